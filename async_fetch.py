@@ -0,0 +1,224 @@
+import asyncio
+import os
+import posixpath
+from typing import Dict, Iterable, List, Optional, Tuple
+import aiohttp
+import wfdb
+from sharding import in_shard
+
+
+# Same location wfdb streams the files from
+PHYSIONET_URL = 'https://physionet.org/files/'
+
+# Answers of an overloaded or failing server, requested again as connection errors
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class AsyncWFDBFetcher:
+    r"""
+    Asynchronous fetcher of WFDB files. Requests share a single HTTP session, so connections are pooled
+    and kept alive, and the number of requests in flight is bounded by a semaphore. Every file fetched is
+    written in mirror_dir with the same layout it has in the database, so the rest of the pipeline can read
+    it with wfdb as a local mirror (see wfdb_source.py).
+
+    Parameters
+    ------------
+
+    database_name: str,
+        the name of the dataset inside PhysioNet (e.g. mimic3wdb-matched/1.0)
+    mirror_dir: str,
+        root directory of the local mirror where files are written
+    base_url: str, default PHYSIONET_URL,
+        the server to fetch the files from, the database is expected at base_url/database_name
+    max_in_flight: int, default 256,
+        maximum number of requests waiting for an answer at the same time
+    max_connections: int, default 64,
+        size of the keep-alive connection pool
+    retries: int, default 3,
+        attempts for a request failing with a connection error, a timeout or one of RETRY_STATUSES
+    timeout: float, default 300,
+        seconds before a single request is abandoned
+    """
+
+    def __init__(self, database_name : str, mirror_dir : str, base_url : str = PHYSIONET_URL, max_in_flight : int = 256, max_connections : int = 64, retries : int = 3, timeout : float = 300):
+        self.database_name = database_name
+        self.mirror_dir = mirror_dir
+        self.base_url = base_url
+        self.max_in_flight = max_in_flight
+        self.max_connections = max_connections
+        self.retries = retries
+        self.timeout = timeout
+        self.n_requests = 0
+        self.n_bytes = 0
+
+    async def __aenter__(self):
+        self._semaphore = asyncio.Semaphore(self.max_in_flight)
+        connector = aiohttp.TCPConnector(limit=self.max_connections, keepalive_timeout=60)
+        self._session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self._session.close()
+
+    def url(self, path : str) -> str:
+        return posixpath.join(self.base_url, self.database_name, path)
+
+    async def fetch(self, path : str) -> bytes:
+        r"""
+        Download a file of the database, raising FileNotFoundError when the server answers 404.
+        """
+        async with self._semaphore:
+            for attempt in range(self.retries):
+                try:
+                    async with self._session.get(self.url(path)) as response:
+                        if response.status == 404:
+                            raise FileNotFoundError(self.url(path))
+                        response.raise_for_status()
+                        content = await response.read()
+                        self.n_requests += 1
+                        self.n_bytes += len(content)
+                        return content
+                except (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError, aiohttp.ClientResponseError) as e:
+                    if attempt == self.retries - 1 or (isinstance(e, aiohttp.ClientResponseError) and e.status not in RETRY_STATUSES):
+                        raise
+                    await asyncio.sleep(2 ** attempt)
+
+    async def fetch_file(self, path : str, overwrite : bool = False) -> str:
+        r"""
+        Download a file of the database into the mirror, files already in the mirror are not downloaded again.
+        The file is written under a temporary name and then renamed, so readers never see partial files.
+        """
+        local_path = os.path.join(self.mirror_dir, path)
+
+        if overwrite or not os.path.exists(local_path):
+            content = await self.fetch(path)
+            os.makedirs(os.path.dirname(local_path), exist_ok=True)
+            tmp_path = f'{local_path}.{os.getpid()}.part'
+            with open(tmp_path, 'wb') as f:
+                f.write(content)
+            os.replace(tmp_path, local_path)
+
+        return local_path
+
+    async def fetch_record_list(self, record_dir : str = '') -> List[str]:
+        local_path = await self.fetch_file(posixpath.join(record_dir, 'RECORDS'))
+        with open(local_path, 'r') as records_file:
+            return records_file.read().splitlines()
+
+    async def fetch_header(self, record_dir : str, record_name : str) -> Optional[str]:
+        r"""
+        Mirror the header of a record, returning the local record path or None when the header does not exist.
+        """
+        try:
+            await self.fetch_file(posixpath.join(record_dir, f'{record_name}.hea'))
+        except FileNotFoundError:
+            return None
+        return os.path.join(self.mirror_dir, record_dir, record_name)
+
+    async def fetch_record(self, record_dir : str, record_name : str) -> Optional[str]:
+        r"""
+        Mirror the header and the signal files of a record, returning the local record path or None when the record does not exist.
+        """
+        record_path = await self.fetch_header(record_dir, record_name)
+        if record_path is None:
+            return None
+
+        # The header lists the signal files, several signals can share the same file (read in a thread, not to block the other requests)
+        header = await asyncio.to_thread(wfdb.rdheader, record_path)
+        signal_files = sorted(set(header.file_name or []))
+
+        try:
+            await asyncio.gather(*[self.fetch_file(posixpath.join(record_dir, signal_file)) for signal_file in signal_files])
+        except FileNotFoundError:
+            return None
+        return record_path
+
+
+async def _or_none(coroutine, what : str):
+    # A request failing after its retries (or any other error) makes its item None, as a file not found, instead of failing the whole batch
+    try:
+        return await coroutine
+    except Exception as e:
+        print(f'Fetch failed for {what}: {type(e).__name__} {e}', flush=True)
+        return None
+
+
+def _split_record_path(record_path : str):
+    # parent_folder/patient_id/seg_id -> ('parent_folder/patient_id/', 'seg_id')
+    record_dir, record_name = posixpath.split(record_path.strip())
+    return f'{record_dir}/' if record_dir else '', record_name
+
+
+def fetch_records(database_name : str, record_paths : Iterable[str], mirror_dir : str, headers_only : bool = False, **fetcher_kwargs) -> Dict[str, Optional[str]]:
+    r"""
+    Mirror many records concurrently, with all the requests sharing one pool of keep-alive connections.
+
+    Parameters
+    ------------
+
+    database_name: str,
+        the name of the dataset inside PhysioNet
+    record_paths: iterable,
+        records in the parent_folder/patient_id/seg_id format
+    mirror_dir: str,
+        root directory of the local mirror where files are written
+    headers_only: bool, default False,
+        whether to fetch only the header files
+    fetcher_kwargs:
+        other arguments of AsyncWFDBFetcher (base_url, max_in_flight, max_connections, ...)
+
+    Returns
+    ------------
+
+    A dictionary from the record path to its local path (None for records not found)
+    """
+    record_paths = [record_path.strip() for record_path in record_paths]
+
+    async def run():
+        async with AsyncWFDBFetcher(database_name, mirror_dir, **fetcher_kwargs) as fetcher:
+            fetch = fetcher.fetch_header if headers_only else fetcher.fetch_record
+            local_paths = await asyncio.gather(*[_or_none(fetch(*_split_record_path(record_path)), record_path) for record_path in record_paths])
+            print(f'Fetched {fetcher.n_requests} files ({fetcher.n_bytes / 2**20:.1f} MB) from {fetcher.base_url}', flush=True)
+            return dict(zip(record_paths, local_paths))
+
+    return asyncio.run(run())
+
+
+def mirror_database_headers(database_name : str, mirror_dir : str, shard : Optional[Tuple[int, int]] = None, **fetcher_kwargs) -> List[str]:
+    r"""
+    Mirror the RECORDS files and the headers of all the waveform files of the database. Subjects are listed
+    and headers are fetched concurrently, then the data provisioning can run on mirror_dir as a local mirror.
+
+    Parameters
+    ------------
+
+    database_name: str,
+        the name of the dataset inside PhysioNet
+    mirror_dir: str,
+        root directory of the local mirror where files are written
+    shard: tuple, default None,
+        (i, N) to mirror only the subjects of the i-th of N shards (see sharding.py)
+    fetcher_kwargs:
+        other arguments of AsyncWFDBFetcher (base_url, max_in_flight, max_connections, ...)
+
+    Returns
+    ------------
+
+    The list of subjects of the database
+    """
+
+    async def mirror_subject(fetcher, subject):
+        files = await fetcher.fetch_record_list(subject)
+        # In the MIMIC III Matched Subset files starting with the subject_id are not waveforms
+        subject_id = subject.split('/')[1]
+        await asyncio.gather(*[_or_none(fetcher.fetch_header(subject, subject_file), f'{subject}{subject_file}') for subject_file in files if not subject_file.startswith(subject_id)])
+
+    async def run():
+        async with AsyncWFDBFetcher(database_name, mirror_dir, **fetcher_kwargs) as fetcher:
+            subjects = [subject for subject in await fetcher.fetch_record_list() if in_shard(subject, shard)]
+            # A subject whose RECORDS cannot be fetched is left out of the mirror, the others go on
+            await asyncio.gather(*[_or_none(mirror_subject(fetcher, subject), subject) for subject in subjects])
+            print(f'Fetched {fetcher.n_requests} files ({fetcher.n_bytes / 2**20:.1f} MB) from {fetcher.base_url}', flush=True)
+            return subjects
+
+    return asyncio.run(run())
@@ -0,0 +1,63 @@
+import argparse
+import time
+import tracemalloc
+import numpy as np
+from scipy.interpolate import PchipInterpolator
+from data_preprocessing import interpolate_nan_pchip
+
+
+def interpolate_nan_pchip_global(data):
+    r"""
+    The interpolation previously used in data_preprocessing, fitted on every valid sample, kept as reference.
+    """
+    valid_indices = np.where(~np.isnan(data))[0]
+    invalid_indices = np.where(np.isnan(data))[0]
+
+    interpolator = PchipInterpolator(valid_indices, data[valid_indices])
+    data[invalid_indices] = interpolator(invalid_indices)
+    return data
+
+
+def measure(function, data):
+    # Best of three for the time, peak of the traced allocations for the memory
+    best = np.inf
+    for _ in range(3):
+        signal = data.copy()
+        start = time.perf_counter()
+        function(signal)
+        best = min(best, time.perf_counter() - start)
+
+    signal = data.copy()
+    tracemalloc.start()
+    result = function(signal)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return best, peak, result
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Global vs gap-local PCHIP interpolation of NaNs')
+    parser.add_argument('--minutes', nargs='+', type=int, help='segment durations to benchmark', default=[8, 20, 60])
+    parser.add_argument('--fs', nargs='?', type=int, help='sampling frequency', default=125)
+    parser.add_argument('--n_gaps', nargs='?', type=int, help='number of NaN gaps per segment', default=10)
+    parser.add_argument('--max_gap', nargs='?', type=float, help='maximum gap length in seconds', default=5.0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+
+    print(f'{"minutes":>8} {"gaps":>5} {"global [ms]":>12} {"local [ms]":>11} {"global [MB]":>12} {"local [MB]":>11} {"max abs diff":>13}')
+    for minutes in args.minutes:
+        n_samples = minutes * 60 * args.fs
+        t = np.arange(n_samples) / args.fs
+        data = 95 + 25 * np.sin(2 * np.pi * 1.2 * t) + rng.normal(0, 0.5, n_samples)
+
+        for start in rng.integers(0, n_samples - int(args.max_gap * args.fs), args.n_gaps):
+            data[start : start + rng.integers(1, int(args.max_gap * args.fs))] = np.nan
+
+        global_time, global_peak, global_result = measure(interpolate_nan_pchip_global, data)
+        local_time, local_peak, local_result = measure(interpolate_nan_pchip, data)
+        no_nans_time, _, _ = measure(interpolate_nan_pchip, global_result)
+
+        print(f'{minutes:>8} {args.n_gaps:>5} {global_time * 1e3:>12.2f} {local_time * 1e3:>11.2f} {global_peak / 2**20:>12.2f} {local_peak / 2**20:>11.2f} {np.abs(global_result - local_result).max():>13.2e}   (no NaNs: {no_nans_time * 1e3:.2f} ms)')
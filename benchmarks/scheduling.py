@@ -0,0 +1,66 @@
+import argparse
+import time
+import numpy as np
+from joblib import Parallel, delayed
+from scheduling import plan_batches, run_scheduled, simulate_makespan
+
+
+def segment_durations(n_segments : int, long_fraction : float, rng : np.random.Generator) -> np.array:
+    r"""
+    Durations in minutes skewed as in mimic3wdb-matched: most segments a little above the 8 minutes minimum, a few of many hours.
+    """
+    durations = 8 + rng.exponential(10, n_segments)
+    n_long = max(1, int(round(long_fraction * n_segments)))
+    durations[rng.choice(n_segments, n_long, replace=False)] = rng.uniform(120, 600, n_long)
+    return durations
+
+
+def process(duration : float, seconds_per_hour : float, overhead : float) -> float:
+    # Busy work proportional to the duration of the segment, plus a fixed cost per task
+    stop = time.perf_counter() + overhead + duration / 60 * seconds_per_hour
+    while time.perf_counter() < stop:
+        pass
+    return duration
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='File order vs longest first (with packed small segments) dispatch of segment workers')
+    parser.add_argument('--n_segments', nargs='?', type=int, help='number of segments', default=400)
+    parser.add_argument('--long_fraction', nargs='?', type=float, help='fraction of segments lasting hours', default=0.01)
+    parser.add_argument('--cores', nargs='+', type=int, help='numbers of workers to benchmark', default=[4, 12])
+    parser.add_argument('--seconds_per_hour', nargs='?', type=float, help='processing time of an hour of signal', default=0.5)
+    parser.add_argument('--overhead', nargs='?', type=float, help='fixed processing time of a segment in seconds', default=0.002)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    durations = segment_durations(args.n_segments, args.long_fraction, rng)
+    # The long segments at the end of the file, the worst case of the file order
+    durations = np.concatenate([durations[durations < 120], durations[durations >= 120]])
+    print(f'{args.n_segments} segments, {np.sum(durations >= 120)} of more than 2 hours, {durations.sum() / 60:.1f} hours in total')
+
+    # Costs in seconds, so that the dispatch overhead measured on the pool is in the same units
+    costs = durations / 60 * args.seconds_per_hour + args.overhead
+    calls = [(duration, args.seconds_per_hour, args.overhead) for duration in durations]
+
+    print(f'{"cores":>6} {"file order [s]":>15} {"longest first [s]":>18} {"speedup":>8} {"expected":>9} {"batches":>8}')
+    for n_cores in args.cores:
+        with Parallel(n_jobs=n_cores) as parallel:
+            # Warm up the workers, and time the dispatch of empty tasks
+            parallel(delayed(process)(0, 0, 0) for _ in range(n_cores))
+            start = time.perf_counter()
+            parallel(delayed(process)(0, 0, 0) for _ in range(len(durations)))
+            dispatch = (time.perf_counter() - start) * n_cores / len(durations)
+
+            start = time.perf_counter()
+            parallel(delayed(process)(*call) for call in calls)
+            file_order = time.perf_counter() - start
+
+            start = time.perf_counter()
+            run_scheduled(parallel, process, calls, costs, name=f'longest first, {n_cores} cores', overhead=dispatch)
+            longest_first = time.perf_counter() - start
+
+        # The plan of run_scheduled, that is deterministic for the same costs
+        batches = plan_batches(costs, n_cores, overhead=dispatch)
+        expected = simulate_makespan(costs + dispatch, n_cores) / simulate_makespan([costs[batch].sum() + dispatch for batch in batches], n_cores)
+        print(f'{n_cores:>6} {file_order:>15.2f} {longest_first:>18.2f} {file_order / longest_first:>7.2f}x {expected:>8.2f}x {len(batches):>8}')
@@ -0,0 +1,210 @@
+import argparse
+import contextlib
+import glob
+import io
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import subprocess
+import time
+from typing import Callable, List
+import numpy as np
+import wfdb
+from joblib import Parallel, delayed
+
+# Figures are only written to files
+os.environ.setdefault('MPLBACKEND', 'Agg')
+
+from benchmarks.synthetic_mimic import generate_mimic_tree
+from data_provisioning import valid_segments_retrieval
+from data_preprocessing import save_records_worker_function, preprocess_records_worker_function
+from data_visualization import worker_function as visualization_worker_function, render_figures_worker_function
+
+
+DATABASE_NAME = 'mimic3wdb-matched/1.0'
+STAGES = ['provisioning', 'save', 'preprocess', 'visualization', 'render']
+
+# Same values of main.py
+VALID_BP_RANGES = {'up_sbp': 220.0, 'low_sbp': 60.0, 'up_dbp': 140.0, 'low_dbp': 30.0}
+THRESHOLDS = {'nans_th': 0.05, 'flat_th': 0.05}
+WINDOWING_PARAM = {'win_len': 20, 'win_overlap': 0.5}
+
+
+def environment() -> dict:
+    r"""
+    What the timings depend on besides the code: versions, machine and commit.
+    """
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {'python': platform.python_version(), 'numpy': np.__version__, 'wfdb': wfdb.__version__, 'platform': platform.platform(),
+            'cpu_count': multiprocessing.cpu_count(), 'commit': commit, 'date': time.strftime('%Y-%m-%d %H:%M:%S')}
+
+
+def timed(function : Callable, repeat : int) -> float:
+    # Best of repeat runs, with the prints of the stage hidden (the workers' ones still reach the terminal)
+    best = np.inf
+    for _ in range(repeat):
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            function()
+            best = min(best, time.perf_counter() - start)
+    return best
+
+
+def read_segments(valid_segments_file : str) -> List[str]:
+    with open(valid_segments_file, 'r') as f:
+        return f.readlines()[1:]
+
+
+def run_suite(work_dir : str, n_patients_list : List[int], cores : List[int], stages : List[str], segments_per_patient : int = 4, minutes : tuple = (8, 20), repeat : int = 1, n_figures : int = 8) -> List[dict]:
+    r"""
+    Time the stages on synthetic trees of n_patients patients (see synthetic_mimic.py) with every number of cores.
+    Each stage starts from the output of the previous one, produced once per tree outside of the timings:
+    - provisioning: valid_segments_retrieval over the tree as a local mirror
+    - save: save_records_worker_function on every valid segment
+    - preprocess: preprocess_records_worker_function on every saved segment (on a fresh copy at every run)
+    - visualization: data_visualization.worker_function on the first n_figures valid segments
+    - render: data_visualization.render_figures_worker_function on all the saved segments, one batch per core
+
+    Parameters
+    ------------
+
+    work_dir: str,
+        where trees and outputs are written, a tree already there is reused
+    n_patients_list: list,
+        the sizes of the trees
+    cores: list,
+        the numbers of parallel workers
+    stages: list,
+        the stages to time, among provisioning, save, preprocess, visualization and render
+    segments_per_patient: int, default 4,
+        number of segments of every patient
+    minutes: tuple, default (8, 20),
+        minimum and maximum duration of a segment
+    repeat: int, default 1,
+        timed runs of every measure (the best is kept)
+    n_figures: int, default 8,
+        number of segments plotted by the visualization stage
+
+    Returns
+    ------------
+
+    A list of results: stage, n_patients, n_segments, n_cores, items, seconds and items_per_second
+    """
+    results = []
+    for n_patients in n_patients_list:
+        tree_dir = os.path.join(work_dir, f'tree_{n_patients}x{segments_per_patient}')
+        if not os.path.exists(os.path.join(tree_dir, 'truth.json')):
+            print(f'Writing {tree_dir} ...', flush=True)
+            generate_mimic_tree(tree_dir, n_patients, segments_per_patient, minutes)
+        with open(os.path.join(tree_dir, 'truth.json'), 'r') as f:
+            n_segments = len(json.load(f))
+
+        # Inputs of the stages, outside of the timings
+        run_dir = os.path.join(work_dir, f'run_{n_patients}x{segments_per_patient}')
+        shutil.rmtree(run_dir, ignore_errors=True)
+        os.makedirs(run_dir)
+        with contextlib.redirect_stdout(io.StringIO()):
+            valid_segments_file = valid_segments_retrieval(DATABASE_NAME, {'ABP', 'PLETH'}, min(minutes), os.path.join(run_dir, 'valid_segments.txt'), n_cores=max(cores), local_dir=tree_dir)
+        segments = read_segments(valid_segments_file)
+        saved_dir = os.path.join(run_dir, 'saved')
+        with contextlib.redirect_stdout(io.StringIO()):
+            Parallel(n_jobs=max(cores))(delayed(save_records_worker_function)(DATABASE_NAME, segment, saved_dir, VALID_BP_RANGES, THRESHOLDS, WINDOWING_PARAM, local_dir=tree_dir) for segment in segments)
+        saved_segments = glob.glob(f'{saved_dir}/*/*/*')
+
+        for n_cores in cores:
+            measures = {}
+
+            if 'provisioning' in stages:
+                n_files = sum(len(open(os.path.join(tree_dir, subject.strip(), 'RECORDS')).readlines()) for subject in open(os.path.join(tree_dir, 'RECORDS')))
+                output_file = os.path.join(run_dir, f'valid_segments_{n_cores}.txt')
+                measures['provisioning'] = (n_files, timed(lambda: valid_segments_retrieval(DATABASE_NAME, {'ABP', 'PLETH'}, min(minutes), output_file, n_cores=n_cores, local_dir=tree_dir), repeat))
+
+            if 'save' in stages:
+                output_dir = os.path.join(run_dir, f'save_{n_cores}')
+
+                def save():
+                    shutil.rmtree(output_dir, ignore_errors=True)
+                    Parallel(n_jobs=n_cores)(delayed(save_records_worker_function)(DATABASE_NAME, segment, output_dir, VALID_BP_RANGES, THRESHOLDS, WINDOWING_PARAM, local_dir=tree_dir) for segment in segments)
+
+                measures['save'] = (len(segments), timed(save, repeat))
+
+            if 'preprocess' in stages:
+                best = np.inf
+                for _ in range(repeat):
+                    # The worker rewrites or removes the segments, every run starts from a fresh copy
+                    copy_dir = os.path.join(run_dir, f'preprocess_{n_cores}')
+                    shutil.rmtree(copy_dir, ignore_errors=True)
+                    shutil.copytree(saved_dir, copy_dir)
+                    copied_segments = [os.path.join(copy_dir, os.path.relpath(segment, saved_dir)) for segment in saved_segments]
+                    best = min(best, timed(lambda: Parallel(n_jobs=n_cores)(delayed(preprocess_records_worker_function)(segment, VALID_BP_RANGES) for segment in copied_segments), 1))
+                measures['preprocess'] = (len(saved_segments), best)
+
+            if 'visualization' in stages:
+                figs_dir = os.path.join(run_dir, f'figs_{n_cores}')
+                os.makedirs(figs_dir, exist_ok=True)
+                measures['visualization'] = (min(n_figures, len(segments)), timed(lambda: Parallel(n_jobs=n_cores)(delayed(visualization_worker_function)(DATABASE_NAME, segment, figs_dir, None, tree_dir) for segment in segments[:n_figures]), repeat))
+
+            if 'render' in stages:
+                render_dir = os.path.join(run_dir, f'render_{n_cores}')
+                os.makedirs(render_dir, exist_ok=True)
+                saved_ids = ['/'.join(segment.replace(os.sep, '/').split('/')[-3:]) for segment in saved_segments]
+                batches = [saved_ids[i::n_cores] for i in range(n_cores)]
+                measures['render'] = (len(saved_ids), timed(lambda: Parallel(n_jobs=n_cores)(delayed(render_figures_worker_function)(batch, render_dir, saved_dir) for batch in batches), repeat))
+
+            for stage, (items, seconds) in measures.items():
+                results.append({'stage': stage, 'n_patients': n_patients, 'n_segments': n_segments, 'n_cores': n_cores, 'items': items, 'seconds': seconds, 'items_per_second': items / seconds if seconds > 0 else None})
+                print(f'{stage:>14} {n_patients:>9} {n_segments:>9} {n_cores:>6} {items:>6} {seconds:>10.2f} {items / seconds:>10.2f}', flush=True)
+
+    return results
+
+
+def compare(results : List[dict], baseline : List[dict], tolerance : float = 0.2) -> List[dict]:
+    r"""
+    Measures slower than the same measure (stage, n_patients, n_cores) of a baseline by more than tolerance.
+    """
+    baseline_seconds = {(result['stage'], result['n_patients'], result['n_cores']): result['seconds'] for result in baseline}
+    regressions = []
+    for result in results:
+        key = (result['stage'], result['n_patients'], result['n_cores'])
+        if key in baseline_seconds and result['seconds'] > (1 + tolerance) * baseline_seconds[key]:
+            regressions.append(dict(result, baseline_seconds=baseline_seconds[key], ratio=result['seconds'] / baseline_seconds[key]))
+    return regressions
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Timings of the pipeline stages on synthetic mimic3wdb-matched-like trees')
+    parser.add_argument('--work_dir', nargs='?', type=str, help='where trees and outputs are written', default='./output/benchmarks')
+    parser.add_argument('--n_patients', nargs='+', type=int, help='sizes of the trees', default=[4, 16])
+    parser.add_argument('--segments_per_patient', nargs='?', type=int, help='number of segments of every patient', default=4)
+    parser.add_argument('--minutes', nargs=2, type=float, help='minimum and maximum duration of a segment', default=[8, 20])
+    parser.add_argument('--cores', nargs='+', type=int, help='numbers of parallel workers', default=[1, 2, 4])
+    parser.add_argument('--stages', nargs='+', type=str, choices=STAGES, help='stages to time', default=STAGES)
+    parser.add_argument('--repeat', nargs='?', type=int, help='timed runs of every measure (the best is kept)', default=1)
+    parser.add_argument('--output', nargs='?', type=str, help='JSON file of the results, by default in work_dir with the date', default=None)
+    parser.add_argument('--baseline', nargs='?', type=str, help='JSON file of previous results, measures slower by more than --tolerance are reported', default=None)
+    parser.add_argument('--tolerance', nargs='?', type=float, help='relative slowdown reported as a regression', default=0.2)
+    args = parser.parse_args()
+
+    os.makedirs(args.work_dir, exist_ok=True)
+    print(f'{"stage":>14} {"patients":>9} {"segments":>9} {"cores":>6} {"items":>6} {"time [s]":>10} {"items/s":>10}')
+    results = run_suite(args.work_dir, args.n_patients, args.cores, args.stages, args.segments_per_patient, tuple(args.minutes), args.repeat)
+
+    output = args.output or os.path.join(args.work_dir, f'stages_{time.strftime("%Y%m%d_%H%M%S")}.json')
+    with open(output, 'w') as f:
+        json.dump({'environment': environment(), 'config': vars(args), 'results': results}, f, indent=2)
+    print(f'Results saved in {output}')
+
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as f:
+            regressions = compare(results, json.load(f)['results'], args.tolerance)
+        for regression in regressions:
+            print(f'Regression: {regression["stage"]} with {regression["n_patients"]} patients and {regression["n_cores"]} cores, {regression["seconds"]:.2f}s vs {regression["baseline_seconds"]:.2f}s ({regression["ratio"]:.2f}x)')
+        if not regressions:
+            print(f'No regressions with respect to {args.baseline}')
@@ -0,0 +1,231 @@
+import argparse
+import json
+import os
+from typing import Tuple
+import numpy as np
+import wfdb
+
+
+# Channels of a segment, with the gains used to store them as 16 bit integers
+CHANNELS = {
+    'II': ('mV', 200.0),
+    'ABP': ('mmHg', 100.0),
+    'PLETH': ('NU', 1000.0),
+}
+
+
+def _beat_phase(n_samples : int, fs : int, heart_rate : float, rng : np.random.Generator) -> np.array:
+    # Phase of the cardiac cycle in [0, 1) for every sample, with a slowly varying heart rate (beats per second)
+    t = np.arange(n_samples) / fs
+    rate = heart_rate * (1 + 0.05 * np.sin(2 * np.pi * t / rng.uniform(30, 90)) + 0.02 * np.sin(2 * np.pi * 0.25 * t))
+    return np.cumsum(rate / fs) % 1.0
+
+
+def synthetic_abp(phase : np.array, fs : int, sbp : float, dbp : float, rng : np.random.Generator) -> np.array:
+    r"""
+    ABP-like waveform between dbp and sbp: systolic peak, dicrotic notch and diastolic decay at every beat,
+    respiratory modulation and measurement noise.
+    """
+    pulse = np.exp(-((phase - 0.15) / 0.07) ** 2) + 0.35 * np.exp(-((phase - 0.45) / 0.08) ** 2) + 0.15 * np.exp(-phase / 0.6)
+    pulse = (pulse - pulse.min()) / (pulse.max() - pulse.min())
+    respiration = 3 * np.sin(2 * np.pi * 0.25 * np.arange(len(phase)) / fs)
+    return dbp + (sbp - dbp) * pulse + respiration + rng.normal(0, 0.5, len(phase))
+
+
+def synthetic_pleth(phase : np.array, rng : np.random.Generator) -> np.array:
+    r"""
+    PLETH-like waveform in [0, 1]: a smoother pulse delayed with respect to the ABP.
+    """
+    delayed = (phase - 0.2) % 1.0
+    pulse = np.exp(-((delayed - 0.3) / 0.15) ** 2) + 0.2 * np.exp(-((delayed - 0.6) / 0.1) ** 2)
+    return 0.2 + 0.6 * pulse / pulse.max() + rng.normal(0, 0.005, len(phase))
+
+
+def synthetic_ecg(phase : np.array, rng : np.random.Generator) -> np.array:
+    r"""
+    ECG-like (lead II) waveform: a narrow R wave and a T wave at every beat.
+    """
+    return np.exp(-((phase - 0.05) / 0.01) ** 2) + 0.3 * np.exp(-((phase - 0.35) / 0.05) ** 2) + rng.normal(0, 0.02, len(phase))
+
+
+def _add_runs(signal : np.array, fraction : float, max_run : int, rng : np.random.Generator, value=None) -> None:
+    # Put runs of NaNs (value None: the last valid sample, i.e. a flat line) until about fraction of the signal is covered
+    n_target = int(fraction * len(signal))
+    covered = 0
+    while covered < n_target:
+        length = int(min(rng.integers(1, max_run + 1), n_target - covered))
+        start = int(rng.integers(1, len(signal) - length))
+        signal[start : start + length] = signal[start - 1] if value is None else value
+        covered += length
+
+
+def write_segment(record_dir : str, segment_name : str, fs : int, minutes : float, anomalies : dict, rng : np.random.Generator) -> Tuple[list, int]:
+    r"""
+    Write one segment (header and 16 bit .dat file) with the channels and the anomalies given.
+
+    Parameters
+    ------------
+
+    record_dir: str,
+        the directory of the patient
+    segment_name: str,
+        the name of the segment (e.g. 3000001_0001)
+    fs: int,
+        the sampling frequency
+    minutes: float,
+        the duration of the segment
+    anomalies: dict,
+        nan_fraction and flat_fraction of the ABP and PLETH, sbp and dbp levels, whether PLETH is missing
+    rng: np.random.Generator,
+        source of the random values
+
+    Returns
+    ------------
+
+    The channels written and the number of samples
+    """
+    n_samples = int(minutes * 60 * fs)
+    phase = _beat_phase(n_samples, fs, rng.uniform(1.0, 1.8), rng)
+
+    signals = {'II': synthetic_ecg(phase, rng), 'ABP': synthetic_abp(phase, fs, anomalies['sbp'], anomalies['dbp'], rng)}
+    if not anomalies['missing_pleth']:
+        signals['PLETH'] = synthetic_pleth(phase, rng)
+
+    for name in ['ABP', 'PLETH']:
+        if name in signals:
+            # Flat lines first, so that NaN gaps can fall inside them as in the real records
+            _add_runs(signals[name], anomalies['flat_fraction'], 30 * fs, rng)
+            _add_runs(signals[name], anomalies['nan_fraction'], 10 * fs, rng, value=np.nan)
+
+    names = list(signals)
+    wfdb.wrsamp(segment_name, fs=fs, units=[CHANNELS[name][0] for name in names], sig_name=names, p_signal=np.stack([signals[name] for name in names], axis=1),
+                fmt=['16'] * len(names), adc_gain=[CHANNELS[name][1] for name in names], baseline=[0] * len(names), write_dir=record_dir)
+    return names, n_samples
+
+
+def generate_mimic_tree(root_dir : str, n_patients : int = 8, segments_per_patient : int = 4, minutes : Tuple[float, float] = (5, 20), fs : int = 125,
+                        nan_prob : float = 0.2, nan_fraction : float = 0.1, flat_prob : float = 0.1, flat_fraction : float = 0.1,
+                        out_of_range_prob : float = 0.1, missing_pleth_prob : float = 0.1, seed : int = 0) -> dict:
+    r"""
+    Write a local WFDB tree with the layout of mimic3wdb-matched, usable as local_dir/local_mirror by every stage:
+    RECORDS at the root with the pXX/pXXXXXX/ subjects, and in every subject a RECORDS file with the segments
+    (NNNNNNN_0001, ...), a layout header (NNNNNNN_layout), the master header of the multi-segment record
+    (pXXXXXX-YYYY-MM-DD-hh-mm) and the name of the numerics record (pXXXXXX-...n, listed but not written).
+
+    Segments have ECG (II), ABP and, most of the times, PLETH, with anomalies drawn at random for every segment:
+    - NaN gaps covering about nan_fraction of ABP and PLETH (with probability nan_prob)
+    - flat lines covering about flat_fraction of ABP and PLETH (with probability flat_prob)
+    - pressures out of the usual ranges, hypertensive or hypotensive (with probability out_of_range_prob)
+    - no PLETH channel (with probability missing_pleth_prob)
+    The ground truth of every segment is written in truth.json at the root.
+
+    Parameters
+    ------------
+
+    root_dir: str,
+        root directory of the tree
+    n_patients: int, default 8,
+        number of patients, spread over the pXX groups
+    segments_per_patient: int, default 4,
+        number of segments of every patient
+    minutes: tuple, default (5, 20),
+        minimum and maximum duration of a segment
+    fs: int, default 125,
+        the sampling frequency
+    nan_prob, nan_fraction, flat_prob, flat_fraction, out_of_range_prob, missing_pleth_prob: float,
+        the anomalies, see above
+    seed: int, default 0,
+        seed of the random values, the same seed writes the same tree
+
+    Returns
+    ------------
+
+    The ground truth: a dictionary from segment (parent_folder/patient_id/seg_id) to its duration, channels and anomalies
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(root_dir, exist_ok=True)
+    n_groups = min(10, n_patients)
+
+    subjects = []
+    truth = {}
+    for i in range(n_patients):
+        patient_id = f'p{(i % n_groups) * 10000 + i // n_groups + 1:06d}'
+        subject = f'{patient_id[:3]}/{patient_id}/'
+        record_dir = os.path.join(root_dir, subject)
+        os.makedirs(record_dir, exist_ok=True)
+        subjects.append(subject)
+
+        record_number = 3000000 + i
+        master_name = f'{patient_id}-2100-01-01-00-00'
+        segment_names = []
+        segment_lengths = []
+
+        for k in range(1, segments_per_patient + 1):
+            segment_name = f'{record_number}_{k:04d}'
+            out_of_range = bool(rng.random() < out_of_range_prob)
+            if out_of_range:
+                sbp, dbp = (rng.uniform(230, 260), rng.uniform(140, 160)) if rng.random() < 0.5 else (rng.uniform(45, 55), rng.uniform(15, 25))
+            else:
+                sbp, dbp = rng.uniform(100, 160), rng.uniform(50, 90)
+
+            anomalies = {
+                'sbp': float(sbp),
+                'dbp': float(dbp),
+                'out_of_range': out_of_range,
+                'nan_fraction': float(nan_fraction if rng.random() < nan_prob else 0.0),
+                'flat_fraction': float(flat_fraction if rng.random() < flat_prob else 0.0),
+                'missing_pleth': bool(rng.random() < missing_pleth_prob),
+            }
+            duration = float(rng.uniform(*minutes))
+            channels, n_samples = write_segment(record_dir, segment_name, fs, duration, anomalies, rng)
+
+            segment_names.append(segment_name)
+            segment_lengths.append(n_samples)
+            truth[f'{subject}{segment_name}'] = dict(anomalies, minutes=duration, channels=channels)
+
+        # Layout and master headers of the multi-segment record, as in mimic3wdb-matched
+        layout_name = f'{record_number}_layout'
+        with open(os.path.join(record_dir, f'{layout_name}.hea'), 'w') as f:
+            f.write(f'{layout_name} {len(CHANNELS)} {fs} 0\n')
+            for name, (units, gain) in CHANNELS.items():
+                f.write(f'~ 0 {gain:g}/{units} 16 0 0 0 0 {name}\n')
+
+        with open(os.path.join(record_dir, f'{master_name}.hea'), 'w') as f:
+            f.write(f'{master_name}/{len(segment_names) + 1} {len(CHANNELS)} {fs} {sum(segment_lengths)} 00:00:00.000 01/01/2100\n')
+            f.write(f'{layout_name} 0\n')
+            for segment_name, length in zip(segment_names, segment_lengths):
+                f.write(f'{segment_name} {length}\n')
+
+        with open(os.path.join(record_dir, 'RECORDS'), 'w') as f:
+            for name in segment_names + [layout_name, master_name, f'{master_name}n']:
+                f.write(f'{name}\n')
+
+    with open(os.path.join(root_dir, 'RECORDS'), 'w') as f:
+        for subject in sorted(subjects):
+            f.write(f'{subject}\n')
+
+    with open(os.path.join(root_dir, 'truth.json'), 'w') as f:
+        json.dump(truth, f, indent=2)
+
+    return truth
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Write a synthetic mimic3wdb-matched-like WFDB tree')
+    parser.add_argument('root_dir', type=str, help='root directory of the tree')
+    parser.add_argument('--n_patients', nargs='?', type=int, help='number of patients', default=8)
+    parser.add_argument('--segments_per_patient', nargs='?', type=int, help='number of segments of every patient', default=4)
+    parser.add_argument('--minutes', nargs=2, type=float, help='minimum and maximum duration of a segment', default=[5, 20])
+    parser.add_argument('--nan_prob', nargs='?', type=float, help='probability of NaN gaps in a segment', default=0.2)
+    parser.add_argument('--nan_fraction', nargs='?', type=float, help='fraction of ABP and PLETH in NaN gaps', default=0.1)
+    parser.add_argument('--flat_prob', nargs='?', type=float, help='probability of flat lines in a segment', default=0.1)
+    parser.add_argument('--flat_fraction', nargs='?', type=float, help='fraction of ABP and PLETH in flat lines', default=0.1)
+    parser.add_argument('--out_of_range_prob', nargs='?', type=float, help='probability of pressures out of the usual ranges', default=0.1)
+    parser.add_argument('--missing_pleth_prob', nargs='?', type=float, help='probability of a segment without PLETH', default=0.1)
+    parser.add_argument('--seed', nargs='?', type=int, help='seed of the random values', default=0)
+    args = parser.parse_args()
+
+    truth = generate_mimic_tree(args.root_dir, args.n_patients, args.segments_per_patient, tuple(args.minutes), nan_prob=args.nan_prob, nan_fraction=args.nan_fraction,
+                                flat_prob=args.flat_prob, flat_fraction=args.flat_fraction, out_of_range_prob=args.out_of_range_prob, missing_pleth_prob=args.missing_pleth_prob, seed=args.seed)
+    print(f'Written {len(truth)} segments of {args.n_patients} patients in {args.root_dir}')
@@ -0,0 +1,117 @@
+import argparse
+import time
+import numpy as np
+from scipy.interpolate import PchipInterpolator
+from scipy.signal import find_peaks
+from data_preprocessing import create_windows, estimate_windowed_bp, interpolate_nan_pchip
+
+
+def interpolate_nan_pchip_baseline(data):
+    r"""
+    The interpolation of the baseline code, copied verbatim: the interpolator is built on every window, NaNs or not.
+    """
+
+    valid_indices = np.where(~np.isnan(data))[0]
+    invalid_indices = np.where(np.isnan(data))[0]
+
+    # There is a paper suggesting this interpolation whihch better preserve frequencies
+    interpolator = PchipInterpolator(valid_indices, data[valid_indices])
+    interpolated_values = interpolator(invalid_indices)
+
+    data[invalid_indices] = interpolated_values
+    return data
+
+
+def windowed_bp_loop(abp : np.array, win_start : np.array, win_stop : np.array):
+    r"""
+    The per-window loop of the baseline save_records_worker_function, copied verbatim with its interpolation, kept as reference.
+    """
+    n_win = len(win_start)
+
+    SBP = []
+    DBP = []
+
+    # Sliding window over the signal: it prevents to remove signals with small amount of missing data 
+    for j in range(0, n_win):
+        idx_start = win_start[j]
+        idx_stop = win_stop[j]
+
+        sig = abp[idx_start : idx_stop]
+
+        try:
+            # Interp to remove nan: can raise an exception if the window is completely empty
+            sig = interpolate_nan_pchip_baseline(sig)
+
+            # scipy.signal.find_peaks return a pair with idxs on the first element
+            peaks = find_peaks(sig)[0]
+            valleys = find_peaks(-sig)[0]
+
+            # Check in case there signal is basically flat in the window
+            if len(peaks) == 0 or len(valleys) == 0:
+                # Set an invalid BP value
+                sbp = 0.0
+                dbp = 0.0
+            else:
+                # Calculate the actual SBP and DBP
+                sbp = np.mean(sig[peaks])
+                dbp = np.mean(sig[valleys])
+
+            SBP.append(sbp)
+            DBP.append(dbp)
+
+        except: 
+            SBP.append(0.0)
+            DBP.append(0.0)        
+
+    return np.array(SBP), np.array(DBP)
+
+
+def windowed_bp_batched(abp : np.array, win_start : np.array, win_stop : np.array):
+    r"""
+    The code path of check_segment: NaNs interpolated once on the whole signal, then the batched estimation.
+    """
+    return estimate_windowed_bp(interpolate_nan_pchip(abp), win_start, win_stop)
+
+
+def synthetic_abp(n_samples : int, fs : int, rng : np.random.Generator) -> np.array:
+    r"""
+    ABP-like signal: a pulse train with a slowly varying heart rate, quantized like the ADC output (so peaks
+    have plateaus), with a flat part to exercise the 0.0 rule.
+    """
+    t = np.arange(n_samples) / fs
+    heart_rate = 1.2 + 0.1 * np.sin(2 * np.pi * t / 60)
+    phase = 2 * np.pi * np.cumsum(heart_rate) / fs
+    abp = 95 + 25 * np.sin(phase) + 8 * np.sin(2 * phase + 0.5) + rng.normal(0, 0.5, n_samples)
+    abp = np.round(abp * 2) / 2
+
+    abp[n_samples // 3 : n_samples // 3 + 30 * fs] = abp[n_samples // 3]
+    return abp
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Per-window loop of the baseline vs batched SBP/DBP estimation')
+    parser.add_argument('--minutes', nargs='+', type=int, help='segment durations to benchmark', default=[8, 20, 60])
+    parser.add_argument('--fs', nargs='?', type=int, help='sampling frequency', default=125)
+    parser.add_argument('--repeat', nargs='?', type=int, help='timed repetitions (best is reported)', default=3)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+
+    print(f'{"minutes":>8} {"windows":>8} {"loop [ms]":>10} {"batched [ms]":>13} {"speedup":>8} {"max abs diff":>13}')
+    for minutes in args.minutes:
+        abp = synthetic_abp(minutes * 60 * args.fs, args.fs, rng)
+        win_start, win_stop = create_windows(20, args.fs, len(abp), 0.5)
+
+        timings = {}
+        results = {}
+        for name, estimator in [('loop', windowed_bp_loop), ('batched', windowed_bp_batched)]:
+            best = np.inf
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                results[name] = estimator(abp.copy(), win_start, win_stop)
+                best = min(best, time.perf_counter() - start)
+            timings[name] = best
+
+        diff = max(np.abs(results['loop'][0] - results['batched'][0]).max(), np.abs(results['loop'][1] - results['batched'][1]).max())
+        print(f'{minutes:>8} {len(win_start):>8} {timings["loop"] * 1e3:>10.1f} {timings["batched"] * 1e3:>13.1f} {timings["loop"] / timings["batched"]:>7.1f}x {diff:>13.2e}')
@@ -0,0 +1,111 @@
+import json
+import os
+from typing import Dict, List
+
+
+class CrawlJournal:
+    r"""
+    Append-only journal of the data provisioning crawl. The first line holds the crawl parameters, then
+    every subject whose files have all been checked is appended as one JSON line with its valid segments,
+    which is both the result and the completion marker of the subject. When the crawl is started again with
+    the same parameters, subjects found in the journal are not crawled again.
+
+    Lines are flushed as soon as they are written (so a killed process loses at most the subjects being
+    processed) and synced to disk every fsync_every subjects, the cost is negligible compared to reading headers.
+
+    Parameters
+    ------------
+
+    journal_path: str,
+        location of the journal file
+    params: dict,
+        the crawl parameters (JSON serializable), a journal written with other parameters is discarded
+    fsync_every: int, default 100,
+        number of subjects between two syncs of the journal to disk
+    """
+
+    def __init__(self, journal_path : str, params : dict, fsync_every : int = 100):
+        self.journal_path = journal_path
+        self.params = params
+        self.fsync_every = fsync_every
+        self.completed: Dict[str, List[str]] = {}
+        self._n_written = 0
+
+        if os.path.exists(journal_path) and self._load():
+            print(f'Resuming from {journal_path}: {len(self.completed)} subjects already crawled', flush=True)
+            self._file = open(journal_path, 'a')
+        else:
+            self._file = open(journal_path, 'w')
+            self._write(params)
+
+    def _load(self) -> bool:
+        # Return whether the journal on disk can be resumed
+        with open(self.journal_path, 'r') as f:
+            lines = f.readlines()
+
+        # The header too can be truncated, if the process has been killed before the first subject
+        try:
+            header = json.loads(lines[0]) if lines and lines[0].endswith('\n') else None
+        except json.JSONDecodeError:
+            header = None
+        if header is None:
+            print(f'{self.journal_path} has no valid header, starting from scratch', flush=True)
+            return False
+
+        if header != self.params:
+            print(f'{self.journal_path} was written with other parameters, starting from scratch', flush=True)
+            return False
+
+        for line in lines[1:]:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                # The last line can be truncated if the process has been killed while writing it
+                continue
+            self.completed[entry['subject']] = entry['records']
+
+        # Drop a truncated line, so that the next entry starts on its own line
+        if not lines[-1].endswith('\n'):
+            with open(self.journal_path, 'w') as f:
+                f.writelines(lines[:-1])
+
+        return True
+
+    def _write(self, entry : dict) -> None:
+        self._file.write(json.dumps(entry) + '\n')
+        self._file.flush()
+
+    def record_subject(self, subject : str, records : List) -> None:
+        r"""
+        Append the valid segments of a subject, marking it as completed.
+
+        Parameters
+        ------------
+
+        subject: str,
+            path identifying the subject inside the dataset
+        records: list,
+            the valid segments of the subject
+
+        Returns
+        ------------
+        None
+        """
+        records = [str(record) for record in records]
+        self._write({'subject': subject, 'records': records})
+        self.completed[subject] = records
+
+        self._n_written += 1
+        if self._n_written % self.fsync_every == 0:
+            os.fsync(self._file.fileno())
+
+    def close(self) -> None:
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -1,47 +1,55 @@
+import io
 import os
+import time
 from pathlib import Path
 import shutil
 import glob
 import zipfile
-from joblib import Parallel, delayed
+from joblib import Parallel, delayed, effective_n_jobs
 import multiprocessing
 from shutil import rmtree
-from typing import Tuple
-import wfdb
+from typing import Dict, List, Optional, Tuple
 import numpy as np
 from scipy.interpolate import PchipInterpolator
 from scipy.signal import find_peaks
-
-
-def count_patients_and_records(valid_segments_file: str) -> Tuple[int, int]:
+from wfdb_source import rdheader, iter_record_chunks, signal_file_bytes
+from async_fetch import fetch_records
+from segment_store import SegmentStore
+from segment_catalog import SegmentCatalog, read_segments_txt
+from event_journal import EventJournal
+from feature_table import FeatureTable, qc_status
+from sharding import in_shard
+from scheduling import run_scheduled, segment_costs, plan_batches, npy_length, zip_member_sizes
+from instrumentation import instrumented, step, add_bytes, count
+
+
+def count_patients_and_records(valid_segments_file: str, status: Optional[str] = None) -> Tuple[int, int]:
     r"""
-    Given a txt file with the database name and its valid segments, return the amount of different patients and 
+    Given a segment catalog or a txt file with the database name and its valid segments, return the amount of different patients and 
     total number of reocords with the required signals specified during the data provisioning step.
     
     Parameters
     ------------
 
     valid_segments_file: string,
-        the txt file to be analyzed
+        the segment catalog (.sqlite, see segment_catalog.py) or the txt file to be analyzed
+    status: string, default None,
+        count only the segments of the catalog with this status (e.g. 'downloaded')
 
     Returns
     ------------
 
-    An integer, the number of different patients 
+    An integer, the number of different patients, and the number of records
     """
     
-    with open(valid_segments_file, 'r') as seg_file:
-        lines = seg_file.readlines()
-
-        # First line is the database name
-        _ = lines[0]
-        patients = set()
+    if valid_segments_file.endswith('.sqlite'):
+        # Counts are kept by the catalog, nothing is scanned
+        with SegmentCatalog(valid_segments_file) as catalog:
+            return catalog.count_patients(status), catalog.count(status)
 
-        # Next lines are all structured as parent_directory/patient_id/segments
-        for i in range(1, len(lines)):
-            patients.add(lines[i].split('/')[1])
-        
-    return len(patients), len(lines) - 1
+    # A txt file is counted with a set of patients, much faster than filling a catalog
+    _, segments = read_segments_txt(valid_segments_file)
+    return len({segment.split('/')[1] for segment in segments}), len(segments)
 
 
 def nans_percentage(signal : np.array) -> float:
@@ -96,31 +104,288 @@ def flat_lines_detection(signal : np.array, delta : float = 1e-5, window_len = 3
     return np.concatenate((pre_window, flat_locs_sig))
 
 
-def interpolate_nan_pchip(data):
+def find_nan_runs(data : np.array) -> Tuple[np.array, np.array]:
+    r"""
+    Find the runs of consecutive NaNs (gaps) of a 1D signal with a vectorised run-length encoding.
+
+    Parameters
+    ------------
+
+    data: np.array,
+        the input 1D NumPy array.
+
+    Returns
+    ------------
+
+    starts: np.array,
+        index of the first NaN of every gap
+    lengths: np.array,
+        number of NaNs of every gap
+    """
+    # Transitions of the NaN mask: +1 where a gap starts, -1 right after it ends
+    transitions = np.diff(np.isnan(data).view(np.int8), prepend=np.int8(0), append=np.int8(0))
+    starts = np.flatnonzero(transitions == 1)
+    stops = np.flatnonzero(transitions == -1)
+
+    return starts, stops - starts
+
+
+def interpolate_nan_pchip(data, return_gaps : bool = False):
     r"""
     Interpolates NaN values in a 1D NumPy array using PCHIP.
+    PCHIP is local: the curve inside a gap only depends on the two valid samples on each side of it
+    (three at the edges of the signal), so the interpolator is fitted only on these neighbourhoods instead of
+    on every valid sample, with the same result. Arrays without NaNs are returned untouched.
 
     Parameters
     ------------
     
     data: np.array, 
-        the input 1D NumPy array.
+        the input 1D NumPy array, modified in place.
+    return_gaps: bool, default False,
+        whether to return also the length of every gap that has been interpolated
 
     Returns
     ------------
     
-    The interpolated array.
+    The interpolated array, and the array of gap lengths when return_gaps is True (its size is the number of gaps).
     """
 
-    valid_indices = np.where(~np.isnan(data))[0]
-    invalid_indices = np.where(np.isnan(data))[0]
+    # NaNs propagate through the sum, so this is a quick check without allocating a mask
+    if not np.isnan(np.sum(data)):
+        return (data, np.zeros(0, dtype=int)) if return_gaps else data
+
+    starts, lengths = find_nan_runs(data)
+    if len(starts) == 0:
+        # The sum was NaN because of opposite infinities
+        return (data, lengths) if return_gaps else data
+
+    # Rank (among the valid samples) of the first valid sample after every gap
+    nans_before = np.concatenate(([0], np.cumsum(lengths)))
+    after_ranks = starts - nans_before[:-1]
+    n_valid = len(data) - nans_before[-1]
+
+    # Neighbourhood of every gap: three valid samples on each side cover the derivatives at the gap ends,
+    # also when the gap is at the edges of the signal and PCHIP extrapolates
+    ranks = np.unique(np.clip((after_ranks[:, None] + np.arange(-3, 3)).ravel(), 0, n_valid - 1))
+
+    # Back from ranks to indexes: shift by the NaNs of the gaps before each valid sample
+    gaps_before = np.searchsorted(after_ranks, ranks, side='right')
+    knots = ranks + nans_before[gaps_before]
 
     # There is a paper suggesting this interpolation whihch better preserve frequencies
-    interpolator = PchipInterpolator(valid_indices, data[valid_indices])
-    interpolated_values = interpolator(invalid_indices)
+    interpolator = PchipInterpolator(knots, data[knots])
+
+    invalid_indices = np.flatnonzero(np.isnan(data))
+    data[invalid_indices] = interpolator(invalid_indices)
+
+    return (data, lengths) if return_gaps else data
+
+
+class SignalQualityReport:
+    r"""
+    Quality statistics of several signals of the same segment (e.g. ABP and PLETH) computed together in a
+    single pass, in blocks of bounded size: NaN fraction, flat fraction, min/max and NaN gaps of every channel.
+    The flat parts follow flat_lines_detection, and min/max ignore NaNs.
+
+    Signals can be fed block by block with update (e.g. while they are being downloaded), or all at once with
+    from_signals. Since the flat check of the pipeline runs on the interpolated signals, refresh_after_interpolation
+    updates flat parts and min/max by looking only at the samples around the NaN gaps.
+
+    Parameters
+    ------------
+
+    n_channels: int, default 2,
+        number of signals
+    delta: float, default 1e-5,
+        the threshold to determine whether two values are equal
+    window_len: int, default 3,
+        the distance of the compared values
+    """
 
-    data[invalid_indices] = interpolated_values
-    return data
+    def __init__(self, n_channels : int = 2, delta : float = 1e-5, window_len : int = 3):
+        self.n_channels = n_channels
+        self.delta = delta
+        self.window_len = window_len
+        self.n_samples = 0
+        self.nan_count = np.zeros(n_channels, dtype=int)
+        self.flat_count = np.zeros(n_channels, dtype=int)
+        self.minimum = np.full(n_channels, np.nan)
+        self.maximum = np.full(n_channels, np.nan)
+        self._gap_starts = [[] for _ in range(n_channels)]
+        self._gap_stops = [[] for _ in range(n_channels)]
+        self._open_gaps = [None] * n_channels
+        self._tail = None
+        self.interpolated = False
+
+    @classmethod
+    def from_signals(cls, signals, block_size : int = 2**16, delta : float = 1e-5, window_len : int = 3) -> 'SignalQualityReport':
+        r"""
+        Compute the report of whole signals, reading them block by block.
+
+        Parameters
+        ------------
+
+        signals: np.array or list,
+            a 2D array (samples x channels) or a list of 1D arrays of the same length
+        block_size: int, default 2**16,
+            number of samples of every block
+        delta: float, default 1e-5,
+            the threshold to determine whether two values are equal
+        window_len: int, default 3,
+            the distance of the compared values
+
+        Returns
+        ------------
+
+        The SignalQualityReport of the signals
+        """
+        n_channels = signals.shape[1] if isinstance(signals, np.ndarray) else len(signals)
+        report = cls(n_channels, delta, window_len)
+
+        n_samples = len(signals) if isinstance(signals, np.ndarray) else len(signals[0])
+        for block_start in range(0, n_samples, block_size):
+            report.update(_signals_block(signals, block_start, block_start + block_size))
+
+        return report
+
+    def update(self, block : np.array) -> None:
+        r"""
+        Add the next block of samples (samples x channels) to the report.
+        """
+        n, w = len(block), self.window_len
+        if n == 0:
+            return
+        offset = self.n_samples
+
+        nan_mask = np.isnan(block)
+        self.nan_count += nan_mask.sum(axis=0)
+
+        # fmin/fmax ignore NaNs and do not warn on all-NaN blocks
+        self.minimum = np.fmin(self.minimum, np.fmin.reduce(block, axis=0))
+        self.maximum = np.fmax(self.maximum, np.fmax.reduce(block, axis=0))
+
+        # Flat parts: samples compared with the one window_len before, also across the previous block.
+        # Comparisons with NaNs are False, as in flat_lines_detection
+        if self._tail is not None:
+            head = np.concatenate((self._tail, block[:w]))
+            self.flat_count += (np.abs(head[w:] - head[:-w]) < self.delta).sum(axis=0)
+        if n > w:
+            self.flat_count += (np.abs(block[w:] - block[:-w]) < self.delta).sum(axis=0)
+        self._tail = block[-w:].copy() if self._tail is None or n >= w else np.concatenate((self._tail, block))[-w:]
+
+        # NaN gaps, a gap still open at the end of the previous block continues if this block starts with a NaN
+        transitions = np.diff(nan_mask.view(np.int8), axis=0, prepend=np.zeros((1, self.n_channels), dtype=np.int8), append=np.zeros((1, self.n_channels), dtype=np.int8))
+        for c in range(self.n_channels):
+            starts = np.flatnonzero(transitions[:, c] == 1) + offset
+            stops = np.flatnonzero(transitions[:, c] == -1) + offset
+
+            if self._open_gaps[c] is not None:
+                if len(starts) > 0 and starts[0] == offset:
+                    starts[0] = self._open_gaps[c]
+                else:
+                    self._gap_starts[c].append(np.array([self._open_gaps[c]]))
+                    self._gap_stops[c].append(np.array([offset]))
+                self._open_gaps[c] = None
+
+            if len(stops) > 0 and stops[-1] == offset + n:
+                self._open_gaps[c] = starts[-1]
+                starts, stops = starts[:-1], stops[:-1]
+
+            self._gap_starts[c].append(starts)
+            self._gap_stops[c].append(stops)
+
+        self.n_samples += n
+
+    def gaps(self, channel : int) -> Tuple[np.array, np.array]:
+        r"""
+        Starts and lengths of the NaN gaps of a channel.
+        """
+        starts = np.concatenate(self._gap_starts[channel] + [np.zeros(0, dtype=int)]).astype(int)
+        stops = np.concatenate(self._gap_stops[channel] + [np.zeros(0, dtype=int)]).astype(int)
+        if self._open_gaps[channel] is not None:
+            starts = np.append(starts, self._open_gaps[channel])
+            stops = np.append(stops, self.n_samples)
+        return starts, stops - starts
+
+    @property
+    def nan_fraction(self) -> np.array:
+        return self.nan_count / max(self.n_samples, 1)
+
+    @property
+    def flat_fraction(self) -> np.array:
+        return self.flat_count / max(self.n_samples, 1)
+
+    @property
+    def gap_count(self) -> np.array:
+        return np.array([len(self.gaps(c)[0]) for c in range(self.n_channels)])
+
+    @property
+    def max_gap(self) -> np.array:
+        return np.array([self.gaps(c)[1].max(initial=0) for c in range(self.n_channels)])
+
+    def metrics(self, names : List[str]) -> dict:
+        r"""
+        The statistics of every channel as a flat dictionary of floats (e.g. abp_nan_fraction, ppg_max_gap), for logging.
+
+        Parameters
+        ------------
+
+        names: list,
+            a short name for every channel, used as prefix of its statistics
+
+        Returns
+        ------------
+
+        A dictionary from the name of a statistic to its value
+        """
+        statistics = {'nan_fraction': self.nan_fraction, 'flat_fraction': self.flat_fraction, 'gap_count': self.gap_count, 'max_gap': self.max_gap, 'min': self.minimum, 'max': self.maximum}
+        return {f'{name}_{statistic}': float(values[c]) for c, name in enumerate(names) for statistic, values in statistics.items()}
+
+    def refresh_after_interpolation(self, signals) -> None:
+        r"""
+        Update flat parts and min/max once the NaN gaps of the signals have been interpolated (in place).
+        Before the interpolation, any comparison involving a NaN was not flat: only the samples inside a gap,
+        or window_len samples after it, can change and they are the only ones checked again.
+        The NaN counts and gaps keep describing the signals before the interpolation.
+
+        Parameters
+        ------------
+
+        signals: np.array or list,
+            the interpolated signals, in the same format given to from_signals
+
+        Returns
+        ------------
+        None
+        """
+        if self.interpolated:
+            return
+        w = self.window_len
+
+        for c in range(self.n_channels):
+            signal = signals[:, c] if isinstance(signals, np.ndarray) else signals[c]
+            starts, lengths = self.gaps(c)
+            if len(starts) == 0:
+                continue
+
+            gap_indices = np.concatenate([np.arange(start, start + length) for start, length in zip(starts, lengths)])
+            self.minimum[c] = np.fmin(self.minimum[c], np.fmin.reduce(signal[gap_indices]))
+            self.maximum[c] = np.fmax(self.maximum[c], np.fmax.reduce(signal[gap_indices]))
+
+            # Samples inside a gap, and samples compared with one inside a gap
+            checked = np.concatenate([np.arange(start, start + length) for start, length in zip(starts, lengths)] + [np.arange(start + w, start + length + w) for start, length in zip(starts, lengths)])
+            checked = np.unique(checked[(checked >= w) & (checked < self.n_samples)])
+            self.flat_count[c] += np.count_nonzero(np.abs(signal[checked] - signal[checked - w]) < self.delta)
+
+        self.interpolated = True
+
+
+def _signals_block(signals, block_start : int, block_stop : int) -> np.array:
+    # Rows [block_start, block_stop) of the signals as a (samples x channels) array
+    if isinstance(signals, np.ndarray):
+        return signals[block_start : block_stop]
+    return np.column_stack([signal[block_start : block_stop] for signal in signals])
 
 
 def create_windows(win_len, fs, n_samp, overlap)-> Tuple[np.array, np.array]:
@@ -159,7 +424,156 @@ def create_windows(win_len, fs, n_samp, overlap)-> Tuple[np.array, np.array]:
     return idx_start, idx_stop
 
 
-def save_records_worker_function(database_name : str, valid_segment_path : str, output_dir : str, valid_bp_ranges : dict, thresholds : dict, windowing_param : dict) -> None:
+def _windowed_peaks_sum(signal : np.array, win_start : np.array, win_stop : np.array) -> Tuple[np.array, np.array]:
+    # Peaks of the whole signal, with the edges of their plateaus (left == right for sharp peaks)
+    peaks, properties = find_peaks(signal, plateau_size=1)
+    left_edges = properties['left_edges']
+    right_edges = properties['right_edges']
+
+    # find_peaks on signal[start : stop] returns exactly the peaks of the whole signal whose plateau, plus one
+    # sample on both sides, lies inside the window: left_edge >= start + 1 and right_edge <= stop - 2.
+    # Plateaus are sorted and do not overlap, so the peaks of a window are a contiguous range [lo, hi)
+    lo = np.searchsorted(left_edges, win_start + 1, side='left')
+    hi = np.searchsorted(right_edges, win_stop - 2, side='right')
+    counts = np.maximum(hi - lo, 0)
+
+    cumulative = np.concatenate(([0.0], np.cumsum(signal[peaks])))
+    sums = np.where(counts > 0, cumulative[np.maximum(hi, lo)] - cumulative[lo], 0.0)
+
+    return sums, counts
+
+
+def estimate_windowed_bp(abp : np.array, win_start : np.array, win_stop : np.array) -> Tuple[np.array, np.array]:
+    r"""
+    Estimate SBP and DBP of every window as the mean value of the peaks and valleys of the ABP inside the window.
+    Peaks and valleys are found once over the whole signal, then each window takes its own with searchsorted
+    and the means come from cumulative sums, so every sample is scanned only twice whatever the overlap.
+    The result is the one of running scipy.signal.find_peaks on every abp[start : stop] window (up to floating
+    point rounding), and windows without peaks or valleys (flat windows) get SBP = DBP = 0.0.
+
+    Parameters
+    ------------
+
+    abp: np.array,
+        the arterial blood pressure, without NaNs (i.e. already interpolated)
+    win_start: np.array,
+        array of window starting indexes in the signal (as returned by create_windows)
+    win_stop: np.array,
+        array of window ending indexes in the signal (excluded, as returned by create_windows)
+
+    Returns
+    ------------
+
+    SBP: np.array,
+        the systolic blood pressure of every window
+    DBP: np.array,
+        the diastolic blood pressure of every window
+    """
+    win_start = np.asarray(win_start, dtype=int)
+    win_stop = np.asarray(win_stop, dtype=int)
+
+    peaks_sum, peaks_count = _windowed_peaks_sum(abp, win_start, win_stop)
+    valleys_sum, valleys_count = _windowed_peaks_sum(-abp, win_start, win_stop)
+
+    # Check in case the signal is basically flat in the window, then set an invalid BP value
+    valid = (peaks_count > 0) & (valleys_count > 0)
+    SBP = np.where(valid, peaks_sum / np.maximum(peaks_count, 1), 0.0)
+    DBP = np.where(valid, -valleys_sum / np.maximum(valleys_count, 1), 0.0)
+
+    return SBP, DBP
+
+
+def read_segment_signals(seg_id : str, database_name : str, record_dir : str, local_dir : Optional[str] = None, channel_names : Tuple[str, ...] = ('ABP', 'PLETH'), chunk_size : int = 2**18, out_files : Optional[List[str]] = None):
+    r"""
+    Read only the required channels of a segment, in chunks of bounded size, and compute their SignalQualityReport
+    while the chunks arrive. The header is read first, so every channel is allocated once with its final length.
+    When out_files are given, every channel is written in its own .npy file through a memory map, so the memory
+    used by a worker does not grow with the length of the segment.
+
+    Parameters
+    ------------
+
+    seg_id: str,
+        the name of the segment (without extension)
+    database_name: str,
+        the name of the dataset, it will be used to build the file path
+    record_dir: str,
+        the directory of the segment inside the dataset (e.g. p00/p000020/)
+    local_dir: str, default None,
+        root directory of a local mirror of the database, when None PhysioNet is queried
+    channel_names: tuple, default ('ABP', 'PLETH'),
+        the channels to read
+    chunk_size: int, default 2**18,
+        maximum number of samples read at once
+    out_files: list, default None,
+        one .npy file per channel where signals are written, when None they are kept in memory
+
+    Returns
+    ------------
+
+    The list of signals (one 1D array per channel), the sampling frequency, the units of the channels and the SignalQualityReport
+    """
+
+    header = rdheader(seg_id, database_name, record_dir, local_dir)
+    units = [header.units[header.sig_name.index(channel)] for channel in channel_names]
+
+    if out_files is None:
+        signals = [np.empty(header.sig_len) for _ in channel_names]
+    else:
+        signals = [np.lib.format.open_memmap(out_file, mode='w+', dtype=np.float64, shape=(header.sig_len,)) for out_file in out_files]
+
+    report = SignalQualityReport(len(channel_names))
+    for sampfrom, chunk in iter_record_chunks(seg_id, database_name, record_dir, local_dir, list(channel_names), chunk_size, header.sig_len):
+        for signal, column in zip(signals, chunk.T):
+            signal[sampfrom : sampfrom + len(chunk)] = column
+        report.update(chunk)
+
+    # The channels are interleaved in the signal file, all of them are transferred
+    add_bytes('fetched', signal_file_bytes(header))
+
+    return signals, header.fs, units, report
+
+
+# Units of the ABP and PLETH channels of MIMIC-III, the .npy files of the records directory do not keep them
+DEFAULT_UNITS = ('mmHg', 'NU')
+
+
+def read_local_segment(segment_id : str, records_dir : Optional[str] = None, store : Optional[SegmentStore] = None, fs : float = 125.0):
+    r"""
+    Read the ABP and PLETH signals of a segment from the local output of the pipeline, as memory maps: from a SegmentStore
+    first, then from the parent_folder/patient_id/seg_id/{abp,ppg}.npy files of records_dir.
+
+    Parameters
+    ------------
+
+    segment_id: str,
+        the segment in the parent_folder/patient_id/seg_id format
+    records_dir: str, default None,
+        directory with the downloaded segments
+    store: SegmentStore, default None,
+        an open SegmentStore
+    fs: float, default 125.0,
+        the sampling frequency of the signals of records_dir, which is not kept in the .npy files (all MIMIC-III waveforms are at 125 Hz)
+
+    Returns
+    ------------
+
+    The ABP and PPG signals, the sampling frequency and the units of the two signals, or None when the segment is not found
+    """
+    if store is not None and segment_id in store:
+        segment_info = store.info(segment_id)
+        units = segment_info['units'] or [''] * len(segment_info['channels'])
+        return store.read_channel(segment_id, 'ABP'), store.read_channel(segment_id, 'PLETH'), segment_info['fs'], (units[segment_info['channels'].index('ABP')], units[segment_info['channels'].index('PLETH')])
+
+    segment_path = os.path.join(records_dir, segment_id) if records_dir is not None else None
+    if segment_path is not None and os.path.exists(os.path.join(segment_path, 'abp.npy')):
+        return np.load(os.path.join(segment_path, 'abp.npy'), mmap_mode='r'), np.load(os.path.join(segment_path, 'ppg.npy'), mmap_mode='r'), fs, DEFAULT_UNITS
+
+    return None
+
+
+@instrumented('download', counter='segments')
+def save_records_worker_function(database_name : str, valid_segment_path : str, output_dir : str, valid_bp_ranges : dict, thresholds : dict, windowing_param : dict, local_dir : Optional[str] = None, store_dir : Optional[str] = None, journal_path : Optional[str] = None, features_path : Optional[str] = None) -> None:
     r"""
     A thead wil spawn executing the code of this function, that is 
     downloading, performing intial preprocessing, and storing of the signals.
@@ -179,6 +593,14 @@ def save_records_worker_function(database_name : str, valid_segment_path : str,
         contains the permitted % of anomalies in the signals (NaNs and flat parts)
     windowing_param: dict,
         contains parameters tos etup the sliding window (length in seconds and overlap)
+    local_dir: str, default None,
+        root directory of a local mirror of the database, when None PhysioNet is queried
+    store_dir: str, default None,
+        directory of a SegmentStore where valid segments are appended, when None they are saved as .npy files in output_dir
+    journal_path: str, default None,
+        location of the SQLite event journal (see event_journal.py) where the outcome of every step is recorded
+    features_path: str, default None,
+        location of the SQLite feature table (see feature_table.py) where the quality features of the segment are kept
     
     Returns
     ------------
@@ -186,107 +608,306 @@ def save_records_worker_function(database_name : str, valid_segment_path : str,
     """
     print(f'Processing {valid_segment_path[:-1]}', flush=True)
 
+    # The events of a segment are written together at the end, except the start that marks segments in progress
+    with EventJournal(journal_path) as journal:
+        journal.log(valid_segment_path.strip(), 'fetch', 'started', flush=True)
+
+        start = time.time()
+        try:
+            with step('download.fetch'):
+                segment_id, scratch_path, fs, units, report = fetch_segment(database_name, valid_segment_path, output_dir, local_dir)
+        except Exception as e:
+            journal.log(valid_segment_path.strip(), 'fetch', 'failed', reason=repr(e), started_at=start, duration=time.time() - start)
+            raise
+        journal.log(segment_id, 'fetch', 'done', metrics={'fs': fs, 'n_samples': report.n_samples}, started_at=start, duration=time.time() - start)
+
+        # The scratch directory of a segment that fails from now on is removed, not to pile up partial signals
+        stage = 'qc'
+        try:
+            start = time.time()
+            with step('download.check'):
+                status, metrics = check_segment(scratch_path, fs, report, valid_bp_ranges, thresholds, windowing_param, segment_id, features_path)
+            journal.log(segment_id, 'qc', 'passed' if status == 'valid' else 'discarded', reason=None if status == 'valid' else status, metrics=metrics, started_at=start, duration=time.time() - start)
+
+            stage, start = 'write', time.time()
+            with step('download.write'):
+                store_checked_segment(segment_id, scratch_path, status, output_dir, fs, units, store_dir)
+        except Exception as e:
+            rmtree(scratch_path, ignore_errors=True)
+            journal.log(segment_id, stage, 'failed', reason=repr(e), started_at=start, duration=time.time() - start)
+            raise
+        if status == 'valid':
+            journal.log(segment_id, 'write', 'saved', reason=store_dir, started_at=start, duration=time.time() - start)
+
+
+def fetch_segment(database_name : str, valid_segment_path : str, output_dir : str, local_dir : Optional[str] = None):
+    r"""
+    First step of save_records_worker_function: the ABP and PLETH channels of a segment are read, chunk by chunk,
+    in a scratch directory next to the segment output directory, and NaNs, flats and gaps are computed meanwhile.
+
+    Parameters
+    ------------
+
+    database_name: str,
+        the name of the dataset, it will be used to build the file path
+    valid_segment_path: str,
+        path identifying the subject's segment inside the dataset
+    output_dir: str,
+        the root directory where to save the signals
+    local_dir: str, default None,
+        root directory of a local mirror of the database, when None PhysioNet is queried
+
+    Returns
+    ------------
+
+    The segment id (parent_folder/patient_id/seg_id), the scratch directory with abp.npy and ppg.npy, the sampling frequency,
+    the units of the signals and their SignalQualityReport
+    """
+
     # Retrieve segment information from the txt file line
     parent_folder, patient_id, seg_id = valid_segment_path.split('/')
     seg_id = seg_id.strip() # remove the initial/endline whitespaces
 
-    record_data = wfdb.rdrecord(record_name=seg_id, pn_dir=f'{database_name}/{parent_folder}/{patient_id}')
+    # Signals are written in a scratch directory while they are read, it becomes the output directory if the segment is valid
+    scratch_path = Path(os.path.join(f'{output_dir}/{parent_folder}/{patient_id}/{seg_id}.part'))
+    if scratch_path.exists():
+        rmtree(scratch_path)
+    os.makedirs(scratch_path)
 
     # Note: we are sure that segments have ABP or PLETH thanks to the data provisioning step
-    abp_idx = record_data.sig_name.index('ABP')
-    ppg_idx = record_data.sig_name.index('PLETH')
+    try:
+        signals, fs, units, report = read_segment_signals(seg_id, database_name, f'{parent_folder}/{patient_id}/', local_dir, out_files=[os.path.join(scratch_path, 'abp.npy'), os.path.join(scratch_path, 'ppg.npy')])
+        for signal in signals:
+            signal.flush()
+    except BaseException:
+        rmtree(scratch_path, ignore_errors=True)
+        raise
+
+    return f'{parent_folder}/{patient_id}/{seg_id}', scratch_path, fs, units, report
+
+
+def _windowed_fraction(indicator : np.array, win_start : np.array, win_stop : np.array) -> np.array:
+    # Fraction of True samples of every window, from a cumulative sum
+    counts = np.concatenate(([0], np.cumsum(indicator)))
+    return (counts[win_stop] - counts[win_start]) / np.maximum(win_stop - win_start, 1)
+
+
+def compute_segment_features(abp : np.array, ppg : np.array, fs : float, report : SignalQualityReport, windowing_param : dict, delta : float = 1e-5, window_len : int = 3) -> dict:
+    r"""
+    All the quality features the checks of the download use, computed without stopping at the first failed check,
+    so that they can be kept in a FeatureTable (see feature_table.py) and filtered later with other thresholds.
+    NaNs are interpolated in place (channels with less than two valid samples are left as they are).
+
+    Parameters
+    ------------
+
+    abp: np.array,
+        the ABP signal, modified in place
+    ppg: np.array,
+        the PPG signal, modified in place
+    fs: float,
+        the sampling frequency
+    report: SignalQualityReport,
+        the report of the ABP and PLETH signals before the interpolation
+    windowing_param: dict,
+        contains parameters tos etup the sliding window (length in seconds and overlap)
+    delta: float, default 1e-5,
+        the threshold of flat_lines_detection
+    window_len: int, default 3,
+        the distance of the compared values of flat_lines_detection
+
+    Returns
+    ------------
+
+    A dictionary with the columns of the feature table
+    """
+    n_samples = len(abp)
+    win_start, win_stop = create_windows(windowing_param['win_len'], fs, n_samples, windowing_param['win_overlap'])
+    win_start, win_stop = np.asarray(win_start, dtype=int), np.asarray(win_stop, dtype=int)
+
+    signals = [abp, ppg]
+    window_nan_fraction = np.stack([_windowed_fraction(np.isnan(signal), win_start, win_stop) for signal in signals])
+
+    # Interpolate to remove nan
+    for c, signal in enumerate(signals):
+        if n_samples - report.nan_count[c] >= 2:
+            interpolate_nan_pchip(signal)
+    report.refresh_after_interpolation(signals)
+
+    window_flat_fraction = np.stack([_windowed_fraction(np.concatenate((np.zeros(window_len, dtype=bool), np.abs(signal[window_len:] - signal[:-window_len]) < delta)), win_start, win_stop) for signal in signals])
+
+    # Sliding window over the signal: it prevents to remove signals with small amount of missing data 
+    if n_samples - report.nan_count[0] >= 2:
+        SBP, DBP = estimate_windowed_bp(abp, win_start, win_stop)
+    else:
+        SBP, DBP = np.full(len(win_start), np.nan), np.full(len(win_start), np.nan)
+
+    return {
+        'fs': fs, 'n_samples': n_samples, 'win_len': windowing_param['win_len'], 'win_overlap': windowing_param['win_overlap'],
+        'abp_nan_fraction': report.nan_fraction[0], 'ppg_nan_fraction': report.nan_fraction[1],
+        'abp_flat_fraction': report.flat_fraction[0], 'ppg_flat_fraction': report.flat_fraction[1],
+        'abp_min': report.minimum[0], 'abp_max': report.maximum[0],
+        # Calculate the overall DBP and SBP for the whole signal
+        'sbp': SBP.mean() if len(SBP) > 0 else np.nan, 'dbp': DBP.mean() if len(DBP) > 0 else np.nan,
+        'window_sbp': SBP, 'window_dbp': DBP, 'window_nan_fraction': window_nan_fraction, 'window_flat_fraction': window_flat_fraction,
+    }
+
+
+def check_segment(scratch_path : str, fs : float, report : SignalQualityReport, valid_bp_ranges : dict, thresholds : dict, windowing_param : dict, segment_id : Optional[str] = None, features_path : Optional[str] = None) -> Tuple[str, dict]:
+    r"""
+    Second step of save_records_worker_function: the quality checks of a segment in a scratch directory.
+    NaNs are interpolated in place, then flat parts and the average SBP/DBP of the sliding windows are checked.
+
+    When features_path is given, all the features are computed even when a check fails, and they are added to
+    the FeatureTable at features_path (see feature_table.py), so that the checks can be applied again later.
+
+    Parameters
+    ------------
+
+    scratch_path: str,
+        the directory with abp.npy and ppg.npy written by fetch_segment
+    fs: float,
+        the sampling frequency
+    report: SignalQualityReport,
+        the report of the ABP and PLETH signals computed while they were read
+    valid_bp_ranges: dict,
+        the upper and lower valid values for systolic and diastolic blood pressure
+    thresholds: dict,
+        contains the permitted % of anomalies in the signals (NaNs and flat parts)
+    windowing_param: dict,
+        contains parameters tos etup the sliding window (length in seconds and overlap)
+    segment_id: str, default None,
+        the segment in the parent_folder/patient_id/seg_id format, required with features_path
+    features_path: str, default None,
+        location of the SQLite feature table
+
+    Returns
+    ------------
+
+    'valid', or the reason why the segment is discarded ('nans', 'flat' or 'abp'), and the quality metrics computed so far
+    """
 
-    abp = record_data.p_signal[:, abp_idx]
-    ppg = record_data.p_signal[:, ppg_idx]
-    fs = record_data.fs
+    if features_path is not None:
+        abp = np.load(os.path.join(scratch_path, 'abp.npy'), mmap_mode='r+')
+        ppg = np.load(os.path.join(scratch_path, 'ppg.npy'), mmap_mode='r+')
+        with step('download.check.features'):
+            features = compute_segment_features(abp, ppg, fs, report, windowing_param)
+        abp.flush()
+        ppg.flush()
+
+        with FeatureTable(features_path) as table:
+            table.add(segment_id, features)
+
+        metrics = report.metrics(['abp', 'ppg'])
+        metrics.update({'sbp': float(features['sbp']), 'dbp': float(features['dbp'])})
+        status = qc_status(features['abp_nan_fraction'], features['ppg_nan_fraction'], features['abp_flat_fraction'], features['ppg_flat_fraction'], features['sbp'], features['dbp'], valid_bp_ranges, thresholds)
+        return str(status), metrics
 
     # Do not save signals with more then 5% of NaNs
-    if nans_percentage(abp) <= thresholds['nans_th'] and nans_percentage(ppg) < thresholds['nans_th']:
-        
-        # Interpolate to remove nan
-        abp = interpolate_nan_pchip(abp)
-        ppg = interpolate_nan_pchip(ppg)
-     
-        # Do not save signals with more then 5% of flats
-        abp_per_flat = len(np.where(flat_lines_detection(abp))[0]) / len(abp)
-        ppg_per_flat = len(np.where(flat_lines_detection(ppg))[0]) / len(ppg)
-
-        if abp_per_flat <= thresholds['flat_th'] and ppg_per_flat < thresholds['flat_th']:
-
-            n_samples = len(abp)
-            win_start, win_stop = create_windows(windowing_param['win_len'], fs, n_samples, windowing_param['win_overlap'])
-            n_win = len(win_start)
-            
-            SBP = []
-            DBP = []
-            
-            # Sliding window over the signal: it prevents to remove signals with small amount of missing data 
-            for j in range(0, n_win):
-                idx_start = win_start[j]
-                idx_stop = win_stop[j]
-
-                sig = abp[idx_start : idx_stop]
-                
-                try:
-                    # Interp to remove nan: can raise an exception if the window is completely empty
-                    sig = interpolate_nan_pchip(sig)
-
-                    # scipy.signal.find_peaks return a pair with idxs on the first element
-                    peaks = find_peaks(sig)[0]
-                    valleys = find_peaks(-sig)[0]
-
-                    # Check in case there signal is basically flat in the window
-                    if len(peaks) == 0 or len(valleys) == 0:
-                        # Set an invalid BP value
-                        sbp = 0.0
-                        dbp = 0.0
-                    else:
-                        # Calculate the actual SBP and DBP
-                        sbp = np.mean(sig[peaks])
-                        dbp = np.mean(sig[valleys])
-
-                    SBP.append(sbp)
-                    DBP.append(dbp)
-
-                except: 
-                    SBP.append(0.0)
-                    DBP.append(0.0)        
-
-            # Calculate the overall DBP and SBP for the whole signal
-            SBP = np.array(SBP).mean()
-            DBP = np.array(DBP).mean()
-
-            # Do not save signals with abnormal BP values
-            if SBP >= valid_bp_ranges['low_sbp'] and SBP <= valid_bp_ranges['up_sbp'] and DBP >= valid_bp_ranges['low_dbp'] and DBP <= valid_bp_ranges['up_dbp']:
-                
-                # Save valid segments
-                output_path = Path(os.path.join(f'{output_dir}/{parent_folder}/{patient_id}/{seg_id}'))
-
-                if output_path.exists():
-                    rmtree(output_path)
-                os.makedirs(output_path)
-
-                np.save(os.path.join(output_path, 'abp'), abp)
-                np.save(os.path.join(output_path, 'ppg'), ppg)
-                print(f'Saved {output_path}', flush=True)
-            
-            else:
-                print(f'ABP with invalid ranges for {valid_segment_path[:-1]} ...')    
-        
+    if not (report.nan_fraction[0] <= thresholds['nans_th'] and report.nan_fraction[1] < thresholds['nans_th']):
+        return 'nans', report.metrics(['abp', 'ppg'])
+
+    # Interpolate to remove nan, in place in the scratch directory
+    with step('download.check.interpolate'):
+        abp = interpolate_nan_pchip(np.load(os.path.join(scratch_path, 'abp.npy'), mmap_mode='r+'))
+        ppg = interpolate_nan_pchip(np.load(os.path.join(scratch_path, 'ppg.npy'), mmap_mode='r+'))
+        abp.flush()
+        ppg.flush()
+
+    # Do not save signals with more then 5% of flats, only the interpolated parts are checked again
+    with step('download.check.flat'):
+        report.refresh_after_interpolation([abp, ppg])
+
+    if not (report.flat_fraction[0] <= thresholds['flat_th'] and report.flat_fraction[1] < thresholds['flat_th']):
+        return 'flat', report.metrics(['abp', 'ppg'])
+
+    n_samples = len(abp)
+    win_start, win_stop = create_windows(windowing_param['win_len'], fs, n_samples, windowing_param['win_overlap'])
+
+    # Sliding window over the signal: it prevents to remove signals with small amount of missing data 
+    with step('download.check.windowed_bp'):
+        SBP, DBP = estimate_windowed_bp(abp, win_start, win_stop)
+
+    # Calculate the overall DBP and SBP for the whole signal
+    SBP = SBP.mean()
+    DBP = DBP.mean()
+
+    # Do not save signals with abnormal BP values
+    metrics = report.metrics(['abp', 'ppg'])
+    metrics.update({'sbp': float(SBP), 'dbp': float(DBP)})
+    if not (SBP >= valid_bp_ranges['low_sbp'] and SBP <= valid_bp_ranges['up_sbp'] and DBP >= valid_bp_ranges['low_dbp'] and DBP <= valid_bp_ranges['up_dbp']):
+        return 'abp', metrics
+
+    return 'valid', metrics
+
+
+def store_checked_segment(segment_id : str, scratch_path : str, status : str, output_dir : str, fs : float, units : List[str], store_dir : Optional[str] = None) -> None:
+    r"""
+    Last step of save_records_worker_function: a valid segment is moved from the scratch directory to its
+    output directory (or appended to a SegmentStore), the scratch directory of the others is removed.
+
+    Parameters
+    ------------
+
+    segment_id: str,
+        the segment in the parent_folder/patient_id/seg_id format
+    scratch_path: str,
+        the directory with abp.npy and ppg.npy written by fetch_segment
+    status: str,
+        the result of check_segment
+    output_dir: str,
+        the root directory where to save the signals
+    fs: float,
+        the sampling frequency
+    units: list,
+        the units of the ABP and PLETH signals
+    store_dir: str, default None,
+        directory of a SegmentStore where valid segments are appended, when None they are saved as .npy files in output_dir
+
+    Returns
+    ------------
+    None
+    """
+
+    if status == 'valid':
+        add_bytes('written', sum(os.path.getsize(os.path.join(scratch_path, name)) for name in ['abp.npy', 'ppg.npy']))
+        if store_dir is not None:
+            with SegmentStore(store_dir) as store:
+                store.append(segment_id, [np.load(os.path.join(scratch_path, 'abp.npy'), mmap_mode='r'), np.load(os.path.join(scratch_path, 'ppg.npy'), mmap_mode='r')], fs, ['ABP', 'PLETH'], units)
+            print(f'Saved {segment_id} in {store_dir}', flush=True)
         else:
-            print(f'Too many flat parts for {valid_segment_path[:-1]} ...')
-        
+            output_path = Path(os.path.join(output_dir, segment_id))
+            if output_path.exists():
+                rmtree(output_path)
+            os.replace(scratch_path, output_path)
+            print(f'Saved {output_path}', flush=True)
+
+    elif status == 'abp':
+        print(f'ABP with invalid ranges for {segment_id} ...')
+    elif status == 'flat':
+        print(f'Too many flat parts for {segment_id} ...')
     else:
-        print(f'Too many NaNs for {valid_segment_path[:-1]} ...')
+        print(f'Too many NaNs for {segment_id} ...')
+
+    # Discarded segments
+    if os.path.exists(scratch_path):
+        rmtree(scratch_path)
 
         
 
-def download_mimic_iii_records(valid_segments_file_path, output_dir, valid_BP_ranges, thresholds, windowing_param, n_cores : int = 1) -> None:
+def download_mimic_iii_records(valid_segments_file_path, output_dir, valid_BP_ranges, thresholds, windowing_param, n_cores : int = 1, async_mirror_dir : Optional[str] = None, prefetch_batch : int = 512, max_in_flight : int = 256, keep_mirror : bool = False, store_dir : Optional[str] = None, journal_path : Optional[str] = None, features_path : Optional[str] = None, shard : Optional[Tuple[int, int]] = None, durations : Optional[Dict[str, float]] = None, local_dir : Optional[str] = None) -> None:
     r"""
     This function downloads the valid segments containing the required signals and with the specified minimum length.
     After the downloads, signals are processed to look for NaNs, flat lines, and valid BP ranges. 
     If a signal pass the checks, then it is stored locally.
 
+    Segments are handed to the workers longest first, the shortest packed together (see scheduling.py), so that a few
+    long segments do not run alone at the end; makespan and worker utilisation are printed at the end of every run.
+
+    When async_mirror_dir is provided, segments are fetched asynchronously in batches of prefetch_batch records
+    (see async_fetch.py), with many requests in flight over a pool of keep-alive connections, and the
+    workers read them from the local mirror instead of opening their own connections.
+
     Parameters
     ------------
 
@@ -302,7 +923,30 @@ def download_mimic_iii_records(valid_segments_file_path, output_dir, valid_BP_ra
         contains parameters tos etup the sliding window (length in seconds and overlap)
     n_cores: int, default 1,
         number of parallel cores to use
-    
+    async_mirror_dir: str, default None,
+        directory where records are fetched asynchronously before being processed
+    prefetch_batch: int, default 512,
+        number of records fetched before being handed to the workers
+    max_in_flight: int, default 256,
+        maximum number of concurrent requests of the asynchronous fetch
+    keep_mirror: bool, default False,
+        whether to keep the fetched records in async_mirror_dir once processed
+    store_dir: str, default None,
+        directory of a SegmentStore (see segment_store.py) where valid segments are appended instead of
+        creating a directory with two .npy files for each of them
+    journal_path: str, default None,
+        location of the SQLite event journal (see event_journal.py) where the outcome of every segment is recorded
+    features_path: str, default None,
+        location of the SQLite feature table (see feature_table.py) where the quality features of every segment,
+        accepted or rejected, are kept: other thresholds can then be applied with feature_table.filter_segments
+    shard: tuple, default None,
+        (i, N) to process only the patients of the i-th of N shards (see sharding.py)
+    durations: dict, default None,
+        duration of the segments (e.g. SegmentCatalog.durations, from the header index), the segments not in it count as
+        the median duration, when None they keep the order of the file
+    local_dir: str, default None,
+        root directory of a local mirror of the database, read by the workers instead of PhysioNet (async_mirror_dir is then not used)
+
     Returns
     ------------
     None
@@ -323,11 +967,140 @@ def download_mimic_iii_records(valid_segments_file_path, output_dir, valid_BP_ra
         # First line is the database name
         database_name = lines[0].strip() # remove the endline \n char
         
+        # Next lines are all structured as parent_directory/patient_id/segments
+        segments = [segment for segment in lines[1:] if in_shard(segment, shard)]
+
+    costs = segment_costs(segments, durations)
+
+    if async_mirror_dir is None or local_dir is not None:
         # Loop through the valid segments
-        Parallel(n_jobs=used_cores)(delayed(save_records_worker_function)(database_name, lines[i], output_dir, valid_BP_ranges, thresholds, windowing_param) for i in range(len(lines))) 
+        run_scheduled(Parallel(n_jobs=used_cores), save_records_worker_function, [(database_name, segment, output_dir, valid_BP_ranges, thresholds, windowing_param) for segment in segments], costs,
+                      kwargs={'local_dir': local_dir, 'store_dir': store_dir, 'journal_path': journal_path, 'features_path': features_path}, name='download')
+        return
+
+    # Longest first also across the prefetch batches
+    order = sorted(range(len(segments)), key=lambda i: -costs[i])
+    segments, costs = [segments[i] for i in order], [costs[i] for i in order]
+
+    # The same pool of workers processes a batch while it has been fetched
+    with Parallel(n_jobs=used_cores) as parallel:
+        for batch_start in range(0, len(segments), prefetch_batch):
+            batch = segments[batch_start : batch_start + prefetch_batch]
+            local_paths = fetch_records(database_name, batch, async_mirror_dir, max_in_flight=max_in_flight)
+
+            for segment, local_path in local_paths.items():
+                if local_path is None:
+                    print(f'No file found for {database_name}/{segment}', flush=True)
+
+            fetched = [i for i, segment in enumerate(batch) if local_paths[segment.strip()] is not None]
+            run_scheduled(parallel, save_records_worker_function, [(database_name, batch[i], output_dir, valid_BP_ranges, thresholds, windowing_param, async_mirror_dir, store_dir, journal_path, features_path) for i in fetched],
+                          [costs[batch_start + i] for i in fetched], name='download')
+
+            if not keep_mirror:
+                for local_path in local_paths.values():
+                    if local_path is not None:
+                        for record_file in glob.glob(f'{local_path}.*'):
+                            os.remove(record_file) 
+
+
+@instrumented('features', counter='segments')
+def features_worker_function(database_name : str, valid_segment_path : str, output_dir : str, windowing_param : dict, features_path : str, local_dir : Optional[str] = None) -> None:
+    r"""
+    Read a segment and add its quality features to the FeatureTable at features_path, without applying any check
+    and without saving the signals. Segments already in the table are skipped.
+
+    Parameters
+    ------------
+
+    database_name: str,
+        the name of the dataset, it will be used to build the file path
+    valid_segment_path: str,
+        path identifying the subject's segment inside the dataset
+    output_dir: str,
+        the root directory of the scratch directories
+    windowing_param: dict,
+        contains parameters tos etup the sliding window (length in seconds and overlap)
+    features_path: str,
+        location of the SQLite feature table
+    local_dir: str, default None,
+        root directory of a local mirror of the database, when None PhysioNet is queried
+
+    Returns
+    ------------
+    None
+    """
+    with FeatureTable(features_path) as table:
+        if valid_segment_path.strip() in table:
+            return
+
+    print(f'Processing {valid_segment_path[:-1]}', flush=True)
+
+    segment_id, scratch_path, fs, _, report = fetch_segment(database_name, valid_segment_path, output_dir, local_dir)
+    try:
+        abp = np.load(os.path.join(scratch_path, 'abp.npy'), mmap_mode='r+')
+        ppg = np.load(os.path.join(scratch_path, 'ppg.npy'), mmap_mode='r+')
+        features = compute_segment_features(abp, ppg, fs, report, windowing_param)
+        del abp, ppg
+    finally:
+        rmtree(scratch_path)
+
+    with FeatureTable(features_path) as table:
+        table.add(segment_id, features)
+
+
+def build_feature_table(valid_segments_file_path : str, output_dir : str, windowing_param : dict, features_path : str, n_cores : int = 1, local_dir : Optional[str] = None, shard : Optional[Tuple[int, int]] = None) -> str:
+    r"""
+    One pass over the signals of the valid segments that only fills the feature table, so that many thresholds and
+    BP ranges can be evaluated on it (see feature_table.sweep_thresholds) before downloading anything. It can be
+    interrupted and started again, segments already in the table are not read again.
+
+    Parameters
+    ------------
+
+    valid_segments_file_path: str,
+        the txt file with the database name as first line and the valid segments on the following ones
+    output_dir: str,
+        root directory of the scratch directories
+    windowing_param: dict,
+        contains parameters tos etup the sliding window (length in seconds and overlap)
+    features_path: str,
+        location of the SQLite feature table
+    n_cores: int, default 1,
+        number of parallel workers
+    local_dir: str, default None,
+        root directory of a local mirror of the database, when None PhysioNet is queried
+    shard: tuple, default None,
+        (i, N) to process only the patients of the i-th of N shards (see sharding.py)
 
+    Returns
+    ------------
+
+    The path of the feature table
+    """
+
+    output_dir = os.path.join(output_dir, 'records')
+    os.makedirs(output_dir, exist_ok=True)
+
+    with open(valid_segments_file_path, 'r') as seg_file:
+        lines = seg_file.readlines()
 
-def preprocess_records_worker_function(segment_path : str, valid_bp_ranges : dict) -> None:
+        # First line is the database name
+        database_name = lines[0].strip()
+
+        # Next lines are all structured as parent_directory/patient_id/segments
+        segments = [segment for segment in lines[1:] if in_shard(segment, shard)]
+
+    # The schema is created once, before the workers open the table
+    FeatureTable(features_path).close()
+
+    print(f'Using {n_cores}/{multiprocessing.cpu_count()} cores')
+    Parallel(n_jobs=n_cores)(delayed(features_worker_function)(database_name, segment, output_dir, windowing_param, features_path, local_dir) for segment in segments)
+
+    return features_path
+
+
+@instrumented('preprocess', counter='segments')
+def preprocess_records_worker_function(segment_path : str, valid_bp_ranges : dict, journal_path : Optional[str] = None) -> None:
     r"""
     A thead wil spawn executing the code of this function, that is 
     interpolating, removing signals with uncceptable SBP/DBP, and storing of the signals.
@@ -339,46 +1112,215 @@ def preprocess_records_worker_function(segment_path : str, valid_bp_ranges : dic
         path identifying the subject's segment inside the dataset
     valid_bp_ranges: dict,
         the upper and lower valid values for systolic and diastolic blood pressure
+    journal_path: str, default None,
+        location of the SQLite event journal (see event_journal.py) where the outcome is recorded
     
     Returns
     ------------
     None
     """
     print(f'Processing {segment_path}', flush=True)
+    start = time.time()
 
     # Load the ABP numpy array
-    abp = np.load(os.path.join(segment_path, 'abp.npy'))
+    with step('preprocess.load'):
+        abp = np.load(os.path.join(segment_path, 'abp.npy'))
+        report = SignalQualityReport.from_signals([abp])
 
-    # Interpolate the whole signals
-    abp = interpolate_nan_pchip(abp)
+    # Interpolate the whole signals, min/max are updated only around the gaps
+    with step('preprocess.interpolate'):
+        abp = interpolate_nan_pchip(abp)
+        report.refresh_after_interpolation([abp])
 
-    SBP = abp.max()
-    DBP = abp.min()
+    SBP = report.maximum[0]
+    DBP = report.minimum[0]
 
     # Do not save signals where the SBP/DBP is not in range even after interpolation
     if SBP >= valid_bp_ranges['low_sbp'] and SBP <= valid_bp_ranges['up_sbp'] and DBP >= valid_bp_ranges['low_dbp'] and DBP <= valid_bp_ranges['up_dbp']:
         
         # Valid segments, interpolate also the ppg and save the signals 
-        ppg = np.load(os.path.join(segment_path, 'ppg.npy'))
-        ppg = interpolate_nan_pchip(ppg)
-
-        # Remove old ones
-        rmtree(segment_path)
-        os.makedirs(segment_path)
-
-        # Allocate new ones
-        np.save(os.path.join(segment_path, 'abp'), abp)
-        np.save(os.path.join(segment_path, 'ppg'), ppg)
+        with step('preprocess.interpolate'):
+            ppg = np.load(os.path.join(segment_path, 'ppg.npy'))
+            ppg = interpolate_nan_pchip(ppg)
+
+        with step('preprocess.write'):
+            # Remove old ones
+            rmtree(segment_path)
+            os.makedirs(segment_path)
+
+            # Allocate new ones
+            np.save(os.path.join(segment_path, 'abp'), abp)
+            np.save(os.path.join(segment_path, 'ppg'), ppg)
+        add_bytes('written', abp.nbytes + ppg.nbytes)
         print(f'Saved {segment_path}', flush=True)
+        outcome = 'saved'
 
     else:
 
         # Remove the segments folder
         rmtree(segment_path)
         print(f'Removed {segment_path}', flush=True)
+        outcome = 'removed'
+
+    with EventJournal(journal_path) as journal:
+        journal.log('/'.join(Path(segment_path).parts[-3:]), 'preprocess', outcome, reason='abp' if outcome == 'removed' else None, metrics=report.metrics(['abp']), started_at=start, duration=time.time() - start)
         
 
-def preprocess_mimic_iii_records(downloaded_segments_path, valid_BP_ranges, n_cores : int = 1) -> None:
+@instrumented('preprocess', counter='segments')
+def preprocess_store_worker_function(store_dir : str, segment_id : str, valid_bp_ranges : dict, journal_path : Optional[str] = None) -> None:
+    r"""
+    Same of preprocess_records_worker_function for a segment of a SegmentStore: signals are interpolated in place
+    inside the data file, and segments with uncceptable SBP/DBP are removed from the store.
+
+    Parameters
+    ------------
+
+    store_dir: str,
+        directory of the SegmentStore
+    segment_id: str,
+        the segment in the parent_folder/patient_id/seg_id format
+    valid_bp_ranges: dict,
+        the upper and lower valid values for systolic and diastolic blood pressure
+    journal_path: str, default None,
+        location of the SQLite event journal (see event_journal.py) where the outcome is recorded
+    
+    Returns
+    ------------
+    None
+    """
+    print(f'Processing {segment_id}', flush=True)
+    start = time.time()
+
+    with SegmentStore(store_dir) as store, EventJournal(journal_path) as journal:
+        with step('preprocess.load'):
+            abp = store.read_channel(segment_id, 'ABP', mode='r+')
+            report = SignalQualityReport.from_signals([abp])
+
+        # Interpolate the whole signals, min/max are updated only around the gaps
+        with step('preprocess.interpolate'):
+            abp = interpolate_nan_pchip(abp)
+            report.refresh_after_interpolation([abp])
+
+        SBP = report.maximum[0]
+        DBP = report.minimum[0]
+
+        # Do not keep signals where the SBP/DBP is not in range even after interpolation
+        if SBP >= valid_bp_ranges['low_sbp'] and SBP <= valid_bp_ranges['up_sbp'] and DBP >= valid_bp_ranges['low_dbp'] and DBP <= valid_bp_ranges['up_dbp']:
+
+            # Valid segments, interpolate also the ppg
+            with step('preprocess.interpolate'):
+                ppg = store.read_channel(segment_id, 'PLETH', mode='r+')
+                interpolate_nan_pchip(ppg)
+            with step('preprocess.write'):
+                abp.flush()
+                ppg.flush()
+            add_bytes('written', abp.nbytes + ppg.nbytes)
+            print(f'Saved {segment_id}', flush=True)
+            journal.log(segment_id, 'preprocess', 'saved', metrics=report.metrics(['abp']), started_at=start, duration=time.time() - start)
+
+        else:
+            store.remove(segment_id)
+            print(f'Removed {segment_id}', flush=True)
+            journal.log(segment_id, 'preprocess', 'removed', reason='abp', metrics=report.metrics(['abp']), started_at=start, duration=time.time() - start)
+
+
+def list_zip_segments(zip_file_path : str) -> List[Tuple[str, str, str]]:
+    r"""
+    List the segments inside a pXX.zip archive of downloaded records, without extracting it.
+
+    Parameters
+    ------------
+
+    zip_file_path: str,
+        the archive, with members in the parent_folder/patient_id/seg_id/abp.npy (and ppg.npy) format
+
+    Returns
+    ------------
+
+    A list of (segment_id, abp member, ppg member), segments missing one of the two signals are skipped
+    """
+    with zipfile.ZipFile(zip_file_path, 'r') as zip_ref:
+        members = set(zip_ref.namelist())
+
+    segments = []
+    for member in sorted(members):
+        if member.endswith('/abp.npy'):
+            segment_dir = member[:-len('abp.npy')]
+            if f'{segment_dir}ppg.npy' in members:
+                segments.append(('/'.join(segment_dir.split('/')[-4:-1]), member, f'{segment_dir}ppg.npy'))
+            else:
+                print(f'No ppg.npy for {segment_dir} in {zip_file_path}', flush=True)
+
+    return segments
+
+
+@instrumented('preprocess')
+def preprocess_zip_worker_function(zip_file_path : str, segments : List[Tuple[str, str, str]], store_dir : str, valid_bp_ranges : dict, fs : float = 125.0, journal_path : Optional[str] = None) -> None:
+    r"""
+    A thead wil spawn executing the code of this function, that is the same of preprocess_records_worker_function
+    for a batch of segments read straight from a pXX.zip archive: the .npy members are loaded in memory, and only
+    the segments with acceptable SBP/DBP are written, in a SegmentStore. The archive is opened once per batch.
+
+    Parameters
+    ------------
+
+    zip_file_path: str,
+        the archive with the downloaded segments
+    segments: list,
+        the (segment_id, abp member, ppg member) to process, as returned by list_zip_segments
+    store_dir: str,
+        directory of the SegmentStore where valid segments are appended
+    valid_bp_ranges: dict,
+        the upper and lower valid values for systolic and diastolic blood pressure
+    fs: float, default 125.0,
+        the sampling frequency of the signals, which is not kept in the .npy files (all MIMIC-III waveforms are at 125 Hz)
+    journal_path: str, default None,
+        location of the SQLite event journal (see event_journal.py) where the outcomes are recorded, once per batch
+    
+    Returns
+    ------------
+    None
+    """
+    with zipfile.ZipFile(zip_file_path, 'r') as zip_ref, SegmentStore(store_dir) as store, EventJournal(journal_path, batch_size=len(segments) + 1) as journal:
+        for segment_id, abp_member, ppg_member in segments:
+
+            # Segments already in the store come from a previous execution
+            if segment_id in store:
+                continue
+            print(f'Processing {segment_id}', flush=True)
+            start = time.time()
+
+            with step('preprocess.load'):
+                abp = np.load(io.BytesIO(zip_ref.read(abp_member)))
+                report = SignalQualityReport.from_signals([abp])
+
+            # Interpolate the whole signals, min/max are updated only around the gaps
+            with step('preprocess.interpolate'):
+                abp = interpolate_nan_pchip(abp)
+                report.refresh_after_interpolation([abp])
+            count('segments')
+
+            SBP = report.maximum[0]
+            DBP = report.minimum[0]
+
+            # Do not save signals where the SBP/DBP is not in range even after interpolation
+            if SBP >= valid_bp_ranges['low_sbp'] and SBP <= valid_bp_ranges['up_sbp'] and DBP >= valid_bp_ranges['low_dbp'] and DBP <= valid_bp_ranges['up_dbp']:
+
+                # Valid segments, interpolate also the ppg and save the signals 
+                with step('preprocess.interpolate'):
+                    ppg = interpolate_nan_pchip(np.load(io.BytesIO(zip_ref.read(ppg_member))))
+                with step('preprocess.write'):
+                    store.append(segment_id, [abp, ppg], fs, ['ABP', 'PLETH'])
+                add_bytes('written', abp.nbytes + ppg.nbytes)
+                print(f'Saved {segment_id} in {store_dir}', flush=True)
+                journal.log(segment_id, 'preprocess', 'saved', metrics=report.metrics(['abp']), started_at=start, duration=time.time() - start)
+
+            else:
+                print(f'Removed {segment_id}', flush=True)
+                journal.log(segment_id, 'preprocess', 'removed', reason='abp', metrics=report.metrics(['abp']), started_at=start, duration=time.time() - start)
+
+
+def preprocess_mimic_iii_records(downloaded_segments_path, valid_BP_ranges, n_cores : int = 1, store_dir : Optional[str] = None, from_zip : bool = False, zip_batch : int = 64, journal_path : Optional[str] = None, shard : Optional[Tuple[int, int]] = None) -> None:
     r"""
     This function downloads the valid segments containing the required signals and with the specified minimum length.
     After the downloads, signals are processed to look for NaNs, flat lines, and valid BP ranges. 
@@ -399,12 +1341,55 @@ def preprocess_mimic_iii_records(downloaded_segments_path, valid_BP_ranges, n_co
         contains parameters tos etup the sliding window (length in seconds and overlap)
     n_cores: int, default 1,
         number of parallel cores to use
+    store_dir: str, default None,
+        directory of a SegmentStore filled by download_mimic_iii_records, when given its segments are preprocessed
+        in place (downloaded_segments_path is not used) and the space of the removed ones is reclaimed at the end
+    from_zip: bool, default False,
+        whether to read the segments straight from the p0*.zip archives in downloaded_segments_path, which are never
+        extracted: only the valid segments are written, in store_dir
+    zip_batch: int, default 64,
+        maximum number of segments of an archive processed by a worker with from_zip, the long segments are processed
+        first and alone, the short ones packed together (see scheduling.py)
+    journal_path: str, default None,
+        location of the SQLite event journal (see event_journal.py) where the outcome of every segment is recorded
+    shard: tuple, default None,
+        (i, N) to process only the patients of the i-th of N shards (see sharding.py)
 
     Returns
     ------------
     None
     """ 
     
+    if from_zip:
+        if store_dir is None:
+            raise ValueError('from_zip writes the valid segments in a segment store, store_dir is required')
+
+        print(f'Using {n_cores}/{multiprocessing.cpu_count()} cores')
+        with Parallel(n_jobs=n_cores) as parallel:
+            for zip_file_path in sorted(glob.glob(f'{downloaded_segments_path}/p0*.zip')):
+                segments = [segment for segment in list_zip_segments(zip_file_path) if in_shard(segment[0], shard)]
+                print(f'Streaming {len(segments)} segments from {zip_file_path} ...', flush=True)
+
+                # Batches of at most zip_batch segments, weighed by the size of their abp.npy members
+                sizes = zip_member_sizes(zip_file_path)
+                costs = [sizes[abp_member] for _, abp_member, _ in segments]
+                batches = plan_batches(costs, effective_n_jobs(n_cores), granularity=8, max_batch=zip_batch)
+                run_scheduled(parallel, preprocess_zip_worker_function, [(zip_file_path, [segments[i] for i in batch], store_dir, valid_BP_ranges) for batch in batches],
+                              [sum(costs[i] for i in batch) for batch in batches], kwargs={'journal_path': journal_path}, name='preprocess', pack=False)
+        return
+
+    if store_dir is not None:
+        with SegmentStore(store_dir) as store:
+            segment_ids = [segment_id for segment_id in store.segment_ids() if in_shard(segment_id, shard)]
+            costs = [store.info(segment_id)['length'] for segment_id in segment_ids]
+        print(f'Preprocessing {len(segment_ids)} segments of {store_dir} with {n_cores}/{multiprocessing.cpu_count()} cores')
+
+        run_scheduled(Parallel(n_jobs=n_cores), preprocess_store_worker_function, [(store_dir, segment_id, valid_BP_ranges, journal_path) for segment_id in segment_ids], costs, name='preprocess')
+
+        with SegmentStore(store_dir) as store:
+            store.compact()
+        return
+
     zip_file_paths = glob.glob(f'{downloaded_segments_path}/p0*.zip')
     
     # Parallel cores
@@ -426,10 +1411,11 @@ def preprocess_mimic_iii_records(downloaded_segments_path, valid_BP_ranges, n_co
             zip_ref.extractall(downloaded_segments_path)
         
         # Preprocess files int he new directory and remove the invalid ones
-        segments_dirs_path = glob.glob(f'{dest_dir}/*/*')
+        segments_dirs_path = [segment_path for segment_path in glob.glob(f'{dest_dir}/*/*') if in_shard('/'.join(Path(segment_path).parts[-3:]), shard)]
 
-        # Loop through the valid segments
-        Parallel(n_jobs=used_cores)(delayed(preprocess_records_worker_function)(segments_dirs_path[i], valid_BP_ranges) for i in range(len(segments_dirs_path))) 
+        # Loop through the valid segments, longest abp.npy first
+        costs = [npy_length(os.path.join(segment_path, 'abp.npy')) for segment_path in segments_dirs_path]
+        run_scheduled(Parallel(n_jobs=used_cores), preprocess_records_worker_function, [(segment_path, valid_BP_ranges, journal_path) for segment_path in segments_dirs_path], costs, name='preprocess')
         
     # Remove empty subfolders
     for dir_path, _, filenames in os.walk(downloaded_segments_path, topdown=False):
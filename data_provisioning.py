@@ -1,11 +1,20 @@
+import time
 from pathlib import Path
-import wfdb
 from joblib import Parallel, delayed
 import multiprocessing
-from typing import Optional
+from typing import List, Optional, Tuple
+from wfdb_source import get_record_list, rdheader
+from header_index import update_header_index, query_valid_segments
+from provisioning_engine import crawl_subjects, report_throughput
+from async_fetch import mirror_database_headers
+from crawl_journal import CrawlJournal
+from event_journal import EventJournal
+from sharding import in_shard
+from instrumentation import instrumented, step
 
 
-def worker_function(subject_file: str, database_name: str, subject: str, subject_id: str, required_signals: set, min_duration: int) -> Optional[Path]:
+@instrumented('provisioning', counter='headers')
+def worker_function(subject_file: str, database_name: str, subject: str, subject_id: str, required_signals: set, min_duration: int, local_dir: Optional[str] = None) -> Optional[Path]:
   r"""
   A thead wil spawn executing the code of this function, that consist in:
   - checking if a file of a subject contains waveform data
@@ -27,6 +36,8 @@ def worker_function(subject_file: str, database_name: str, subject: str, subject
     which signals (arterial blood pressure, photoplethysmography, etc.) to look for
   min_duration: int,
     minimum length of a valid segment
+  local_dir: str, default None,
+    root directory of a local mirror of database_name, when None PhysioNet is queried
 
   Returns
   ------------
@@ -39,7 +50,8 @@ def worker_function(subject_file: str, database_name: str, subject: str, subject
     try:
       # Query the dataset, this operation is slow due to connection
       # It can throw a 404, this is why it is in side a try-catch
-      segment_header = wfdb.rdheader(record_name=subject_file, pn_dir=f'{database_name}/{subject}')
+      with step('provisioning.rdheader'):
+        segment_header = rdheader(subject_file, database_name, subject, local_dir)
     except:
       print(f'No file found for {database_name}/{subject}/{subject_file}', flush=True)
       return None
@@ -58,7 +70,51 @@ def worker_function(subject_file: str, database_name: str, subject: str, subject
     return None
   
 
-def valid_segments_retrieval(database_name: str, required_signals: set, min_duration: int, output_file: str, n_cores : int = 1) -> str:
+def save_valid_segments(database_name: str, records: List, required_signals: set, min_duration: int, output_file: str) -> str:
+  r"""
+  Save the list of valid segments as a txt file, the database name is written on the first line.
+  The required signals and the minimum duration are appended to the file name.
+
+  Parameters
+  ------------
+
+  database_name: string,
+    the name of the dataset
+  records: list,
+    the valid segments in the parent_directory/patient_id/segment format
+  required_signal: set,
+    which signals (arterial blood pressure, photoplethysmography, etc.) have been looked for
+  min_duration: int,
+    minimum duration of a signal
+  output_file: str,
+    where to save the list of valid segments
+
+  Returns
+  ------------
+  output_file_new_path: str,
+    the path to the txt file with valid segments location in the database
+  """
+
+  # Save the list as a txt file
+  output_file_new_path = output_file[:-4] # remove extension
+  
+  # Add requried signals to name
+  for el in required_signals:
+    output_file_new_path += '_' + str(el).lower()
+
+  # Add duration (in minutes) to signal name
+  output_file_new_path += '_' + str(min_duration) + 'm'
+  output_file_new_path += '.txt'
+
+  with open(output_file_new_path, 'w') as f:
+    f.write(f"{database_name}\n")
+    for record in records:
+      f.write(f"{record}\n")
+
+  return output_file_new_path
+
+
+def valid_segments_retrieval(database_name: str, required_signals: set, min_duration: int, output_file: str, n_cores : int = 1, index_path: Optional[str] = None, local_dir: Optional[str] = None, refresh_index: bool = False, engine: str = 'queue', async_mirror_dir: Optional[str] = None, max_in_flight: int = 256, journal_path: Optional[str] = None, shard: Optional[Tuple[int, int]] = None, event_journal_path: Optional[str] = None) -> str:
   r"""
   This function analyze the MIMIC-III Matched subset dataset, by examining the header files of patients
   who have the required signals. It is worth noticing that patients are organized in folders 
@@ -67,6 +123,28 @@ def valid_segments_retrieval(database_name: str, required_signals: set, min_dura
   Blood Pressure, PPG, etc.). These records are divided in segmentswhich may or may not contain the required signals. 
   Additionally, it removes segments that last less than 8 minutes.
 
+  When index_path is provided, every header read is kept in a local SQLite index (see header_index.py)
+  and the valid segments are obtained with a local query: only subjects not indexed yet are crawled,
+  so running again with other required signals or another minimum duration does not touch the network.
+
+  With the 'queue' engine all the (subject, file) pairs are a single stream of tasks served by one pool of workers
+  (see provisioning_engine.py), while the 'loop' engine starts a parallel call for every subject.
+
+  When async_mirror_dir is provided, all the headers are first fetched asynchronously into that directory, with
+  hundreds of requests in flight over a pool of keep-alive connections (see async_fetch.py), and then read locally.
+
+  When journal_path is provided, the valid segments of each subject are appended to a journal as soon as the subject
+  is completed (see crawl_journal.py). If the crawl dies, running it again with the same parameters skips the subjects
+  already in the journal. The header index plays the same role when index_path is provided.
+
+  When shard is provided, only the subjects of that shard are crawled (see sharding.py): patients are split among
+  the shards by a stable hash, so every host of a run can work on its own shard and the outputs are merged later.
+
+  When event_journal_path is provided, a 'provision' event is logged in the EventJournal for every subject (see event_journal.py),
+  with the subject (e.g. p00/p000020/) in place of the segment and the number of files and valid segments in the metrics:
+  'crawled' for the subjects whose headers have been read, 'resumed' for the ones taken from the journal and 'indexed'
+  for the ones queried from the header index.
+
   Parameters
   ------------
 
@@ -80,6 +158,24 @@ def valid_segments_retrieval(database_name: str, required_signals: set, min_dura
     where to save the list of valid segments
   n_cores: int, default 1,
     number of parallel cores to use
+  index_path: str, default None,
+    location of the SQLite header index, when None headers are not kept
+  local_dir: str, default None,
+    root directory of a local mirror of database_name, when None PhysioNet is queried
+  refresh_index: bool, default False,
+    whether to look for new files in subjects that have already been indexed
+  engine: str, default 'queue',
+    'queue' for a single work queue over all the subjects' files, 'loop' for one parallel call per subject
+  async_mirror_dir: str, default None,
+    directory where headers are fetched asynchronously before being read, it replaces local_dir
+  max_in_flight: int, default 256,
+    maximum number of concurrent requests of the asynchronous fetch
+  journal_path: str, default None,
+    where to append the segments of every completed subject, if the crawl is interrupted it resumes from there
+  shard: tuple, default None,
+    (i, N) to process only the patients of the i-th of N shards
+  event_journal_path: str, default None,
+    location of the SQLite event journal where the outcome of every subject is recorded
   
   Returns
   ------------
@@ -87,10 +183,49 @@ def valid_segments_retrieval(database_name: str, required_signals: set, min_dura
     the path to the txt file with valid segments location in the database
   """ 
 
+  if async_mirror_dir is not None:
+    mirror_database_headers(database_name, async_mirror_dir, shard=shard, max_in_flight=max_in_flight)
+    local_dir = async_mirror_dir
+
+  if index_path is not None:
+    update_header_index(database_name, index_path, local_dir=local_dir, refresh=refresh_index, n_cores=n_cores, engine=engine, shard=shard)
+    records = [record for record in query_valid_segments(index_path, database_name, required_signals, min_duration) if in_shard(record, shard)]
+
+    # Only the subjects with valid segments are known from the query
+    subject_counts = {}
+    for record in records:
+      subject = str(record).rsplit('/', 1)[0] + '/'
+      subject_counts[subject] = subject_counts.get(subject, 0) + 1
+    with EventJournal(event_journal_path) as events:
+      for subject, n_valid in subject_counts.items():
+        events.log(subject, 'provision', 'indexed', metrics={'n_valid': n_valid})
+
+    print()
+    print(f"Loaded {len(records)} records from the '{database_name}' header index.")
+
+    return save_valid_segments(database_name, records, required_signals, min_duration, output_file)
+
   # Each subject may be associated with multiple records
-  subjects = wfdb.get_record_list(database_name)
+  subjects = get_record_list(database_name, local_dir=local_dir)
   print(f"The '{database_name}' database contains data from {len(subjects)} subjects")
 
+  if shard is not None:
+    subjects = [subject for subject in subjects if in_shard(subject, shard)]
+    print(f"Shard {shard[0]}/{shard[1]}: {len(subjects)} subjects")
+
+  # Subjects already in the journal are not crawled again
+  journal = None
+  if journal_path is not None:
+    params = {'database_name': database_name, 'required_signals': sorted(required_signals), 'min_duration': min_duration}
+    if shard is not None:
+      params['shard'] = list(shard)
+    journal = CrawlJournal(journal_path, params)
+  completed = journal.completed if journal is not None else {}
+  events = EventJournal(event_journal_path)
+  for subject in subjects:
+    if subject in completed:
+      events.log(subject, 'provision', 'resumed', metrics={'n_valid': len(completed[subject])})
+
   # Iterate the subjects to get a list of records
   records = []
 
@@ -99,43 +234,62 @@ def valid_segments_retrieval(database_name: str, required_signals: set, min_dura
   used_cores = n_cores
   print(f'Using {used_cores}/{num_cores} cores')
 
-  j=0
-  for subject in subjects:
-    # Retrieve the file associated to a patient
-    # Thanks to wfdb we have to distinguish only between numerics and waveforms (layout files are not appearing,
-    # print files to get evidence of this)
-    files = wfdb.get_record_list(f'{database_name}/{subject}')
+  if engine == 'queue':
+    # Subjects complete out of order, their segments are put back in the database order at the end
+    subject_records = {subject_idx: completed[subject] for subject_idx, subject in enumerate(subjects) if subject in completed}
+    subjects_to_crawl = [(subject_idx, subject) for subject_idx, subject in enumerate(subjects) if subject not in completed]
 
-    # The subject id is needed to remove files associated to a study that are not waveforms
-    subject_id = subject.split('/')[1]
+    for subject_idx, subject, files, segments in crawl_subjects(database_name, subjects_to_crawl, worker_function, (required_signals, min_duration, local_dir), n_cores=used_cores, local_dir=local_dir):
+      subject_records[subject_idx] = [record for record in segments if record is not None]
+      events.log(subject, 'provision', 'crawled', metrics={'n_files': len(files), 'n_valid': len(subject_records[subject_idx])})
+      if journal is not None:
+        journal.record_subject(subject, subject_records[subject_idx])
 
-    segments = Parallel(n_jobs=used_cores)(delayed(worker_function)(files[i], database_name, subject, subject_id, required_signals, min_duration) for i in range(len(files)))
+    for subject_idx in sorted(subject_records):
+      records.extend(subject_records[subject_idx])
 
-    # Segments contains the results of the parallel execution
-    records.extend([record for record in segments if record is not None])
+  else:
+    start = time.time()
+    n_tasks = 0
 
-    j += 1
-    if j % 1000 == 0:
-      print(f'Subjects processed {j}/{len(subjects)}')
+    j=0
+    for subject in subjects:
+      j += 1
+      if subject in completed:
+        records.extend(completed[subject])
+        continue
 
-  print()
-  print(f"Loaded {len(records)} records from the '{database_name}' database.")
+      subject_start = time.time()
 
-  # Save the list as a txt file
-  output_file_new_path = output_file[:-4] # remove extension
-  
-  # Add requried signals to name
-  for el in required_signals:
-    output_file_new_path += '_' + str(el).lower()
+      # Retrieve the file associated to a patient
+      # Thanks to wfdb we have to distinguish only between numerics and waveforms (layout files are not appearing,
+      # print files to get evidence of this)
+      files = get_record_list(database_name, subject, local_dir)
 
-  # Add duration (in minutes) to signal name
-  output_file_new_path += '_' + str(min_duration) + 'm'
-  output_file_new_path += '.txt'
+      # The subject id is needed to remove files associated to a study that are not waveforms
+      subject_id = subject.split('/')[1]
 
-  with open(output_file_new_path, 'w') as f:
-    f.write(f"{database_name}\n")
-    for record in records:
-      f.write(f"{record}\n")
+      segments = Parallel(n_jobs=used_cores)(delayed(worker_function)(files[i], database_name, subject, subject_id, required_signals, min_duration, local_dir) for i in range(len(files)))
 
-  return output_file_new_path
-    
\ No newline at end of file
+      # Segments contains the results of the parallel execution
+      segments = [record for record in segments if record is not None]
+      records.extend(segments)
+      n_tasks += len(files)
+      events.log(subject, 'provision', 'crawled', metrics={'n_files': len(files), 'n_valid': len(segments)}, started_at=subject_start, duration=time.time() - subject_start)
+
+      if journal is not None:
+        journal.record_subject(subject, segments)
+
+      if j % 1000 == 0:
+        report_throughput(j, len(subjects), n_tasks, time.time() - start)
+
+    report_throughput(j, len(subjects), n_tasks, time.time() - start)
+
+  if journal is not None:
+    journal.close()
+  events.close()
+
+  print()
+  print(f"Loaded {len(records)} records from the '{database_name}' database.")
+
+  return save_valid_segments(database_name, records, required_signals, min_duration, output_file)
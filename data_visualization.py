@@ -1,10 +1,21 @@
 import os
+import time
+import warnings
+from contextlib import nullcontext
 from joblib import Parallel, delayed
 import multiprocessing
 import numpy as np
 from matplotlib import pyplot as plt
-import wfdb
+from matplotlib.figure import Figure
+from matplotlib.collections import PolyCollection
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 from scipy.signal import welch
+from typing import List, Optional, Tuple
+from data_preprocessing import read_segment_signals, read_local_segment
+from segment_store import SegmentStore
+from event_journal import EventJournal
+from spectral_features import read_segment_spectrum
+from instrumentation import instrumented, step, count
 
 
 def plot_psd(signal : np.array, sampling_rate : int, window : str = 'hann'):
@@ -40,7 +51,167 @@ def plot_psd(signal : np.array, sampling_rate : int, window : str = 'hann'):
     plt.clf()
 
 
-def worker_function(database_name : str, seg_path : str, output_dir : str) -> None:
+def plot_segment_psd(spectral_dir : str, segment_id : str, channel : str = 'ppg', save_path : Optional[str] = None) -> None:
+    r"""
+    Plots the average power spectral density of a segment from its spectral feature file (see spectral_features.py),
+    with the median dominant frequency of its windows, without reading the signals again.
+
+    Parameters
+    ------------
+    spectral_dir: str,
+        directory of the feature files
+    segment_id: str,
+        the segment in the parent_folder/patient_id/seg_id format
+    channel: str, default 'ppg',
+        'ppg' or 'abp'
+    save_path: str, default None,
+        where to save the image, when None the figure is shown
+
+    Returns
+    ------------
+    None
+    """
+
+    spectrum = read_segment_spectrum(spectral_dir, segment_id)
+    dominant_frequency = np.nanmedian(spectrum[f'{channel}_dominant_frequency'])
+
+    plt.figure()
+    plt.semilogy(spectrum['frequencies'], spectrum[f'{channel}_psd'], color='b')
+    plt.xlabel('frequency [Hz]')
+    plt.ylabel('PSD [V**2/Hz]')
+    plt.axvline(x=dominant_frequency, color='r', linestyle='--', label=f'Dominant frequency ({60 * dominant_frequency:.0f} bpm)')
+    plt.title(f'{segment_id} {channel.upper()}')
+    plt.legend()
+    if save_path is not None:
+        plt.savefig(save_path)
+    else:
+        plt.show()
+    plt.close()
+
+
+def minmax_decimate(signal : np.array, fs : float, n_bins : int) -> Tuple[np.array, np.array, np.array]:
+    r"""
+    Min/max envelope of a signal in n_bins bins (e.g. one per pixel column of the axes): filling the area between the
+    minimum and the maximum of every bin looks the same of plotting all the samples, with flat lines, spikes and NaN gaps
+    (bins with NaNs only) still visible. Signals with less than 2 * n_bins samples are not decimated (minimum and maximum
+    are the samples themselves).
+
+    Parameters
+    ------------
+
+    signal: np.array,
+        the signal to decimate (a memory map is read once)
+    fs: float,
+        the sampling frequency
+    n_bins: int,
+        the number of bins
+
+    Returns
+    ------------
+
+    The start of every bin in seconds, and the minimum and the maximum of every bin
+    """
+    n_samples = len(signal)
+    if n_samples <= 2 * n_bins:
+        signal = np.asarray(signal)
+        return np.arange(n_samples) / fs, signal, signal
+
+    bin_len = -(-n_samples // n_bins)
+    n_full = n_samples // bin_len
+    blocks = np.asarray(signal[: n_full * bin_len]).reshape(n_full, bin_len)
+    tail = np.asarray(signal[n_full * bin_len :])
+
+    with warnings.catch_warnings():
+        # All-NaN bins are kept as NaN, a gap in the line
+        warnings.simplefilter('ignore', RuntimeWarning)
+        low = np.nanmin(blocks, axis=1)
+        high = np.nanmax(blocks, axis=1)
+        if len(tail):
+            low = np.append(low, np.nanmin(tail))
+            high = np.append(high, np.nanmax(tail))
+
+    return np.arange(len(low)) * (bin_len / fs), low, high
+
+
+class FigureRenderer:
+    r"""
+    Renderer of signal figures for batches of segments, on the non-interactive Agg canvas. The Figure, its Axes and
+    the envelope are created once and updated for every signal, instead of building a new pyplot figure each time.
+    Signals are decimated with minmax_decimate down to the pixel width of the axes, and drawn as the polygons between
+    the minima and the maxima of the bins: their outline is a smooth path, that Agg draws several times faster than
+    the line zigzagging between minima and maxima.
+
+    Parameters
+    ------------
+
+    width: int, default 1280,
+        width of the figures in pixels
+    height: int, default 480,
+        height of the figures in pixels
+    dpi: int, default 100,
+        resolution of the figures
+    """
+
+    def __init__(self, width : int = 1280, height : int = 480, dpi : int = 100):
+        self.figure = Figure(figsize=(width / dpi, height / dpi), dpi=dpi)
+        self.canvas = FigureCanvasAgg(self.figure)
+        self.axes = self.figure.add_subplot()
+        self.figure.subplots_adjust(left=0.08, right=0.98, bottom=0.12, top=0.9)
+        self.axes.set_xlabel('s')
+        self.envelope = self.axes.add_collection(PolyCollection([], linewidths=0.8))
+        # One bin per pixel column of the axes
+        self.n_bins = max(int(self.axes.get_position().width * width), 1)
+
+    def render(self, signal : np.array, fs : float, title : str, units : str, color : str, save_path : str) -> None:
+        r"""
+        Draw a signal (seconds on the x-axis) and save the figure in save_path.
+        """
+        t, low, high = minmax_decimate(signal, fs, self.n_bins)
+
+        # One polygon per run of bins with values, NaN gaps are left empty
+        valid = np.concatenate(([False], np.isfinite(low), [False]))
+        starts = np.flatnonzero(~valid[:-1] & valid[1:])
+        stops = np.flatnonzero(valid[:-1] & ~valid[1:])
+        self.envelope.set_verts([np.concatenate((np.column_stack((t[i:j], high[i:j])), np.column_stack((t[i:j][::-1], low[i:j][::-1])))) for i, j in zip(starts, stops)])
+        self.envelope.set_color(color)
+
+        self.axes.set_title(title)
+        self.axes.set_ylabel(units)
+        self.axes.set_xlim(0, max(len(signal) / fs, 1.0 / fs))
+
+        finite = np.isfinite(low)
+        low, high = (low[finite].min(), high[finite].max()) if finite.any() else (0.0, 1.0)
+        margin = 0.05 * (high - low) if high > low else 0.5
+        self.axes.set_ylim(low - margin, high + margin)
+
+        # The fastest zlib level, PNG encoding is otherwise the slowest part of a figure (files are ~30% larger)
+        self.figure.savefig(save_path, pil_kwargs={'compress_level': 1})
+
+
+_renderer = None
+
+
+def get_renderer() -> FigureRenderer:
+    r"""
+    The FigureRenderer of the current process, created at the first call.
+    """
+    global _renderer
+    if _renderer is None:
+        _renderer = FigureRenderer()
+    return _renderer
+
+
+def render_abp_and_ppg(renderer : FigureRenderer, abp : np.array, ppg : np.array, fs : float, units : Tuple[str, str], output_dir : str, patient_id : str, seg_id : str) -> None:
+    r"""
+    Save the ABP and PPG figures of a segment in output_dir, as patient_id_seg_id_ABP.png and patient_id_seg_id_PPG.png.
+    """
+    for signal, title, signal_units, color, label in [(abp, 'Arterial Blood Pressure', units[0], 'orange', 'ABP'), (ppg, 'PhotoPlethysmoGraphy', units[1], 'blue', 'PPG')]:
+        with step('visualization.plot'):
+            renderer.render(signal, fs, title, signal_units, color, os.path.join(output_dir, f'{patient_id}_{seg_id}_{label}.png'))
+
+
+@instrumented('visualization', counter='segments')
+def worker_function(database_name : str, seg_path : str, output_dir : str, store_dir : Optional[str] = None, local_dir : Optional[str] = None, journal_path : Optional[str] = None) -> None:
     r"""
     A thead wil spawn executing the code of this function, that is:
     - querying the database for the specific segment associated to a patient
@@ -56,6 +227,12 @@ def worker_function(database_name : str, seg_path : str, output_dir : str) -> No
         path identifying the subject segmetn inside the dataset
     output_dir: string,
         the location where the images will be saved
+    store_dir: string, default None,
+        directory of a SegmentStore, segments found there are not queried from the database
+    local_dir: string, default None,
+        root directory of a local mirror of the database, when None PhysioNet is queried
+    journal_path: string, default None,
+        location of the SQLite event journal (see event_journal.py) where a 'visualize' event of the segment is recorded
         
     Returns
     ------------
@@ -66,34 +243,90 @@ def worker_function(database_name : str, seg_path : str, output_dir : str) -> No
     parent_folder, patient_id, seg_id = seg_path.split('/')
     seg_id = seg_id[:-1] # remove the endline \n char 
     
-    record_data = wfdb.rdrecord(record_name=seg_id, pn_dir=f'{database_name}/{parent_folder}/{patient_id}')
-    fs = record_data.fs
+    # The memory maps read from the store stay valid once it is closed
+    with step('visualization.read'), (SegmentStore(store_dir) if store_dir is not None else nullcontext()) as store:
+        if store is not None and seg_path.strip() in store:
+            # Memory mapped from the store, the signals are already interpolated
+            segment_info = store.info(seg_path.strip())
+            abp = store.read_channel(seg_path.strip(), 'ABP')
+            ppg = store.read_channel(seg_path.strip(), 'PLETH')
+            fs = segment_info['fs']
+            units = segment_info['units'] or [''] * len(segment_info['channels'])
+            abp_units, ppg_units = units[segment_info['channels'].index('ABP')], units[segment_info['channels'].index('PLETH')]
+        else:
+            # Only the ABP and PPG channels are read, in chunks
+            (abp, ppg), fs, (abp_units, ppg_units), _ = read_segment_signals(seg_id, database_name, f'{parent_folder}/{patient_id}/', local_dir)
+
+    start = time.time()
+    with EventJournal(journal_path) as journal:
+        try:
+            render_abp_and_ppg(get_renderer(), abp, ppg, fs, (abp_units, ppg_units), output_dir, patient_id, seg_id)
+        except Exception as e:
+            journal.log(seg_path.strip(), 'visualize', 'failed', reason=repr(e), started_at=start, duration=time.time() - start)
+            raise
+        journal.log(seg_path.strip(), 'visualize', 'rendered', reason=output_dir, started_at=start, duration=time.time() - start)
+
+
+@instrumented('visualization')
+def render_figures_worker_function(segment_ids : List[str], output_dir : str, records_dir : Optional[str] = None, store_dir : Optional[str] = None, fs : float = 125.0, journal_path : Optional[str] = None) -> int:
+    r"""
+    A thead wil spawn executing the code of this function, that is plotting and saving the ABP and PPG figures of a batch
+    of segments read from the local output of the pipeline (a SegmentStore or the records directory), without querying
+    the database. Segments found in neither are skipped (e.g. discarded by the checks).
+
+    Parameters
+    ------------
+
+    segment_ids: list,
+        the segments in the parent_folder/patient_id/seg_id format
+    output_dir: string,
+        the location where the images will be saved
+    records_dir: string, default None,
+        directory with the parent_folder/patient_id/seg_id/{abp,ppg}.npy files of the segments
+    store_dir: string, default None,
+        directory of a SegmentStore, looked up before records_dir
+    fs: float, default 125.0,
+        the sampling frequency of the signals of records_dir, which is not kept in the .npy files (all MIMIC-III waveforms are at 125 Hz)
+    journal_path: string, default None,
+        location of the SQLite event journal (see event_journal.py) where a 'visualize' event of every segment is recorded
 
-    abp_idx = record_data.sig_name.index('ABP')
-    ppg_idx = record_data.sig_name.index('PLETH')
+    Returns
+    ------------
+    The number of segments plotted
+    """
+    renderer = get_renderer()
+    n_plotted = 0
 
-    abp = record_data.p_signal[:, abp_idx]
-    ppg = record_data.p_signal[:, ppg_idx]
+    with (SegmentStore(store_dir) if store_dir is not None else nullcontext()) as store, EventJournal(journal_path) as journal:
+        for segment_id in segment_ids:
+            segment_id = segment_id.strip()
+            _, patient_id, seg_id = segment_id.split('/')
+            start = time.time()
 
-    t = np.arange(0, (len(abp) / fs), 1.0 / fs)
+            # Memory mapped, only the bins of the decimation are kept in memory
+            with step('visualization.read'):
+                signals = read_local_segment(segment_id, records_dir, store, fs)
 
-    plt.title('Arterial Blood Pressure')
-    plt.xlabel('s')
-    plt.ylabel(record_data.units[abp_idx])
-    plt.plot(t, abp, color='orange', label='ABP')
-    plt.savefig(os.path.join(output_dir, f'{patient_id}_{seg_id}_ABP.png'))
-    plt.clf()
+            if signals is None:
+                print(f'No local signals for {segment_id}, skipped', flush=True)
+                journal.log(segment_id, 'visualize', 'skipped', reason='no local signals', started_at=start, duration=time.time() - start)
+                continue
 
-    plt.title('PhotoPlethysmoGraphy')
-    plt.xlabel('s')
-    plt.ylabel(record_data.units[ppg_idx])
-    plt.plot(t, ppg, color='blue', label='PPG')
-    plt.savefig(os.path.join(output_dir, f'{patient_id}_{seg_id}_PPG.png'))
-    plt.clf()
+            abp, ppg, segment_fs, units = signals
+            try:
+                render_abp_and_ppg(renderer, abp, ppg, segment_fs, units, output_dir, patient_id, seg_id)
+            except Exception as e:
+                journal.log(segment_id, 'visualize', 'failed', reason=repr(e), started_at=start, duration=time.time() - start)
+                raise
+            journal.log(segment_id, 'visualize', 'rendered', reason=output_dir, started_at=start, duration=time.time() - start)
+            count('segments')
+            n_plotted += 1
 
+    return n_plotted
 
 
-def save_abp_and_ppg_figures(valid_segment_file : str, output_dir : str, n_sample_to_plot : int = 4, n_cores : int = 1) -> None:
+
+def save_abp_and_ppg_figures(valid_segment_file : str, output_dir : str, n_sample_to_plot : int = 4, n_cores : int = 1, store_dir : Optional[str] = None, local_dir : Optional[str] = None, records_dir : Optional[str] = None, batch_size : int = 256, journal_path : Optional[str] = None) -> None:
     r"""
     The following function creates the directories required to save the figures associated to the physiological signal of a patient,
     and then it queries the dataset for the specifc patients' segments. The required information is stored in a txt file produced from the data provisioning step.
@@ -105,9 +338,21 @@ def save_abp_and_ppg_figures(valid_segment_file : str, output_dir : str, n_sampl
     output_dir: string,
         the parent directory where to save the output figures
     n_sample_to_plot: int, default 4,
-        the number of patients to analyze
+        the number of segments to plot, the first ones of valid_segment_file
     n_cores: int, default 1,
         the number of cores to use to speed up the data retrieval process
+    store_dir: string, default None,
+        directory of a SegmentStore to read the segments from, segments not in the store are queried from the database
+        (unless records_dir is given)
+    local_dir: string, default None,
+        root directory of a local mirror of the database, when None PhysioNet is queried
+    records_dir: string, default None,
+        directory of the downloaded segments (parent_folder/patient_id/seg_id/{abp,ppg}.npy), when given the figures are
+        rendered in batches by render_figures_worker_function from the local signals only (and from store_dir)
+    batch_size: int, default 256,
+        number of segments of a batch of render_figures_worker_function
+    journal_path: string, default None,
+        location of the SQLite event journal (see event_journal.py) where the outcome of every figure is recorded
         
     Returns
     ------------
@@ -129,8 +374,16 @@ def save_abp_and_ppg_figures(valid_segment_file : str, output_dir : str, n_sampl
         # First line is the database name 
         database_name = lines[0][:-1] # remove the endline \n char
 
+        if records_dir is not None:
+            # Batches of local segments, at least one per core
+            segment_ids = lines[1:n_sample_to_plot + 1]
+            batch_size = max(1, min(batch_size, -(-len(segment_ids) // used_cores)))
+            n_plotted = Parallel(n_jobs=used_cores)(delayed(render_figures_worker_function)(segment_ids[i : i + batch_size], output_dir, records_dir, store_dir, journal_path=journal_path) for i in range(0, len(segment_ids), batch_size))
+            print(f'Saved the figures of {sum(n_plotted)} segments in {output_dir}', flush=True)
+            return
+
         # Next lines are all structured as parent_directory/patient_id/segments
-        _ = Parallel(n_jobs=used_cores)(delayed(worker_function)(database_name, lines[i], output_dir) for i in range(1, n_sample_to_plot))
+        _ = Parallel(n_jobs=used_cores)(delayed(worker_function)(database_name, lines[i], output_dir, store_dir, local_dir, journal_path) for i in range(1, min(n_sample_to_plot + 1, len(lines))))
 
   
 def plot_signal(signal : np.array, fs : int, flat_locs_sig : np.array = None, peaks : np.array = None, valleys: np.array = None, title : str = '', save_path : str = './') -> None:
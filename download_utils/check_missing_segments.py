@@ -1,12 +1,25 @@
 import os
+import sys
 import glob
+import re
+from typing import Dict, Iterable, Iterator, List, Optional
 
 from numpy import sort
 
-downloaded_segments = []
+# The pipeline modules are in the parent directory
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from segment_catalog import SegmentCatalog, read_segments_txt
 
-intial_valid_segments_path = os.path.join('./output', 'valid_segments_pleth_abp_8m.txt')
-valid_downloaded_segments_path = sort(glob.glob('./output/logs/valid_segment_download_*')) # sort it is important to maintain the order of downloads
+
+# Segments appear in the logs as parent_folder/patient_id/seg_id, possibly inside a longer path
+SEGMENT_PATTERN = re.compile(r'p\d\d/p\d{6}/\d+_\d+')
+
+# State of a segment after reading the logs: the first 'Processing' line moves it to 1, then the first line telling
+# how the processing ended (saved, too many flat parts, too many NaNs, ABP with invalid ranges) moves it to 2, 3, 4 or 5
+NOT_SEEN, PROCESSING, SAVED, FLAT, NANS, INVALID_ABP = range(6)
+
+# Status in the segment catalog of the segments of every list of reconcile_segments (strange ones keep their status)
+CATALOG_STATUSES = {'missing': 'downloading', 'downloaded': 'downloaded', 'deleted': 'discarded'}
 
 
 def get_idx(li, el_to_find) -> int:
@@ -17,75 +30,130 @@ def get_idx(li, el_to_find) -> int:
             idx = i
     return idx
 
-for log_file in valid_downloaded_segments_path:
-    # Remember to change the log file to check !!!
-    try:
-        with open(log_file, 'r') as f:
-            downloaded_segments.extend(f.readlines())
-    except UnicodeDecodeError:
-        with open(log_file, 'r', encoding='utf-16') as f:
-            downloaded_segments.extend(f.readlines())
-
-# A segment that has been fully processed appear two times in the valid_segments_download.log file
-with open(intial_valid_segments_path, 'r') as f:
-    lines = f.readlines()
-
-    # First line is the database name
-    database_name = lines[0][:-1] # remove the endline \n char
-
-    # Look into valid_segment_download.log to get the last seegment whose processing has started and thus (probably) not finished
-    #last_processed_idx = get_idx(lines, lines[-1])
-   
-    # Get the index and obtain the list of valid segment that had to be processed until this idx in valid_segments_pleth_abp_8m.txt 
-    segments_to_download = [lines[x].strip() for x in range(1, len(lines))]
-
-    missing_segments = []
-    actually_downloaded_segments = []
-    strange_segments = []
-    deleted_segments = []
-    
-    for seg in segments_to_download:
-        count = 0
-        for el in downloaded_segments:
-            if (seg in el) and ('Processing' in el) and (count == 0):
-                count = 1
-            elif (seg in el) and ('Saved' in el) and (count == 1):
-                count = 2
-            elif (seg in el) and ('flat' in el) and (count == 1):
-                count = 3
-            elif (seg in el) and ('NaNs' in el) and (count == 1):
-                count = 4
-            elif (seg in el) and ('ABP' in el) and (count == 1):
-                count = 5
-            else:
-                continue
-        
-        if count == 0:
-            strange_segments.append(seg)
-        elif count == 1:
-            missing_segments.append(seg)
-        elif count == 2:
-            actually_downloaded_segments.append(seg)
+
+def detect_encoding(log_path : str) -> str:
+    r"""
+    Encoding of a log from its byte order mark: logs redirected by PowerShell are UTF-16, the others UTF-8.
+    """
+    with open(log_path, 'rb') as f:
+        bom = f.read(3)
+
+    if bom[:2] in (b'\xff\xfe', b'\xfe\xff'):
+        return 'utf-16'
+    if bom == b'\xef\xbb\xbf':
+        return 'utf-8-sig'
+    return 'utf-8'
+
+
+def iter_log_lines(log_paths : Iterable[str]) -> Iterator[str]:
+    r"""
+    Stream the lines of many logs, in the given order, each one read with its own encoding.
+    """
+    for log_path in log_paths:
+        with open(log_path, 'r', encoding=detect_encoding(log_path), errors='replace') as f:
+            yield from f
+
+
+def reconcile_segments(valid_segments_path : str, log_paths : Iterable[str]) -> Dict[str, List[str]]:
+    r"""
+    Find out what happened to every segment of a valid segments file by reading the download logs once.
+    Every segment mentioned by a line gets a state, kept in a dictionary, that changes as follows:
+    - a 'Processing' line of a segment not seen before moves it to processing
+    - then the first 'Saved', 'flat', 'NaNs' or 'ABP' line of the segment moves it to saved, flat, NaNs or invalid ABP
+    - later lines do not change it
+
+    Parameters
+    ------------
+
+    valid_segments_path: str,
+        the segment catalog (.sqlite), whose segments are all checked, or the txt file with the database name as first
+        line and the segments on the following ones
+    log_paths: iterable,
+        the logs of the downloads, in the order they have been written (UTF-8 and UTF-16 can be mixed)
+
+    Returns
+    ------------
+
+    A dictionary with the lists of segments (in the order of the valid segments file):
+    - strange: never processed
+    - missing: processing started, but not finished
+    - downloaded: saved
+    - deleted: discarded by the checks (flat parts, NaNs or ABP)
+    """
+    states = {}
+    for line in iter_log_lines(log_paths):
+        for segment in SEGMENT_PATTERN.findall(line):
+            state = states.get(segment, NOT_SEEN)
+
+            if state == NOT_SEEN and 'Processing' in line:
+                states[segment] = PROCESSING
+            elif state == PROCESSING:
+                if 'Saved' in line:
+                    states[segment] = SAVED
+                elif 'flat' in line:
+                    states[segment] = FLAT
+                elif 'NaNs' in line:
+                    states[segment] = NANS
+                elif 'ABP' in line:
+                    states[segment] = INVALID_ABP
+
+    if valid_segments_path.endswith('.sqlite'):
+        with SegmentCatalog(valid_segments_path) as catalog:
+            segments_to_download = catalog.segments()
+    else:
+        _, segments_to_download = read_segments_txt(valid_segments_path)
+
+    result = {'strange': [], 'missing': [], 'downloaded': [], 'deleted': []}
+    for segment in segments_to_download:
+        state = states.get(segment, NOT_SEEN)
+        if state == NOT_SEEN:
+            result['strange'].append(segment)
+        elif state == PROCESSING:
+            result['missing'].append(segment)
+        elif state == SAVED:
+            result['downloaded'].append(segment)
         else:
-            deleted_segments.append(seg)
-    
-    with open('./output/strange_segments.txt', 'w') as f:
-        for el in strange_segments:
-            f.write(f"{el}\n")
-
-    with open('./output/missing_segments.txt', 'w') as f:
-        for el in missing_segments:
-            f.write(f"{el}\n")
-
-    with open('./output/actually_downloaded_segments.txt', 'w') as f:
-        for el in actually_downloaded_segments:
-            f.write(f"{el}\n")
-    
-    with open('./output/deleted_segments.txt', 'w') as f:
-        for el in deleted_segments:
-            f.write(f"{el}\n")
-    
-    
+            result['deleted'].append(segment)
+
+    return result
+
+
+def save_reconciliation(result : Dict[str, List[str]], output_dir : str, catalog_path : Optional[str] = None) -> None:
+    r"""
+    Write the lists of reconcile_segments in output_dir (strange_segments.txt, missing_segments.txt,
+    actually_downloaded_segments.txt and deleted_segments.txt), and when catalog_path is given move the segments
+    of the catalog to the status of their list (see CATALOG_STATUSES).
+    """
+    if catalog_path is not None:
+        with SegmentCatalog(catalog_path) as catalog:
+            for key, status in CATALOG_STATUSES.items():
+                catalog.set_status(result[key], status)
+
+    file_names = {'strange': 'strange_segments.txt', 'missing': 'missing_segments.txt', 'downloaded': 'actually_downloaded_segments.txt', 'deleted': 'deleted_segments.txt'}
+
+    for key, file_name in file_names.items():
+        with open(os.path.join(output_dir, file_name), 'w') as f:
+            for el in result[key]:
+                f.write(f"{el}\n")
+
+
+if __name__ == '__main__':
+    intial_valid_segments_path = os.path.join('./output', 'valid_segments_pleth_abp_8m.txt')
+    catalog_path = os.path.join('./output', 'segments.sqlite')
+    valid_downloaded_segments_path = sort(glob.glob('./output/logs/valid_segment_download_*')) # sort it is important to maintain the order of downloads
+
+    # The catalog written by main.py, created from the valid segments file when it does not exist
+    if not os.path.exists(catalog_path):
+        with SegmentCatalog(catalog_path) as catalog:
+            catalog.import_txt(intial_valid_segments_path, 'valid')
+
+    result = reconcile_segments(catalog_path, valid_downloaded_segments_path)
+    save_reconciliation(result, './output', catalog_path)
+
+    for key, segments in result.items():
+        print(f'{key}: {len(segments)}')
+
+
 #    downloaded_segs = glob.glob('./output/records/p00/*/*')
 #    downloaded_segs.extend(glob.glob('./output/records/p04/*/*'))
 
@@ -95,9 +163,9 @@ with open(intial_valid_segments_path, 'r') as f:
 
 #    for i in range(len(downloaded_segs)):
 #        downloaded_segs[i] = '/'.join(downloaded_segs[i].split('/')[-3:])
-    
+
 #    downloaded_segs = set(downloaded_segs)
-    
+
 #    for el in set(segments_to_download):
 #        if el not in downloaded_segs:
-#            print('Missing segment:', el)    
+#            print('Missing segment:', el)
@@ -1,45 +1,51 @@
 import multiprocessing
 import os
+import sys
 from pathlib import Path
 from shutil import rmtree
 from joblib import Parallel, delayed
-import wfdb
-import numpy as np
+
+# The script runs from download_utils, the pipeline modules are in the parent directory
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from data_preprocessing import read_segment_signals
+from record_cache import enable_record_cache
+from segment_catalog import SegmentCatalog
 
 
 def worker_function(segment_path, output_dir) -> None:
     segment_path = segment_path.strip()
     print(f'Downloading {segment_path.strip()} ...', flush=True)
     parent_folder, patient_id, seg_id = segment_path.split('/')[-3:]
-    record_data = wfdb.rdrecord(record_name=seg_id.strip(), pn_dir=f'mimic3wdb-matched/1.0/{parent_folder}/{patient_id}')
-    abp_idx = record_data.sig_name.index('ABP')
-    ppg_idx = record_data.sig_name.index('PLETH')
- 
-    abp = record_data.p_signal[:, abp_idx]
-    ppg = record_data.p_signal[:, ppg_idx]
-
     output_path = os.path.join(output_dir, segment_path)
 
     if Path(output_path).exists():
         rmtree(output_path)
     os.makedirs(output_path)
 
-    np.save(os.path.join(output_path, 'abp'), abp)
-    np.save(os.path.join(output_path, 'ppg'), ppg)
+    # Only the ABP and PPG channels are read, in chunks written straight into the .npy files
+    read_segment_signals(seg_id.strip(), 'mimic3wdb-matched/1.0', f'{parent_folder}/{patient_id}/', out_files=[os.path.join(output_path, 'abp.npy'), os.path.join(output_path, 'ppg.npy')])
     print(f'Saved {output_path}', flush=True)
+    return segment_path
 
 
 
-missing_segments_to_download_file_path = '../output/logs/segments_preprocessing/downloaded preprocessed_segs.txt' 
+# Segments whose download started during the preprocessing but never finished (see process_preprocessing_logs.py)
+catalog_path = '../output/segments.sqlite'
 output_dir = '../output/records/'
 
+# Records already fetched by a previous run (with the same --record_cache) are read from the local disk
+record_cache_dir = '../output/record_cache'
+enable_record_cache(record_cache_dir)
+
 
 # Parallel cores
 num_cores = multiprocessing.cpu_count()
 used_cores = 12
 print(f'Using {used_cores}/{num_cores} cores')
 
-with open(missing_segments_to_download_file_path, 'r') as f1:
-    lines = f1.readlines()
+with SegmentCatalog(catalog_path) as catalog:
+    lines = catalog.segments(status='downloading')
+    print(f'{len(lines)} segments to download, of {catalog.count_patients("downloading")} patients')
 
-    Parallel(n_jobs=used_cores)(delayed(worker_function)(lines[i], output_dir) for i in range(len(lines))) 
\ No newline at end of file
+    downloaded_segments = Parallel(n_jobs=used_cores)(delayed(worker_function)(lines[i], output_dir) for i in range(len(lines)))
+    catalog.set_status(downloaded_segments, 'downloaded')
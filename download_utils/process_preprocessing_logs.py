@@ -1,21 +1,39 @@
 import os
+import sys
 import glob
 import zipfile
 from concurrent.futures import ThreadPoolExecutor
 
+# The pipeline modules are in the parent directory
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from segment_catalog import SegmentCatalog, split_segment_id
+
 
 preprocessed_segs = []
 with open('../output/logs/valid_segments_preprocess_2.log', 'r') as f1:
     preprocessed_segs.extend(f1.readlines())
 
+# Outcome of every segment in the preprocessing log, as a status of the catalog
+statuses = {'preprocessed': [], 'removed': [], 'downloading': []}
+
 with open('../output/logs/successfully preprocessed_segs.txt', 'a') as f1, open('../output/logs/removed preprocessed_segs.txt', 'a') as f2, open('../output/logs/downloaded preprocessed_segs.txt', 'a') as f3:
     for i in range(len(preprocessed_segs)):
         seg = preprocessed_segs[i].strip()
         if 'Saved' in seg:
             f1.write(f'{seg[23:]}\n')
+            statuses['preprocessed'].append('/'.join(split_segment_id(seg[23:])))
         elif 'Removed' in seg:
             f2.write(f'{seg[25:]}\n')
+            statuses['removed'].append('/'.join(split_segment_id(seg[25:])))
         elif 'Downloading' in seg:
             f3.write(f'{seg[29:-4]}\n')
+            statuses['downloading'].append('/'.join(split_segment_id(seg[29:-4])))
         else:
-            continue
\ No newline at end of file
+            continue
+
+# Segments still downloading are fetched again by download_missing_segements.py
+with SegmentCatalog('../output/segments.sqlite') as catalog:
+    for status, segments in statuses.items():
+        catalog.set_status(segments, status, 'mimic3wdb-matched/1.0')
+    for status, (num_patients, num_records) in catalog.status_counts().items():
+        print(f'{status}: {num_patients} patients, {num_records} segments')
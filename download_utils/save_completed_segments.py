@@ -1,9 +1,15 @@
 import os
+import sys
+
+# The pipeline modules are in the parent directory
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from segment_catalog import SegmentCatalog, read_segments_txt, split_segment_id
 
 downloaded_segments = []
 
 valid_downloaded_segments_path = os.path.join('./output', 'logs', 'valid_segment_download_8.log')
 already_downloaded_segments_path = os.path.join('./output', 'downloaded_segments.txt')
+catalog_path = os.path.join('./output', 'segments.sqlite')
 
 # Remember to change the log file to check !!!
 with open(valid_downloaded_segments_path,'r') as f:
@@ -11,14 +17,16 @@ with open(valid_downloaded_segments_path,'r') as f:
 
     for line in lines:
         if 'Saved' in line:
-            downloaded_segments.append(line)
-
-already_downloaded_segments = []
-with open(already_downloaded_segments_path, 'r') as f:
-    already_downloaded_segments.extend(f.readlines())
+            # Saved <output_dir>/records/parent_folder/patient_id/seg_id
+            downloaded_segments.append('/'.join(split_segment_id(line.split()[-1])))
 
-# append mode
-with open(already_downloaded_segments_path, 'a') as f:
-    for seg in downloaded_segments:
-        if seg not in already_downloaded_segments:
-            f.writelines(seg)
\ No newline at end of file
+# Segments already marked as downloaded are not added twice, the txt list is exported from the catalog
+with SegmentCatalog(catalog_path) as catalog:
+    if os.path.exists(already_downloaded_segments_path):
+        # Segments of the list still valid in the catalog are downloaded, the preprocessed or removed ones keep their status
+        _, listed_segments = read_segments_txt(already_downloaded_segments_path)
+        valid_segments = set(catalog.segments('valid'))
+        catalog.set_status([seg for seg in listed_segments if seg in valid_segments or seg not in catalog], 'downloaded', 'mimic3wdb-matched/1.0')
+    catalog.set_status(downloaded_segments, 'downloaded', 'mimic3wdb-matched/1.0')
+    catalog.export_txt(already_downloaded_segments_path, ['downloaded', 'preprocessed', 'removed'])
+    print(f'{catalog.count("downloaded")} downloaded segments, of {catalog.count_patients("downloaded")} patients')
@@ -0,0 +1,185 @@
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+from typing import Dict, List, Optional
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+    event_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    segment_id TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    outcome TEXT NOT NULL,
+    reason TEXT,
+    metrics TEXT,
+    started_at REAL NOT NULL,
+    duration REAL,
+    pid INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS events_by_segment ON events (segment_id, event_id);
+CREATE INDEX IF NOT EXISTS events_by_outcome ON events (stage, outcome);
+"""
+
+# Columns of an event, in the order of the events table (event_id excluded)
+EVENT_FIELDS = ['segment_id', 'stage', 'outcome', 'reason', 'metrics', 'started_at', 'duration', 'pid']
+
+
+def _to_json(metrics : dict) -> str:
+    # numpy scalars (e.g. SBP, NaN fractions) are not JSON serializable
+    return json.dumps({key: value.item() if hasattr(value, 'item') else value for key, value in metrics.items()})
+
+
+class EventJournal:
+    r"""
+    Append-only journal of what happens to every segment in the pipeline, kept in a SQLite file next to the
+    print-based logs. An event is the outcome of a stage (e.g. fetch, qc, write, preprocess) for a segment,
+    with the reason of a discarded segment, the quality metrics and the timing.
+
+    Events are buffered and written batch_size at a time in a single transaction, so many workers (threads or
+    processes) can write to the same journal without interleaving and without one lock per event.
+    When journal_path is None events are discarded, so workers can log unconditionally.
+
+    Parameters
+    ------------
+
+    journal_path: str,
+        location of the SQLite file, created if it does not exist
+    batch_size: int, default 64,
+        number of buffered events that triggers a write
+    """
+
+    def __init__(self, journal_path : Optional[str], batch_size : int = 64):
+        self.journal_path = journal_path
+        self.batch_size = batch_size
+        self._buffer = []
+        self._lock = threading.Lock()
+        self._connection = None
+
+        if journal_path is not None:
+            self._connection = sqlite3.connect(journal_path, timeout=60, check_same_thread=False)
+            self._connection.executescript(SCHEMA)
+
+    def log(self, segment_id : str, stage : str, outcome : str, reason : Optional[str] = None, metrics : Optional[dict] = None, started_at : Optional[float] = None, duration : Optional[float] = None, flush : bool = False) -> None:
+        r"""
+        Add an event to the journal.
+
+        Parameters
+        ------------
+
+        segment_id: str,
+            the segment in the parent_folder/patient_id/seg_id format
+        stage: str,
+            the stage of the pipeline (e.g. 'fetch', 'qc', 'write', 'preprocess')
+        outcome: str,
+            what happened (e.g. 'started', 'done', 'passed', 'discarded', 'saved', 'removed', 'failed')
+        reason: str, default None,
+            why a segment has been discarded or a stage has failed
+        metrics: dict, default None,
+            quality metrics of the segment (NaN and flat fractions, SBP/DBP, ...)
+        started_at: float, default None,
+            when the stage started (time.time()), now when None
+        duration: float, default None,
+            seconds spent in the stage
+        flush: bool, default False,
+            whether to write the buffered events right away (e.g. to know which segments a killed run was processing)
+
+        Returns
+        ------------
+        None
+        """
+        if self._connection is None:
+            return
+
+        event = (segment_id, stage, outcome, reason, _to_json(metrics) if metrics is not None else None, started_at if started_at is not None else time.time(), duration, os.getpid())
+        with self._lock:
+            self._buffer.append(event)
+            if flush or len(self._buffer) >= self.batch_size:
+                self._write()
+
+    def _write(self) -> None:
+        if self._buffer:
+            with self._connection:
+                self._connection.executemany(f'INSERT INTO events ({", ".join(EVENT_FIELDS)}) VALUES ({", ".join("?" * len(EVENT_FIELDS))})', self._buffer)
+            self._buffer = []
+
+    def flush(self) -> None:
+        if self._connection is not None:
+            with self._lock:
+                self._write()
+
+    def close(self) -> None:
+        if self._connection is not None:
+            self.flush()
+            self._connection.close()
+            self._connection = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _rows_to_events(rows) -> List[dict]:
+    events = []
+    for row in rows:
+        event = dict(zip(['event_id'] + EVENT_FIELDS, row))
+        event['metrics'] = json.loads(event['metrics']) if event['metrics'] is not None else None
+        events.append(event)
+    return events
+
+
+def segment_events(journal_path : str, segment_id : str) -> List[dict]:
+    r"""
+    All the events of a segment, in the order they have been written.
+
+    Parameters
+    ------------
+
+    journal_path: str,
+        location of the SQLite journal
+    segment_id: str,
+        the segment in the parent_folder/patient_id/seg_id format
+
+    Returns
+    ------------
+
+    A list of events, as dictionaries with the columns of the events table
+    """
+    with sqlite3.connect(journal_path, timeout=60) as connection:
+        rows = connection.execute(f'SELECT event_id, {", ".join(EVENT_FIELDS)} FROM events WHERE segment_id = ? ORDER BY event_id', (segment_id,)).fetchall()
+    return _rows_to_events(rows)
+
+
+def segment_state(journal_path : str, segment_id : str) -> Optional[dict]:
+    r"""
+    The last event of a segment (None for a segment never seen), an indexed lookup.
+    """
+    with sqlite3.connect(journal_path, timeout=60) as connection:
+        rows = connection.execute(f'SELECT event_id, {", ".join(EVENT_FIELDS)} FROM events WHERE segment_id = ? ORDER BY event_id DESC LIMIT 1', (segment_id,)).fetchall()
+    events = _rows_to_events(rows)
+    return events[0] if events else None
+
+
+def outcome_counts(journal_path : str) -> Dict[str, Dict[str, int]]:
+    r"""
+    Number of events of every outcome, stage by stage (e.g. {'qc': {'passed': 10, 'discarded': 3}}).
+    """
+    counts = {}
+    with sqlite3.connect(journal_path, timeout=60) as connection:
+        for stage, outcome, count in connection.execute('SELECT stage, outcome, COUNT(*) FROM events GROUP BY stage, outcome ORDER BY stage, outcome'):
+            counts.setdefault(stage, {})[outcome] = count
+    return counts
+
+
+if __name__ == '__main__':
+    # python event_journal.py journal.sqlite [segment_id ...]
+    if len(sys.argv) == 2:
+        for stage, outcomes in outcome_counts(sys.argv[1]).items():
+            print(stage, outcomes)
+    for segment_id in sys.argv[2:]:
+        for event in segment_events(sys.argv[1], segment_id):
+            print(event)
@@ -0,0 +1,250 @@
+import itertools
+import sqlite3
+import time
+from typing import Dict, List
+import numpy as np
+
+
+# One row per segment: the per-segment values the checks compare with the thresholds, and the per-window arrays as blobs
+SCALAR_COLUMNS = ['fs', 'n_samples', 'win_len', 'win_overlap', 'abp_nan_fraction', 'ppg_nan_fraction', 'abp_flat_fraction', 'ppg_flat_fraction', 'abp_min', 'abp_max', 'sbp', 'dbp']
+WINDOW_COLUMNS = ['window_sbp', 'window_dbp', 'window_nan_fraction', 'window_flat_fraction']
+
+# Per-window values are only needed to look at a segment again, single precision is enough
+WINDOW_DTYPE = np.float32
+
+SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS features (
+    segment_id TEXT PRIMARY KEY,
+    {', '.join(f'{column} REAL' for column in SCALAR_COLUMNS)},
+    {', '.join(f'{column} BLOB' for column in WINDOW_COLUMNS)},
+    computed_at REAL NOT NULL
+);
+"""
+
+
+def qc_status(abp_nan_fraction, ppg_nan_fraction, abp_flat_fraction, ppg_flat_fraction, sbp, dbp, valid_bp_ranges : dict, thresholds : dict, abp_min=None, abp_max=None) -> np.array:
+    r"""
+    Outcome of the quality checks of the download, for one segment or for arrays of segments at once. Checks are
+    applied in order, as in check_segment: NaNs, then flat parts, then the average SBP/DBP of the windows. When abp_min and
+    abp_max are given, also the check of the preprocessing (min/max of the interpolated ABP in the BP ranges) is applied.
+
+    Parameters
+    ------------
+
+    abp_nan_fraction, ppg_nan_fraction: float or np.array,
+        fraction of NaNs of the signals
+    abp_flat_fraction, ppg_flat_fraction: float or np.array,
+        fraction of flat parts of the interpolated signals
+    sbp, dbp: float or np.array,
+        average SBP/DBP of the windows
+    valid_bp_ranges: dict,
+        the upper and lower valid values for systolic and diastolic blood pressure
+    thresholds: dict,
+        contains the permitted % of anomalies in the signals (NaNs and flat parts)
+    abp_min, abp_max: float or np.array, default None,
+        min/max of the interpolated ABP
+
+    Returns
+    ------------
+
+    An array of strings: 'valid', or the first check failed ('nans', 'flat', 'abp' or 'range')
+    """
+    conditions = [
+        ~((np.asarray(abp_nan_fraction) <= thresholds['nans_th']) & (np.asarray(ppg_nan_fraction) < thresholds['nans_th'])),
+        ~((np.asarray(abp_flat_fraction) <= thresholds['flat_th']) & (np.asarray(ppg_flat_fraction) < thresholds['flat_th'])),
+        ~((np.asarray(sbp) >= valid_bp_ranges['low_sbp']) & (np.asarray(sbp) <= valid_bp_ranges['up_sbp']) & (np.asarray(dbp) >= valid_bp_ranges['low_dbp']) & (np.asarray(dbp) <= valid_bp_ranges['up_dbp'])),
+    ]
+    choices = ['nans', 'flat', 'abp']
+
+    if abp_min is not None and abp_max is not None:
+        conditions.append(~((np.asarray(abp_max) >= valid_bp_ranges['low_sbp']) & (np.asarray(abp_max) <= valid_bp_ranges['up_sbp']) & (np.asarray(abp_min) >= valid_bp_ranges['low_dbp']) & (np.asarray(abp_min) <= valid_bp_ranges['up_dbp'])))
+        choices.append('range')
+
+    return np.select(conditions, choices, default='valid')
+
+
+class FeatureTable:
+    r"""
+    SQLite table with the quality features of every checked segment, accepted or rejected: NaN and flat fractions,
+    min/max of the interpolated ABP, average SBP/DBP, and the per-window SBP, DBP, NaN and flat fractions.
+    With the table, other thresholds or BP ranges are a vectorised filter over its columns (see filter_segments)
+    instead of downloading and checking the signals again. The per-window arrays depend on the windowing parameters,
+    which are kept in the table too.
+
+    Parameters
+    ------------
+
+    table_path: str,
+        location of the SQLite file, created if it does not exist
+    """
+
+    def __init__(self, table_path : str):
+        self.table_path = table_path
+        self._connection = sqlite3.connect(table_path, timeout=60)
+        self._connection.executescript(SCHEMA)
+
+    def add(self, segment_id : str, features : dict) -> None:
+        r"""
+        Add (or replace) the features of a segment, as computed by data_preprocessing.compute_segment_features.
+        """
+        scalars = [float(features[column]) for column in SCALAR_COLUMNS]
+        windows = [np.ascontiguousarray(features[column], dtype=WINDOW_DTYPE).tobytes() for column in WINDOW_COLUMNS]
+
+        with self._connection:
+            self._connection.execute(f'INSERT OR REPLACE INTO features VALUES ({", ".join("?" * (len(SCALAR_COLUMNS) + len(WINDOW_COLUMNS) + 2))})', [segment_id] + scalars + windows + [time.time()])
+
+    def columns(self) -> Dict[str, np.array]:
+        r"""
+        The per-segment columns as arrays (segment_id included), ordered by segment_id.
+        """
+        rows = self._connection.execute(f'SELECT segment_id, {", ".join(SCALAR_COLUMNS)} FROM features ORDER BY segment_id').fetchall()
+
+        columns = {'segment_id': np.array([row[0] for row in rows], dtype=object)}
+        values = np.array([row[1:] for row in rows], dtype=np.float64).reshape(len(rows), len(SCALAR_COLUMNS))
+        for i, column in enumerate(SCALAR_COLUMNS):
+            columns[column] = values[:, i]
+        return columns
+
+    def windows(self, segment_id : str) -> Dict[str, np.array]:
+        r"""
+        The per-window SBP and DBP (one value per window) and NaN and flat fractions (ABP and PLETH rows) of a segment.
+        """
+        row = self._connection.execute(f'SELECT {", ".join(WINDOW_COLUMNS)} FROM features WHERE segment_id = ?', (segment_id,)).fetchone()
+        if row is None:
+            raise KeyError(segment_id)
+
+        windows = {column: np.frombuffer(blob, dtype=WINDOW_DTYPE) for column, blob in zip(WINDOW_COLUMNS, row)}
+        windows['window_nan_fraction'] = windows['window_nan_fraction'].reshape(2, -1)
+        windows['window_flat_fraction'] = windows['window_flat_fraction'].reshape(2, -1)
+        return windows
+
+    def __contains__(self, segment_id : str) -> bool:
+        return self._connection.execute('SELECT 1 FROM features WHERE segment_id = ?', (segment_id,)).fetchone() is not None
+
+    def __len__(self) -> int:
+        return self._connection.execute('SELECT COUNT(*) FROM features').fetchone()[0]
+
+    def close(self) -> None:
+        self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def filter_segments(table_path : str, valid_bp_ranges : dict, thresholds : dict, check_range : bool = False) -> Dict[str, List[str]]:
+    r"""
+    Apply the quality checks to all the segments of a feature table at once.
+
+    Parameters
+    ------------
+
+    table_path: str,
+        location of the SQLite feature table
+    valid_bp_ranges: dict,
+        the upper and lower valid values for systolic and diastolic blood pressure
+    thresholds: dict,
+        contains the permitted % of anomalies in the signals (NaNs and flat parts)
+    check_range: bool, default False,
+        whether to apply also the check of the preprocessing on min/max of the interpolated ABP
+
+    Returns
+    ------------
+
+    A dictionary from the outcome ('valid', 'nans', 'flat', 'abp', 'range') to the list of its segments
+    """
+    with FeatureTable(table_path) as table:
+        columns = table.columns()
+
+    status = qc_status(columns['abp_nan_fraction'], columns['ppg_nan_fraction'], columns['abp_flat_fraction'], columns['ppg_flat_fraction'], columns['sbp'], columns['dbp'], valid_bp_ranges, thresholds,
+                       columns['abp_min'] if check_range else None, columns['abp_max'] if check_range else None)
+
+    return {outcome: list(columns['segment_id'][status == outcome]) for outcome in ['valid', 'nans', 'flat', 'abp', 'range']}
+
+
+def save_filtered_segments(table_path : str, database_name : str, valid_bp_ranges : dict, thresholds : dict, output_file : str, check_range : bool = False) -> str:
+    r"""
+    Write the segments of a feature table passing the quality checks in a txt file, with the database name on the first line
+    as the valid segments file, so that it can be read by count_patients_and_records.
+
+    Parameters
+    ------------
+
+    table_path: str,
+        location of the SQLite feature table
+    database_name: str,
+        the name of the dataset, written on the first line
+    valid_bp_ranges: dict,
+        the upper and lower valid values for systolic and diastolic blood pressure
+    thresholds: dict,
+        contains the permitted % of anomalies in the signals (NaNs and flat parts)
+    output_file: str,
+        where to write the segments
+    check_range: bool, default False,
+        whether to apply also the check of the preprocessing on min/max of the interpolated ABP
+
+    Returns
+    ------------
+
+    The path of the txt file
+    """
+    segments = filter_segments(table_path, valid_bp_ranges, thresholds, check_range)
+
+    with open(output_file, 'w') as f:
+        f.write(f"{database_name}\n")
+        for segment in segments['valid']:
+            f.write(f"{segment}\n")
+
+    return output_file
+
+
+def sweep_thresholds(table_path : str, nans_ths : List[float], flat_ths : List[float], valid_bp_ranges_list : List[dict], check_range : bool = False) -> List[dict]:
+    r"""
+    Evaluate every combination of NaN threshold, flat threshold and BP ranges on the features of a table, read once.
+    Each configuration is a vectorised qc_status over all the segments, the signals are never read again.
+
+    Parameters
+    ------------
+
+    table_path: str,
+        location of the SQLite feature table
+    nans_ths: list,
+        the values of nans_th to try
+    flat_ths: list,
+        the values of flat_th to try
+    valid_bp_ranges_list: list,
+        the BP ranges to try, dictionaries with the upper and lower valid values for systolic and diastolic blood pressure
+    check_range: bool, default False,
+        whether to apply also the check of the preprocessing on min/max of the interpolated ABP
+
+    Returns
+    ------------
+
+    A list with a dictionary per configuration: thresholds, valid_bp_ranges, num_patients, num_records and
+    the number of segments of every outcome (in outcomes)
+    """
+    with FeatureTable(table_path) as table:
+        columns = table.columns()
+
+    # Patients as integer codes, so that the patients of a configuration are counted with a bincount
+    _, patient_codes = np.unique([segment_id.split('/')[1] for segment_id in columns['segment_id']], return_inverse=True)
+    n_patients = int(patient_codes.max()) + 1 if len(patient_codes) else 0
+
+    results = []
+    for nans_th, flat_th, valid_bp_ranges in itertools.product(nans_ths, flat_ths, valid_bp_ranges_list):
+        thresholds = {'nans_th': nans_th, 'flat_th': flat_th}
+        status = qc_status(columns['abp_nan_fraction'], columns['ppg_nan_fraction'], columns['abp_flat_fraction'], columns['ppg_flat_fraction'], columns['sbp'], columns['dbp'], valid_bp_ranges, thresholds,
+                           columns['abp_min'] if check_range else None, columns['abp_max'] if check_range else None)
+        valid = status == 'valid'
+
+        results.append({
+            'thresholds': thresholds,
+            'valid_bp_ranges': valid_bp_ranges,
+            'num_patients': int(np.count_nonzero(np.bincount(patient_codes[valid], minlength=n_patients))),
+            'num_records': int(np.count_nonzero(valid)),
+            'outcomes': {outcome: int(np.count_nonzero(status == outcome)) for outcome in ['valid', 'nans', 'flat', 'abp', 'range']},
+        })
+
+    return results
@@ -0,0 +1,273 @@
+import json
+import sqlite3
+import time
+from typing import List, Optional, Tuple
+from joblib import Parallel, delayed
+import multiprocessing
+from wfdb_source import get_record_list, rdheader
+from provisioning_engine import crawl_subjects
+from sharding import in_shard
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS headers (
+    record_key TEXT PRIMARY KEY,
+    database_name TEXT NOT NULL,
+    subject TEXT NOT NULL,
+    file TEXT NOT NULL,
+    subject_idx INTEGER NOT NULL,
+    file_idx INTEGER NOT NULL,
+    found INTEGER NOT NULL,
+    fs REAL,
+    sig_len INTEGER,
+    base_time TEXT,
+    base_date TEXT,
+    sig_name TEXT,
+    units TEXT,
+    indexed_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS header_signals (
+    record_key TEXT NOT NULL,
+    sig_name TEXT NOT NULL,
+    PRIMARY KEY (record_key, sig_name)
+);
+CREATE INDEX IF NOT EXISTS header_signals_by_name ON header_signals (sig_name, record_key);
+CREATE INDEX IF NOT EXISTS headers_by_order ON headers (database_name, subject_idx, file_idx);
+CREATE TABLE IF NOT EXISTS subjects (
+    database_name TEXT NOT NULL,
+    subject TEXT NOT NULL,
+    subject_idx INTEGER NOT NULL,
+    n_files INTEGER NOT NULL,
+    indexed_at REAL NOT NULL,
+    PRIMARY KEY (database_name, subject)
+);
+"""
+
+
+def open_header_index(index_path : str) -> sqlite3.Connection:
+    r"""
+    Open (and create, if needed) the SQLite header index.
+
+    Parameters
+    ------------
+
+    index_path: str,
+        location of the SQLite file
+
+    Returns
+    ------------
+
+    An open sqlite3 connection
+    """
+    connection = sqlite3.connect(index_path, timeout=60)
+    connection.executescript(SCHEMA)
+    return connection
+
+
+def header_worker_function(subject_file : str, database_name : str, subject : str, subject_id : str, local_dir : Optional[str] = None) -> Optional[dict]:
+    r"""
+    A thead wil spawn executing the code of this function, that consist in reading the header of a file
+    of a subject and returning all the fields the index keeps. Files that are not waveforms are skipped.
+
+    Parameters
+    ------------
+
+    subject_file: string,
+        the file to be analyzed
+    database_name: string,
+        the name of the dataset, it will be used to build the file path
+    subject: string,
+        path identifying the subject inside the dataset
+    subject_id: string,
+        last part of the subject variable
+    local_dir: str, default None,
+        root directory of a local mirror of database_name, when None PhysioNet is queried
+
+    Returns
+    ------------
+    A dictionary with the header fields (found is False when the header could not be read) or None for skipped files
+    """
+
+    # In the MIMIC III Matched Subset files starting with the subject_id are not waveforms
+    if subject_file.startswith(subject_id):
+        return None
+
+    header = {'file': subject_file, 'found': False, 'fs': None, 'sig_len': None, 'base_time': None, 'base_date': None, 'sig_name': [], 'units': []}
+
+    try:
+        segment_header = rdheader(subject_file, database_name, subject, local_dir)
+    except:
+        print(f'No file found for {database_name}/{subject}/{subject_file}', flush=True)
+        return header
+
+    header['found'] = True
+    header['fs'] = segment_header.fs
+    header['sig_len'] = segment_header.sig_len
+    header['base_time'] = None if segment_header.base_time is None else str(segment_header.base_time)
+    header['base_date'] = None if segment_header.base_date is None else str(segment_header.base_date)
+    # Multi-segment headers do not list their signals unless the segments are read as well
+    header['sig_name'] = list(segment_header.sig_name or [])
+    header['units'] = list(getattr(segment_header, 'units', None) or [])
+
+    return header
+
+
+def store_subject_headers(connection : sqlite3.Connection, database_name : str, subject : str, subject_idx : int, files : List[str], headers : List[dict]) -> None:
+    r"""
+    Write the headers of a subject, and mark the subject as indexed, in a single transaction.
+    A subject is therefore either fully indexed or not indexed at all, even if the crawl is interrupted.
+
+    Parameters
+    ------------
+
+    connection: sqlite3.Connection,
+        the open header index
+    database_name: str,
+        the name of the dataset
+    subject: str,
+        path identifying the subject inside the dataset
+    subject_idx: int,
+        position of the subject in the database RECORDS file, used to keep the original ordering
+    files: list,
+        all the files listed for the subject
+    headers: list,
+        the headers (as returned by header_worker_function) to store, None entries are ignored
+
+    Returns
+    ------------
+    None
+    """
+    now = time.time()
+    file_idx = {subject_file: i for i, subject_file in enumerate(files)}
+
+    with connection:
+        for header in headers:
+            if header is None:
+                continue
+
+            record_key = f"{database_name}/{subject}{header['file']}"
+            connection.execute('DELETE FROM header_signals WHERE record_key = ?', (record_key,))
+            connection.execute(
+                'INSERT OR REPLACE INTO headers VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (record_key, database_name, subject, header['file'], subject_idx, file_idx[header['file']], int(header['found']),
+                 header['fs'], header['sig_len'], header['base_time'], header['base_date'],
+                 json.dumps(header['sig_name']), json.dumps(header['units']), now)
+            )
+            connection.executemany('INSERT OR IGNORE INTO header_signals VALUES (?, ?)', [(record_key, name) for name in header['sig_name']])
+
+        connection.execute('INSERT OR REPLACE INTO subjects VALUES (?, ?, ?, ?, ?)', (database_name, subject, subject_idx, len(files), now))
+
+
+def update_header_index(database_name : str, index_path : str, local_dir : Optional[str] = None, refresh : bool = False, n_cores : int = 1, engine : str = 'queue', shard : Optional[Tuple[int, int]] = None) -> int:
+    r"""
+    Crawl the database and store every header read in the index. The update is incremental:
+    subjects that have already been indexed are skipped, unless refresh is set. In that case their
+    file list is read again, and only headers of files never seen before (or that were not found) are fetched.
+
+    Parameters
+    ------------
+
+    database_name: str,
+        the name of the dataset, it will be used to build the file path
+    index_path: str,
+        location of the SQLite index file
+    local_dir: str, default None,
+        root directory of a local mirror of database_name, when None PhysioNet is queried
+    refresh: bool, default False,
+        whether to look for new files in subjects that have already been indexed
+    n_cores: int, default 1,
+        number of parallel cores to use
+    engine: str, default 'queue',
+        'queue' for a single work queue over all the subjects' files, 'loop' for one parallel call per subject
+    shard: tuple, default None,
+        (i, N) to crawl only the subjects of the i-th of N shards (see sharding.py)
+
+    Returns
+    ------------
+
+    The number of headers read during the update
+    """
+    connection = open_header_index(index_path)
+
+    subjects = get_record_list(database_name, local_dir=local_dir)
+    indexed_subjects = {row[0] for row in connection.execute('SELECT subject FROM subjects WHERE database_name = ?', (database_name,))}
+    print(f"The '{database_name}' database contains data from {len(subjects)} subjects, {len(indexed_subjects)} already indexed")
+
+    # Parallel cores
+    num_cores = multiprocessing.cpu_count()
+    used_cores = n_cores
+    print(f'Using {used_cores}/{num_cores} cores')
+
+    # Subjects keep their position in the database when only a shard is crawled
+    subjects_to_crawl = [(subject_idx, subject) for subject_idx, subject in enumerate(subjects) if (subject not in indexed_subjects or refresh) and in_shard(subject, shard)]
+
+    # Only files never seen before, or whose header could not be read, are fetched again
+    known_files = {}
+    if refresh:
+        for subject, subject_file in connection.execute('SELECT subject, file FROM headers WHERE database_name = ? AND found = 1', (database_name,)):
+            known_files.setdefault(subject, set()).add(subject_file)
+
+    n_read = 0
+    if engine == 'queue':
+        for subject_idx, subject, files, headers in crawl_subjects(database_name, subjects_to_crawl, header_worker_function, (local_dir,), n_cores=used_cores, local_dir=local_dir, exclude=known_files):
+            store_subject_headers(connection, database_name, subject, subject_idx, files, headers)
+            n_read += sum(header is not None for header in headers)
+    else:
+        for subject_idx, subject in subjects_to_crawl:
+            files = get_record_list(database_name, subject, local_dir)
+            subject_id = subject.split('/')[1]
+            files_to_read = [subject_file for subject_file in files if subject_file not in known_files.get(subject, set())]
+
+            headers = Parallel(n_jobs=used_cores)(delayed(header_worker_function)(subject_file, database_name, subject, subject_id, local_dir) for subject_file in files_to_read)
+            store_subject_headers(connection, database_name, subject, subject_idx, files, headers)
+            n_read += sum(header is not None for header in headers)
+
+            if (subject_idx + 1) % 1000 == 0:
+                print(f'Subjects processed {subject_idx + 1}/{len(subjects)}')
+
+    connection.close()
+    print(f'Read {n_read} headers into {index_path}')
+
+    return n_read
+
+
+def query_valid_segments(index_path : str, database_name : str, required_signals : set, min_duration : int) -> List[str]:
+    r"""
+    Local query over the header index returning the segments that contain the required signals and that are long enough.
+    It gives the same answer of data_provisioning.worker_function, in the same order, without any network access.
+
+    Parameters
+    ------------
+
+    index_path: str,
+        location of the SQLite index file
+    database_name: str,
+        the name of the dataset
+    required_signals: set,
+        which signals (arterial blood pressure, photoplethysmography, etc.) to look for
+    min_duration: int,
+        minimum duration of a segment in minutes
+
+    Returns
+    ------------
+
+    The list of valid segments in the parent_directory/patient_id/segment format
+    """
+    connection = open_header_index(index_path)
+    required_signals = sorted(required_signals)
+    placeholders = ', '.join('?' * len(required_signals))
+
+    rows = connection.execute(
+        f"""
+        SELECT h.subject, h.file FROM headers h
+        JOIN header_signals s ON s.record_key = h.record_key
+        WHERE h.database_name = ? AND h.found = 1 AND CAST(h.sig_len AS REAL) / (h.fs * 60) >= ? AND s.sig_name IN ({placeholders})
+        GROUP BY h.record_key
+        HAVING COUNT(DISTINCT s.sig_name) = ?
+        ORDER BY h.subject_idx, h.file_idx
+        """,
+        (database_name, min_duration, *required_signals, len(required_signals))
+    ).fetchall()
+    connection.close()
+
+    return [f'{subject}{subject_file}' for subject, subject_file in rows]
@@ -0,0 +1,312 @@
+import atexit
+import glob
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from functools import wraps
+from typing import Callable, Optional
+
+try:
+    import resource
+except ImportError:
+    # Windows
+    resource = None
+
+
+# Workers (joblib, ProcessPoolExecutor) inherit the environment, so the instrumentation is turned on for all of them at once
+METRICS_DIR_VARIABLE = 'MIMIC_METRICS_DIR'
+
+_NULL_CONTEXT = nullcontext()
+
+
+class Recorder:
+    r"""
+    Metrics of one process: wall time of every step (count, total and max seconds), bytes fetched and written,
+    counters (e.g. segments) and peak RSS. They are written in metrics_dir/metrics_<pid>.json, one file per
+    worker, which summarize aggregates. Updates are thread-safe (the pipeline stages are threads).
+
+    Parameters
+    ------------
+
+    metrics_dir: str,
+        directory of the metrics files
+    """
+
+    def __init__(self, metrics_dir : str):
+        self.metrics_dir = metrics_dir
+        self.pid = os.getpid()
+        self.started_at = time.time()
+        self.steps = {}
+        self.bytes = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    def add_time(self, name : str, seconds : float) -> None:
+        with self._lock:
+            step = self.steps.setdefault(name, [0, 0.0, 0.0])
+            step[0] += 1
+            step[1] += seconds
+            step[2] = max(step[2], seconds)
+
+    def add_bytes(self, kind : str, n_bytes : int) -> None:
+        with self._lock:
+            self.bytes[kind] = self.bytes.get(kind, 0) + int(n_bytes)
+
+    def count(self, name : str, n : int = 1) -> None:
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def flush(self) -> None:
+        # Workers of joblib stay alive between calls, so the file is written after every call and not only at exit
+        now = time.time()
+        with self._lock:
+            metrics = {'pid': self.pid, 'started_at': self.started_at, 'updated_at': now, 'peak_rss_mb': peak_rss_mb(),
+                       'steps': {name: {'count': count, 'seconds': total, 'max_seconds': longest} for name, (count, total, longest) in self.steps.items()},
+                       'bytes': dict(self.bytes), 'counters': dict(self.counters)}
+
+        path = os.path.join(self.metrics_dir, f'metrics_{self.pid}.json')
+        with open(f'{path}.tmp', 'w') as f:
+            json.dump(metrics, f)
+        os.replace(f'{path}.tmp', path)
+
+
+_recorder = None
+
+
+def peak_rss_mb() -> Optional[float]:
+    r"""
+    Peak resident memory of the current process in MB (None where the resource module is not available).
+    """
+    if resource is None:
+        return None
+    # kB on Linux, bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2**20 if os.uname().sysname == 'Darwin' else peak / 2**10
+
+
+def enable(metrics_dir : str) -> None:
+    r"""
+    Turn the instrumentation on for this process and for the workers started from now on.
+    """
+    os.makedirs(metrics_dir, exist_ok=True)
+    os.environ[METRICS_DIR_VARIABLE] = os.path.abspath(metrics_dir)
+
+
+def get_recorder() -> Optional[Recorder]:
+    r"""
+    The Recorder of the current process, None when the instrumentation is off. A forked worker gets its own.
+    """
+    global _recorder
+    if _recorder is not None and _recorder.pid == os.getpid():
+        return _recorder
+
+    metrics_dir = os.environ.get(METRICS_DIR_VARIABLE)
+    if not metrics_dir:
+        return None
+
+    _recorder = Recorder(metrics_dir)
+    atexit.register(_recorder.flush)
+    return _recorder
+
+
+def step(name : str):
+    r"""
+    Context manager timing a step (e.g. with step('download.interpolate'): ...), a shared no-op when the instrumentation is off.
+    """
+    recorder = get_recorder()
+    if recorder is None:
+        return _NULL_CONTEXT
+    return _timed_step(recorder, name)
+
+
+@contextmanager
+def _timed_step(recorder : Recorder, name : str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        recorder.add_time(name, time.perf_counter() - start)
+
+
+def add_bytes(kind : str, n_bytes : int) -> None:
+    r"""
+    Count bytes of a kind ('fetched' or 'written').
+    """
+    recorder = get_recorder()
+    if recorder is not None:
+        recorder.add_bytes(kind, n_bytes)
+
+
+def count(name : str, n : int = 1) -> None:
+    r"""
+    Increment a counter (e.g. 'segments').
+    """
+    recorder = get_recorder()
+    if recorder is not None:
+        recorder.count(name, n)
+
+
+def flush() -> None:
+    r"""
+    Write the metrics file of the current process now (e.g. from the threads of the pipeline, which are not instrumented calls).
+    """
+    recorder = get_recorder()
+    if recorder is not None:
+        recorder.flush()
+
+
+def instrumented(name : str, counter : Optional[str] = None) -> Callable:
+    r"""
+    Decorator of a worker function: the whole call is timed as the step name, counter (if given) is incremented
+    once per call, and the metrics file of the worker is written at the end of the call.
+    When the instrumentation is off, the function is called as it is.
+    """
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            recorder = get_recorder()
+            if recorder is None:
+                return function(*args, **kwargs)
+
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                recorder.add_time(name, time.perf_counter() - start)
+                if counter is not None:
+                    recorder.count(counter)
+                recorder.flush()
+        return wrapper
+    return decorator
+
+
+def summarize(metrics_dir : str) -> dict:
+    r"""
+    Aggregate the metrics files of all the workers of a run.
+
+    Parameters
+    ------------
+
+    metrics_dir: str,
+        directory of the metrics files
+
+    Returns
+    ------------
+
+    A dictionary with the wall time of the run, the steps (count, total and max seconds, share of the worker function),
+    the bytes, the counters with their rate per second of wall time, and the peak RSS of every worker
+    """
+    workers = []
+    for path in glob.glob(os.path.join(metrics_dir, 'metrics_*.json')):
+        try:
+            with open(path, 'r') as f:
+                workers.append(json.load(f))
+        except (OSError, json.JSONDecodeError):
+            # Being replaced by its worker
+            continue
+
+    steps, n_bytes, counters = {}, {}, {}
+    for worker in workers:
+        for name, values in worker['steps'].items():
+            step_summary = steps.setdefault(name, {'count': 0, 'seconds': 0.0, 'max_seconds': 0.0})
+            step_summary['count'] += values['count']
+            step_summary['seconds'] += values['seconds']
+            step_summary['max_seconds'] = max(step_summary['max_seconds'], values['max_seconds'])
+        for kind, value in worker['bytes'].items():
+            n_bytes[kind] = n_bytes.get(kind, 0) + value
+        for name, value in worker['counters'].items():
+            counters[name] = counters.get(name, 0) + value
+
+    wall = max(worker['updated_at'] for worker in workers) - min(worker['started_at'] for worker in workers) if workers else 0.0
+    # Sub-steps (download.fetch) as a share of the time of their worker function (download)
+    for name, values in steps.items():
+        parent = steps.get(name.rsplit('.', 1)[0]) if '.' in name else None
+        values['share'] = values['seconds'] / parent['seconds'] if parent is not None and parent['seconds'] > 0 else None
+
+    rss = [worker['peak_rss_mb'] for worker in workers if worker['peak_rss_mb'] is not None]
+    return {
+        'wall_seconds': wall,
+        'n_workers': len(workers),
+        'steps': dict(sorted(steps.items())),
+        'bytes': n_bytes,
+        'counters': {name: {'count': value, 'per_second': value / wall if wall > 0 else None} for name, value in counters.items()},
+        'peak_rss_mb': {'max': max(rss) if rss else None, 'workers': {worker['pid']: worker['peak_rss_mb'] for worker in workers}},
+    }
+
+
+def print_summary(summary : dict) -> None:
+    print(f'Run of {summary["wall_seconds"]:.1f}s over {summary["n_workers"]} workers', flush=True)
+    for name, values in summary['steps'].items():
+        share = f' ({values["share"]:.1%})' if values['share'] is not None else ''
+        print(f'  {name:<28} {values["count"]:>8} calls {values["seconds"]:>10.2f}s{share}, max {values["max_seconds"]:.2f}s', flush=True)
+    for kind, value in summary['bytes'].items():
+        print(f'  {kind} {value / 2**20:.1f} MB', flush=True)
+    for name, values in summary['counters'].items():
+        rate = f'{values["per_second"]:.2f}/s' if values['per_second'] is not None else '-'
+        print(f'  {name} {values["count"]} ({rate})', flush=True)
+    if summary['peak_rss_mb']['max'] is not None:
+        print(f'  peak RSS {summary["peak_rss_mb"]["max"]:.0f} MB (largest worker)', flush=True)
+
+
+class MetricsReporter:
+    r"""
+    Thread of the main process that aggregates the metrics of the workers every interval seconds in
+    metrics_dir/summary.json, so a running job can be watched, and prints the final summary when stopped.
+
+    Parameters
+    ------------
+
+    metrics_dir: str,
+        directory of the metrics files, the instrumentation is enabled on it
+    interval: float, default 30,
+        seconds between two updates of summary.json
+    """
+
+    def __init__(self, metrics_dir : str, interval : float = 30):
+        self.metrics_dir = metrics_dir
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+        # Metrics files of a previous run would be aggregated with the new ones
+        os.makedirs(metrics_dir, exist_ok=True)
+        for path in glob.glob(os.path.join(metrics_dir, 'metrics_*.json')):
+            os.remove(path)
+        enable(metrics_dir)
+
+    def _write_summary(self) -> dict:
+        summary = summarize(self.metrics_dir)
+        with open(os.path.join(self.metrics_dir, 'summary.json.tmp'), 'w') as f:
+            json.dump(summary, f, indent=2)
+        os.replace(os.path.join(self.metrics_dir, 'summary.json.tmp'), os.path.join(self.metrics_dir, 'summary.json'))
+        return summary
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            self._write_summary()
+
+    def start(self) -> 'MetricsReporter':
+        # The metrics file of the main process marks the start of the run
+        get_recorder().flush()
+        self._thread.start()
+        return self
+
+    def stop(self) -> dict:
+        if self._stop.is_set():
+            return summarize(self.metrics_dir)
+
+        self._stop.set()
+        recorder = get_recorder()
+        if recorder is not None:
+            recorder.flush()
+        summary = self._write_summary()
+        print_summary(summary)
+        return summary
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
@@ -1,76 +1,397 @@
 import os
+import sys
+import glob
+import atexit
 import argparse
-from data_provisioning import valid_segments_retrieval
-from data_preprocessing import count_patients_and_records, download_mimic_iii_records, preprocess_mimic_iii_records
+from typing import List, Optional
+from stage_graph import Stage, StageGraph
+from segment_catalog import SegmentCatalog, read_segments_txt
 
+# Modules reading signals (wfdb, scipy, joblib, matplotlib) are imported by the stages that need them,
+# so status and count do not load them
 
-if __name__ == '__main__':
 
+# Look for segments of patients with these signals recorded simultaneously
+# These acronyms match the dataset format, so beware in changing them
+REQUIRED_SIGNALS = set({'ABP', 'PLETH'})
+
+# Ranges decided empirically by looking at papers
+VALID_BP_RANGES = {
+    'up_sbp' : 220.0,
+    'low_sbp' : 60.0,
+    'up_dbp' : 140.0,
+    'low_dbp' : 30.0,
+}
+
+# Threshold taken from Non-invasive arterial blood pressure measurement and SpO2 estimation using PPG signal: a deep learning framework
+THRESHOLDS = {
+    'nans_th' : 0.05,
+    'flat_th' : 0.05,
+}
+
+WINDOWING_PARAM = {
+    'win_len' : 20, # Parameters choose after Non-invasive arterial blood pressure measurement and SpO2 estimation using PPG signal: a deep learning framework
+    'win_overlap' : 0.5, # Parameter as in https://github.com/Fabian-Sc85/non-invasive-bp-estimation-using-deep-learning/blob/main/prepare_MIMIC_dataset.py
+}
+
+# Subcommands running a stage of the graph, in dependency order
+STAGES = ['provision', 'download', 'filter', 'preprocess', 'visualize', 'export', 'spectral']
+
+
+def parse_arguments() -> argparse.Namespace:
     parser = argparse.ArgumentParser(description='Continual Learning for Physiological Signals Analysis Benchmark')
-    
+
+    common = argparse.ArgumentParser(add_help=False)
     # Backup dir
-    parser.add_argument('--output_dir', nargs='?', type=str, help='location of the txt files produced during the pipeline', default='./output')
-    # Output file name
-    parser.add_argument('--output_file_name', nargs='?', type=str, help='name of the txt files that will be saved in the backup directory', default='valid_segments.txt')
+    common.add_argument('--output_dir', nargs='?', type=str, help='location of the txt files produced during the pipeline', default='./output')
     # MIMIC database name inside Physionet
-    parser.add_argument('--database_name', nargs='?', type=str, help='the name of the database to process', default='mimic3wdb-matched/1.0')
+    common.add_argument('--database_name', nargs='?', type=str, help='the name of the database to process', default='mimic3wdb-matched/1.0')
+    common.add_argument('--catalog', nargs='?', type=str, help='location of the SQLite catalog with the patient, duration, sampling frequency, channels and status of every segment, output_dir/segments.sqlite by default', default=None)
+    common.add_argument('--shard', nargs='?', type=str, help="process only the patients of shard i of N (e.g. 0/4), in output_dir/shard_i_of_N, to split a run across hosts", default=None)
+
+    pipeline = argparse.ArgumentParser(add_help=False)
+    # Output file name
+    pipeline.add_argument('--output_file_name', nargs='?', type=str, help='name of the txt files that will be saved in the backup directory', default='valid_segments.txt')
     # Minimum segment duration (min)
-    parser.add_argument('--min_duration', nargs='?', type=int, help='minimum signals duration in minutes', default=8)
+    pipeline.add_argument('--min_duration', nargs='?', type=int, help='minimum signals duration in minutes', default=8)
     # NUmber of parallel cores to use
-    parser.add_argument('--n_cores', nargs='?', type=int, help='number of parallel cores to use', default=12)
-    
-    args = parser.parse_args()
+    pipeline.add_argument('--n_cores', nargs='?', type=int, help='number of parallel cores to use', default=12)
+    pipeline.add_argument('--force', action='store_true', help='run the stage of the subcommand even if it is up to date (the stages before it are still skipped when up to date)')
 
-    if not os.path.exists(args.output_dir):
-        os.makedirs(args.output_dir)
+    provision = pipeline.add_argument_group('provision')
+    # SQLite index where every header read during the data provisioning is kept
+    provision.add_argument('--header_index', nargs='?', type=str, help='location of the SQLite header index, when given the valid segments are queried from it (crawling only what is not indexed yet)', default=None)
+    # Local copy of the database, to avoid querying Physionet
+    provision.add_argument('--local_mirror', nargs='?', type=str, help='root directory of a local WFDB mirror of the database', default=None)
+    # Look for new files of already indexed subjects
+    provision.add_argument('--refresh_index', action='store_true', help='look for new files in subjects that are already in the header index')
+    # How headers are scanned during the data provisioning
+    provision.add_argument('--provisioning_engine', nargs='?', type=str, choices=['queue', 'loop'], help="'queue' uses a single work queue for all the files, 'loop' one parallel call per subject", default='queue')
+    # Already available list of valid segments
+    provision.add_argument('--valid_segments_file', nargs='?', type=str, help='txt file with the valid segments, when given the data provisioning is skipped (e.g. ./output/valid_segments_pleth_abp_8m.txt)', default=None)
+    # Asynchronous fetch of the database files
+    provision.add_argument('--async_mirror', nargs='?', type=str, help='directory where header and signal files are fetched asynchronously before being processed', default=None)
+    provision.add_argument('--max_in_flight', nargs='?', type=int, help='maximum number of concurrent requests of the asynchronous fetch', default=256)
 
-    output_file = os.path.join(args.output_dir, args.output_file_name)
+    download = pipeline.add_argument_group('download')
+    download.add_argument('--downloaded_segments_file', nargs='?', type=str, help='txt file with the segments downloaded outside of main.py (e.g. by download_utils), when given the download is skipped (e.g. ./output/downloaded_segments.txt)', default=None)
+    download.add_argument('--segment_store', nargs='?', type=str, help='directory of a segment store where signals are appended (one data file per patient group) instead of one directory per segment', default=None)
+    download.add_argument('--pipeline', action='store_true', help='download with separate fetch, quality checks and write stages connected by bounded queues')
+    download.add_argument('--n_fetch', nargs='?', type=int, help='number of segments fetched at the same time by the pipeline', default=16)
+    download.add_argument('--n_qc', nargs='?', type=int, help='number of processes running the quality checks in the pipeline', default=12)
+    download.add_argument('--queue_size', nargs='?', type=int, help='maximum number of segments waiting between two stages of the pipeline', default=32)
+    download.add_argument('--event_journal', nargs='?', type=str, help='location of the SQLite journal where the outcome of every subject (provision) and segment (download, preprocess, visualize) is recorded (e.g. ./output/logs/events.sqlite)', default=None)
+    download.add_argument('--feature_table', nargs='?', type=str, help='location of the SQLite table with the quality features of every checked segment, when it exists the downloaded segments are filtered from it (e.g. ./output/features.sqlite)', default=None)
 
-    # Look for segments of patients with these signals recorded simultaneously
-    # These acronyms match the dataset format, so beware in changing them
-    required_signals = set({'ABP', 'PLETH'})
+    preprocess = pipeline.add_argument_group('preprocess')
+    preprocess.add_argument('--preprocess_from_zip', action='store_true', help='preprocess the segments straight from the records/p0*.zip archives, without extracting them, writing the valid ones in --segment_store')
 
-    # Valid segments identifiers will be saved to output_file
-    #valid_segments_file = valid_segments_retrieval(args.database_name, required_signals, args.min_duration, output_file, n_cores=8)    
+    outputs = pipeline.add_argument_group('visualize, export and spectral')
+    outputs.add_argument('--n_figures', nargs='?', type=int, help='number of preprocessed segments whose ABP and PPG figures are saved in output_dir/figs by visualize, read from the local output', default=4)
+    outputs.add_argument('--export_shards', nargs='?', type=str, help='directory where export writes the preprocessed segments as shards of (PPG, ABP) windows for training, output_dir/shards by default', default=None)
+    outputs.add_argument('--windows_per_shard', nargs='?', type=int, help='number of windows of an exported shard', default=4096)
+    outputs.add_argument('--spectral_features', nargs='?', type=str, help='directory where spectral saves the dominant frequency, band power and spectral SNR of the PPG and ABP windows of every preprocessed segment, output_dir/spectral by default', default=None)
 
-    # Remember to remove this line
-    valid_segments_file = os.path.join(args.output_dir, 'valid_segments_pleth_abp_8m.txt')
+    runtime = pipeline.add_argument_group('runtime')
+    runtime.add_argument('--metrics_dir', nargs='?', type=str, help='directory where the time of every stage step, the bytes fetched and written, the segments per second and the peak memory of the workers are recorded, with a summary.json updated while the run goes on (e.g. ./output/metrics)', default=None)
+    runtime.add_argument('--metrics_interval', nargs='?', type=float, help='seconds between two updates of the metrics summary.json', default=30)
+    runtime.add_argument('--record_cache', nargs='?', type=str, help='directory of a local cache of the files read from PhysioNet, shared by the workers and by later runs (e.g. ./output/record_cache)', default=None)
+    runtime.add_argument('--record_cache_size', nargs='?', type=float, help='maximum size of --record_cache in GB, the least recently used files are evicted', default=20)
 
-    num_patients, num_records = count_patients_and_records(valid_segments_file)
+    subparsers = parser.add_subparsers(dest='command', required=True, metavar='command')
+    stage_help = {
+        'provision': 'list the valid segments (required signals, minimum duration)',
+        'download': 'download the valid segments passing the quality checks (provision first)',
+        'filter': 'apply the thresholds and BP ranges to the downloaded segments, from --feature_table without downloading again (download first)',
+        'preprocess': 'interpolate the downloaded segments and remove the ones with invalid ABP ranges (download first)',
+        'visualize': 'save the ABP and PPG figures of --n_figures preprocessed segments (preprocess first)',
+        'export': 'write the windows of the preprocessed segments in shards for training (preprocess first)',
+        'spectral': 'compute the spectral features of the preprocessed segments (preprocess first)',
+    }
+    for name in STAGES:
+        subparsers.add_parser(name, parents=[common, pipeline], help=stage_help[name])
 
-    print(f'There are {num_patients} different patients, for a total of {num_records} different records, from {args.database_name} with {str(required_signals)} that last at least {args.min_duration} m.')
+    sweep = subparsers.add_parser('sweep', parents=[common, pipeline], help='fill --feature_table with one pass over the valid segments and print the patients and records passing the checks for every combination of thresholds and BP ranges')
+    sweep.add_argument('--sweep_nans_th', nargs='+', type=float, help='values of the NaN threshold tried', default=[0.01, 0.05, 0.1])
+    sweep.add_argument('--sweep_flat_th', nargs='+', type=float, help='values of the flat threshold tried', default=[0.01, 0.05, 0.1])
 
-    # Ranges decided empirically by looking at papers
-    valid_BP_ranges = {
-        'up_sbp' : 220.0,
-        'low_sbp' : 60.0,
-        'up_dbp' : 140.0,
-        'low_dbp' : 30.0,
-    }
+    merge = subparsers.add_parser('merge', parents=[common], help='merge the output directories of all the shards of a run in output_dir')
+    merge.add_argument('shard_dirs', nargs='+', type=str, help='output directories of the shards')
 
-    # Threshold taken from Non-invasive arterial blood pressure measurement and SpO2 estimation using PPG signal: a deep learning framework 
-    thresholds = {
-        'nans_th' : 0.05,
-        'flat_th' : 0.05, 
-    }
+    subparsers.add_parser('status', parents=[common, pipeline], help='print which stages would run with the given options, without reading signals')
+    count = subparsers.add_parser('count', parents=[common], help='print the patients and segments of the catalog, by status')
+    count.add_argument('--status', nargs='?', type=str, help='count only the segments with this status', default=None)
 
-    windowing_param = {
-        'win_len' : 20, # Parameters choose after Non-invasive arterial blood pressure measurement and SpO2 estimation using PPG signal: a deep learning framework 
-        'win_overlap' : 0.5, # Parameter as in https://github.com/Fabian-Sc85/non-invasive-bp-estimation-using-deep-learning/blob/main/prepare_MIMIC_dataset.py
-    }
+    return parser.parse_args()
+
+
+def relocate_to_shard(args : argparse.Namespace) -> None:
+    # Everything a shard writes stays in its own directory, that is copied to one host and merged with merge
+    from sharding import parse_shard, shard_dir
+
+    args.shard = parse_shard(args.shard)
+    args.output_dir = shard_dir(args.output_dir, args.shard)
+    for arg_name in ['segment_store', 'feature_table', 'event_journal', 'metrics_dir', 'spectral_features', 'export_shards', 'catalog']:
+        if getattr(args, arg_name, None) is not None:
+            setattr(args, arg_name, os.path.join(args.output_dir, os.path.basename(os.path.normpath(getattr(args, arg_name)))))
+    print(f'Shard {args.shard[0]}/{args.shard[1]}, writing in {args.output_dir}')
+
+
+def list_local_segments(records_dir : str, store_dir : Optional[str] = None) -> List[str]:
+    r"""
+    The segments found in the local output: in the segment store when given, otherwise the segment directories and
+    the members of the p0*.zip archives of records_dir.
+    """
+    if store_dir is not None:
+        from segment_store import SegmentStore
+
+        if not os.path.exists(store_dir):
+            return []
+        with SegmentStore(store_dir) as store:
+            return store.segment_ids()
+
+    from data_preprocessing import list_zip_segments
+
+    segments = {'/'.join(os.path.relpath(path, records_dir).replace(os.sep, '/').split('/')[-3:]) for path in glob.glob(f'{records_dir}/p*/p*/*') if os.path.isdir(path)}
+    for zip_file_path in glob.glob(f'{records_dir}/p0*.zip'):
+        segments.update(segment_id for segment_id, _, _ in list_zip_segments(zip_file_path))
+    return sorted(segments)
+
+
+def build_graph(args : argparse.Namespace, catalog : SegmentCatalog) -> StageGraph:
+    r"""
+    The stages of the pipeline with the parameters of args: provision -> download -> preprocess -> visualize, export, spectral.
+    Every stage hands a txt list of segments to the next ones, and records the statuses in the catalog.
+    """
+    graph = StageGraph(args.output_dir)
+    records_dir = os.path.join(args.output_dir, 'records')
+    shard = list(args.shard) if args.shard is not None else None
+
+    def provision(upstream : dict) -> dict:
+        output_file = os.path.join(args.output_dir, args.output_file_name)
+
+        if args.valid_segments_file is not None:
+            # Skip the data provisioning and use a list produced before
+            valid_segments_file = args.valid_segments_file
+            if args.shard is not None:
+                from sharding import shard_segments_file
+                valid_segments_file = shard_segments_file(valid_segments_file, args.shard, output_file)
+        else:
+            from data_provisioning import valid_segments_retrieval
+
+            # Valid segments identifiers will be saved to output_file
+            # The crawl can be interrupted: subjects already in the journal (or in the header index) are not crawled again
+            journal_path = os.path.join(args.output_dir, 'valid_segments_retrieval.journal')
+            valid_segments_file = valid_segments_retrieval(args.database_name, REQUIRED_SIGNALS, args.min_duration, output_file, n_cores=args.n_cores, index_path=args.header_index, local_dir=args.local_mirror, refresh_index=args.refresh_index, engine=args.provisioning_engine, async_mirror_dir=args.async_mirror, max_in_flight=args.max_in_flight, journal_path=journal_path, shard=args.shard, event_journal_path=args.event_journal)
+
+        # Segments already in the catalog keep the status reached in a previous run, the ones no longer valid
+        # (e.g. after a change of --min_duration or of the valid segments file) are dropped
+        catalog.import_txt(valid_segments_file, 'valid', remove_others=True)
+        if args.header_index is not None:
+            catalog.fill_from_header_index(args.header_index)
+
+        print(f'There are {catalog.count_patients()} different patients, for a total of {catalog.count()} different records, from {args.database_name} with {str(REQUIRED_SIGNALS)} that last at least {args.min_duration} m.')
+
+        if args.shard is not None:
+            from sharding import write_manifest
+            write_manifest(args.output_dir, args.shard, args.database_name, valid_segments_file=valid_segments_file, store_dir=args.segment_store, features_path=args.feature_table, journal_path=args.event_journal, catalog_path=catalog.catalog_path)
+
+        return {'valid_segments_file': valid_segments_file}
+
+    graph.add(Stage('provision', provision, params={'database_name': args.database_name, 'required_signals': sorted(REQUIRED_SIGNALS), 'min_duration': args.min_duration, 'output_file_name': args.output_file_name,
+                                                    'valid_segments_file': args.valid_segments_file, 'local_mirror': args.local_mirror, 'header_index': args.header_index, 'shard': shard},
+                    inputs=[args.valid_segments_file]))
+
+    def download(upstream : dict) -> dict:
+        output_file = os.path.join(args.output_dir, 'stored_segments.txt')
+
+        if args.downloaded_segments_file is not None:
+            # Downloaded outside of main.py, e.g. with the download_utils scripts
+            catalog.import_txt(args.downloaded_segments_file, 'downloaded', replace_status=True)
+        else:
+            # Durations from the header index, to dispatch the longest segments first
+            durations = catalog.durations() or None
+            if args.pipeline:
+                from pipeline import run_download_pipeline
+                run_download_pipeline(upstream['valid_segments_file'], args.output_dir, VALID_BP_RANGES, THRESHOLDS, WINDOWING_PARAM, n_fetch=args.n_fetch, n_qc=args.n_qc, queue_size=args.queue_size, local_dir=args.local_mirror, store_dir=args.segment_store, journal_path=args.event_journal, features_path=args.feature_table, shard=args.shard, durations=durations)
+            else:
+                from data_preprocessing import download_mimic_iii_records
+                download_mimic_iii_records(upstream['valid_segments_file'], args.output_dir, VALID_BP_RANGES, THRESHOLDS, WINDOWING_PARAM, n_cores=args.n_cores, async_mirror_dir=args.async_mirror, max_in_flight=args.max_in_flight, store_dir=args.segment_store, journal_path=args.event_journal, features_path=args.feature_table, shard=args.shard, durations=durations, local_dir=args.local_mirror)
+
+            # The segments kept by the download passed its checks, the filter stage can then apply others from the feature table
+            catalog.set_status(list_local_segments(records_dir, args.segment_store), 'downloaded')
+
+        if args.segment_store is not None and os.path.exists(args.segment_store):
+            catalog.fill_from_store(args.segment_store)
+        catalog.export_txt(output_file, 'downloaded')
+        return {'stored_segments_file': output_file}
+
+    # With a feature table the thresholds and BP ranges are applied by the filter stage, changing them does not download again
+    download_params = {'windowing_param': WINDOWING_PARAM, 'downloaded_segments_file': args.downloaded_segments_file, 'local_mirror': args.local_mirror, 'segment_store': args.segment_store, 'feature_table': args.feature_table, 'shard': shard}
+    if args.feature_table is None:
+        download_params.update({'valid_bp_ranges': VALID_BP_RANGES, 'thresholds': THRESHOLDS})
+    graph.add(Stage('download', download, deps=['provision'], params=download_params, inputs=[args.downloaded_segments_file]))
+
+    def filter_checks(upstream : dict) -> dict:
+        output_file = os.path.join(args.output_dir, 'downloaded_segments.txt')
+
+        if args.feature_table is not None and os.path.exists(args.feature_table) and args.downloaded_segments_file is None:
+            # The checks are a filter over the feature table, only the stored segments can pass (the ones discarded by
+            # the download with other thresholds have no signals)
+            from feature_table import filter_segments
+            segments = filter_segments(args.feature_table, VALID_BP_RANGES, THRESHOLDS)
+            _, stored = read_segments_txt(upstream['stored_segments_file'])
+            stored = set(stored)
+            valid = [segment for segment in segments['valid'] if segment in stored]
+            catalog.set_status(valid, 'downloaded')
+            catalog.set_status([segment for outcome in ['nans', 'flat', 'abp', 'range'] for segment in segments[outcome] if segment in stored], 'discarded')
+            if len(valid) < len(segments['valid']):
+                print(f'{len(segments["valid"]) - len(valid)} segments pass the checks but have been discarded by the download, run download --force to fetch them', flush=True)
+        catalog.export_txt(output_file, 'downloaded')
+
+        print(f'There are {catalog.count_patients("downloaded")} different patients, for a total of {catalog.count("downloaded")} different records, from {args.database_name} with {str(REQUIRED_SIGNALS)} that last at least {args.min_duration} m, with less than {THRESHOLDS["nans_th"]}, less than {THRESHOLDS["flat_th"]} and average {VALID_BP_RANGES["low_sbp"]} < SBP < {VALID_BP_RANGES["up_sbp"]} - {VALID_BP_RANGES["low_dbp"]} < DBP < {VALID_BP_RANGES["up_dbp"]}.')
+        return {'downloaded_segments_file': output_file}
+
+    graph.add(Stage('filter', filter_checks, deps=['download'], params={'valid_bp_ranges': VALID_BP_RANGES, 'thresholds': THRESHOLDS, 'feature_table': args.feature_table}))
+
+    def preprocess(upstream : dict) -> dict:
+        from data_preprocessing import preprocess_mimic_iii_records
+
+        output_file = os.path.join(args.output_dir, 'preprocessed_segments.txt')
+        preprocess_mimic_iii_records(records_dir, VALID_BP_RANGES, n_cores=args.n_cores, store_dir=args.segment_store, from_zip=args.preprocess_from_zip, journal_path=args.event_journal, shard=args.shard)
+
+        # Downloaded segments not found after the preprocessing have been removed
+        if args.segment_store is not None:
+            preprocessed = set(list_local_segments(records_dir, args.segment_store))
+        else:
+            # The archives are kept as they are, the preprocessed segments are the extracted directories
+            preprocessed = {segment for segment in list_local_segments(records_dir) if os.path.isdir(os.path.join(records_dir, segment))}
+        downloaded = catalog.segments('downloaded')
+        catalog.set_status([segment for segment in downloaded if segment in preprocessed], 'preprocessed')
+        catalog.set_status([segment for segment in downloaded if segment not in preprocessed], 'removed')
+        catalog.export_txt(output_file, 'preprocessed')
+
+        print(f'Preprocessed {catalog.count("preprocessed")} segments of {catalog.count_patients("preprocessed")} patients, {catalog.count("removed")} removed', flush=True)
+        return {'preprocessed_segments_file': output_file}
+
+    graph.add(Stage('preprocess', preprocess, deps=['filter'], params={'valid_bp_ranges': VALID_BP_RANGES, 'segment_store': args.segment_store, 'from_zip': args.preprocess_from_zip, 'shard': shard}))
+
+    def visualize(upstream : dict) -> dict:
+        from data_visualization import save_abp_and_ppg_figures
+
+        # Segments discarded by the preprocessing are skipped, nothing is queried from the database
+        save_abp_and_ppg_figures(upstream['preprocessed_segments_file'], args.output_dir, args.n_figures, n_cores=args.n_cores, store_dir=args.segment_store, records_dir=records_dir, journal_path=args.event_journal)
+        return {'figs_dir': os.path.join(args.output_dir, 'figs')}
+
+    graph.add(Stage('visualize', visualize, deps=['preprocess'], params={'n_figures': args.n_figures, 'segment_store': args.segment_store}, clear=[os.path.join(args.output_dir, 'figs')]))
+
+    def export(upstream : dict) -> dict:
+        from shard_export import export_shards, iter_record_segments, iter_store_segments
+
+        # Windows of the preprocessed segments, cut once with the parameters of the download
+        segments = iter_store_segments(args.segment_store) if args.segment_store is not None else iter_record_segments(records_dir)
+        export_shards(segments, args.export_shards, WINDOWING_PARAM, windows_per_shard=args.windows_per_shard)
+        return {'export_dir': args.export_shards}
+
+    graph.add(Stage('export', export, deps=['preprocess'], params={'windowing_param': WINDOWING_PARAM, 'export_shards': args.export_shards, 'windows_per_shard': args.windows_per_shard, 'segment_store': args.segment_store}))
+
+    def spectral(upstream : dict) -> dict:
+        from spectral_features import compute_spectral_features
+
+        # Welch PSDs of the windows of many segments at once, from the local output
+        compute_spectral_features(upstream['preprocessed_segments_file'], args.spectral_features, WINDOWING_PARAM, n_cores=args.n_cores, records_dir=records_dir, store_dir=args.segment_store)
+        if args.shard is not None:
+            from sharding import write_manifest
+            write_manifest(args.output_dir, args.shard, args.database_name, spectral_dir=args.spectral_features)
+        return {'spectral_dir': args.spectral_features}
+
+    graph.add(Stage('spectral', spectral, deps=['preprocess'], params={'windowing_param': WINDOWING_PARAM, 'spectral_features': args.spectral_features, 'segment_store': args.segment_store}, clear=[args.spectral_features]))
+
+    return graph
+
+
+def print_status(graph : StageGraph, catalog : SegmentCatalog) -> None:
+    for row in graph.status():
+        state = 'up to date' if row['stale'] is None else row['stale']
+        took = f', took {row["seconds"]:.1f}s' if row['seconds'] is not None else ''
+        print(f'{row["stage"]:<12} {state}{took}')
+        for output, path in row['outputs'].items():
+            print(f'  {output}: {path}')
+    print_counts(catalog)
+
+
+def print_counts(catalog : SegmentCatalog, status : Optional[str] = None) -> None:
+    if status is not None:
+        print(f'{status}: {catalog.count_patients(status)} patients, {catalog.count(status)} segments')
+        return
+
+    print(f'{catalog.database_name}: {catalog.count_patients()} patients, {catalog.count()} segments')
+    for status, (num_patients, num_records) in catalog.status_counts().items():
+        print(f'  {status}: {num_patients} patients, {num_records} segments')
+
+
+if __name__ == '__main__':
+
+    args = parse_arguments()
+
+    if args.command == 'merge':
+        from sharding import merge_shards
+        merge_shards(args.shard_dirs, args.output_dir)
+        sys.exit(0)
+
+    if args.shard is not None:
+        relocate_to_shard(args)
+
+    if not os.path.exists(args.output_dir):
+        os.makedirs(args.output_dir)
+
+    for arg_name, default_name in [('export_shards', 'shards'), ('spectral_features', 'spectral')]:
+        if hasattr(args, arg_name) and getattr(args, arg_name) is None:
+            setattr(args, arg_name, os.path.join(args.output_dir, default_name))
+
+    catalog = SegmentCatalog(args.catalog if args.catalog is not None else os.path.join(args.output_dir, 'segments.sqlite'))
+
+    if args.command == 'count':
+        print_counts(catalog, args.status)
+        sys.exit(0)
+
+    if args.command == 'status':
+        print_status(build_graph(args, catalog), catalog)
+        sys.exit(0)
+
+    if args.record_cache is not None:
+        # Every rdheader/rdrecord from PhysioNet, in this process and in the workers, goes through the cache
+        from record_cache import enable_record_cache
+        enable_record_cache(args.record_cache, int(args.record_cache_size * 2**30))
 
-    #download_mimic_iii_records(valid_segments_file, args.output_dir, valid_BP_ranges, thresholds, windowing_param, n_cores=args.n_cores)
+    if args.metrics_dir is not None:
+        # Workers inherit the environment variable set by the reporter, the summary is printed at exit
+        from instrumentation import MetricsReporter
+        metrics_reporter = MetricsReporter(args.metrics_dir, args.metrics_interval).start()
+        atexit.register(metrics_reporter.stop)
 
-    valid_segments_file = os.path.join(args.output_dir, 'downloaded_segments.txt')
-    num_patients, num_records = count_patients_and_records(valid_segments_file)
+    graph = build_graph(args, catalog)
 
-    print(f'There are {num_patients} different patients, for a total of {num_records} different records, from {args.database_name} with {str(required_signals)} that last at least {args.min_duration} m, with less than {thresholds["nans_th"]}, less than {thresholds["flat_th"]} and average {valid_BP_ranges["low_sbp"]} < SBP < {valid_BP_ranges["up_sbp"]} - {valid_BP_ranges["low_dbp"]} < DBP < {valid_BP_ranges["up_sbp"]}.')
+    if args.command == 'sweep':
+        if args.feature_table is None:
+            sys.exit('sweep requires --feature_table')
 
-    downloaded_file_root_path = os.path.join(args.output_dir, 'records')
+        from data_preprocessing import build_feature_table
+        from feature_table import sweep_thresholds
 
-    preprocess_mimic_iii_records(downloaded_file_root_path, valid_BP_ranges, n_cores=args.n_cores)
+        # BP ranges tried by the sweep, the ones above and a stricter version
+        sweep_BP_ranges = [
+            VALID_BP_RANGES,
+            {'up_sbp' : 180.0, 'low_sbp' : 80.0, 'up_dbp' : 120.0, 'low_dbp' : 40.0},
+        ]
 
-    
+        # Segments already in the feature table are not read again
+        valid_segments_file = graph.run('provision')['valid_segments_file']
+        build_feature_table(valid_segments_file, args.output_dir, WINDOWING_PARAM, args.feature_table, n_cores=args.n_cores, local_dir=args.local_mirror, shard=args.shard)
 
+        for result in sweep_thresholds(args.feature_table, args.sweep_nans_th, args.sweep_flat_th, sweep_BP_ranges):
+            th, ranges = result['thresholds'], result['valid_bp_ranges']
+            print(f'There are {result["num_patients"]} different patients, for a total of {result["num_records"]} different records, from {args.database_name} with {str(REQUIRED_SIGNALS)} that last at least {args.min_duration} m, with less than {th["nans_th"]}, less than {th["flat_th"]} and average {ranges["low_sbp"]} < SBP < {ranges["up_sbp"]} - {ranges["low_dbp"]} < DBP < {ranges["up_dbp"]}.')
+        sys.exit(0)
 
-    
+    graph.run(args.command, force=args.force)
@@ -0,0 +1,267 @@
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from shutil import rmtree
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from typing import Dict, Optional, Tuple
+from data_preprocessing import fetch_segment, check_segment, store_checked_segment
+from event_journal import EventJournal
+from sharding import in_shard
+from scheduling import segment_costs
+from instrumentation import instrumented, step, count, flush
+
+
+# Marks the end of the items put in a queue by a stage
+_DONE = None
+
+
+class StageCounter:
+    r"""
+    Number of items a stage of the pipeline has completed (or failed), safe to update from many threads.
+    """
+
+    def __init__(self, name : str):
+        self.name = name
+        self.done = 0
+        self.failed = 0
+        self._lock = threading.Lock()
+
+    def add(self, failed : bool = False) -> None:
+        with self._lock:
+            if failed:
+                self.failed += 1
+            else:
+                self.done += 1
+
+
+@instrumented('download.check')
+def _check_segment_worker(*args):
+    # check_segment in the QC processes, which never run atexit: the decorator writes their metrics after every segment
+    return check_segment(*args)
+
+
+def _report(counters, queues, elapsed : float) -> None:
+    # One line with the throughput of every stage and the depth of the queues between them
+    stages = ', '.join([f'{counter.name} {counter.done} ({counter.done / elapsed:.2f}/s, {counter.failed} failed)' for counter in counters])
+    depths = ', '.join([f'{name} {q.qsize()}/{q.maxsize}' for name, q in queues.items()])
+    print(f'[pipeline {elapsed:.0f}s] {stages} | queues: {depths}', flush=True)
+
+
+def run_download_pipeline(valid_segments_file_path : str, output_dir : str, valid_BP_ranges : dict, thresholds : dict, windowing_param : dict, n_fetch : int = 16, n_qc : int = 1, queue_size : int = 32, local_dir : Optional[str] = None, store_dir : Optional[str] = None, report_every : float = 30, journal_path : Optional[str] = None, features_path : Optional[str] = None, shard : Optional[Tuple[int, int]] = None, durations : Optional[Dict[str, float]] = None) -> None:
+    r"""
+    Same of download_mimic_iii_records, with the steps of every segment split in three stages that work at the same time:
+    - fetch: a pool of n_fetch threads reading the ABP and PLETH channels in scratch directories (network-bound, see fetch_segment)
+    - QC: a pool of n_qc processes running the quality checks and the windowed SBP/DBP estimation (CPU-bound, see check_segment)
+    - write: a thread moving the valid segments to their output directory or segment store (see store_checked_segment)
+
+    Stages are connected by queues of queue_size items: when a stage is slower, the queue before it fills up and the
+    stages before it wait (so the scratch directories on disk are bounded too). Every report_every seconds the throughput
+    of the stages and the depth of the queues are printed, the stage with the full queue in front of it is the one to scale up.
+
+    Parameters
+    ------------
+
+    valid_segments_file_path: str,
+        the txt file with the database name as first line and the valid segments on the following ones
+    output_dir: str,
+        root directory where to store signals
+    valid_BP_ranges: dict,
+        the upper and lower valid values for systolic and diastolic blood pressure
+    thresholds: dict,
+        contains the permitted % of anomalies in the signals (NaNs and flat parts)
+    windowing_param: dict,
+        contains parameters tos etup the sliding window (length in seconds and overlap)
+    n_fetch: int, default 16,
+        number of segments fetched at the same time
+    n_qc: int, default 1,
+        number of processes running the quality checks
+    queue_size: int, default 32,
+        maximum number of segments waiting between two stages
+    local_dir: str, default None,
+        root directory of a local mirror of the database, when None PhysioNet is queried
+    store_dir: str, default None,
+        directory of a SegmentStore where valid segments are appended, when None they are saved as .npy files
+    report_every: float, default 30,
+        seconds between two reports of the pipeline state
+    journal_path: str, default None,
+        location of the SQLite event journal (see event_journal.py), the stages share one journal written in batches
+    features_path: str, default None,
+        location of the SQLite feature table (see feature_table.py) filled by the QC processes
+    shard: tuple, default None,
+        (i, N) to process only the patients of the i-th of N shards (see sharding.py)
+    durations: dict, default None,
+        duration of the segments (e.g. SegmentCatalog.durations), when given the longest segments are fetched first,
+        so that they do not reach the QC processes last
+
+    Returns
+    ------------
+    None
+    """
+
+    # Create patients directory
+    output_dir = os.path.join(output_dir, 'records')
+    os.makedirs(output_dir, exist_ok=True)
+
+    with open(valid_segments_file_path, 'r') as seg_file:
+        lines = seg_file.readlines()
+
+        # First line is the database name
+        database_name = lines[0].strip()
+
+        # Next lines are all structured as parent_directory/patient_id/segments
+        segments = [segment for segment in lines[1:] if in_shard(segment, shard)]
+
+    if durations is not None:
+        costs = segment_costs(segments, durations)
+        segments = [segments[i] for i in sorted(range(len(segments)), key=lambda i: -costs[i])]
+    segments = iter(segments)
+
+    print(f'Pipeline: {n_fetch} fetch threads, {n_qc}/{multiprocessing.cpu_count()} QC processes, queues of {queue_size} segments')
+
+    fetched = queue.Queue(maxsize=queue_size)
+    checked = queue.Queue(maxsize=queue_size)
+    fetch_counter, qc_counter, write_counter = StageCounter('fetch'), StageCounter('qc'), StageCounter('write')
+    segments_lock = threading.Lock()
+    # Set when the QC stage dies, the fetch threads stop taking new segments
+    stop = threading.Event()
+    journal = EventJournal(journal_path)
+    # Exceptions that killed a stage thread, raised at the end of the run
+    errors = []
+
+    def fetch_stage():
+        # The end mark is always sent, also when the thread dies, otherwise the QC stage waits for it forever
+        try:
+            while not stop.is_set():
+                with segments_lock:
+                    valid_segment_path = next(segments, _DONE)
+                if valid_segment_path is _DONE:
+                    return
+
+                print(f'Processing {valid_segment_path.strip()}', flush=True)
+                journal.log(valid_segment_path.strip(), 'fetch', 'started')
+                start = time.time()
+                try:
+                    with step('download.fetch'):
+                        item = fetch_segment(database_name, valid_segment_path, output_dir, local_dir)
+                except Exception as e:
+                    print(f'Fetch failed for {valid_segment_path.strip()}: {e}', flush=True)
+                    journal.log(valid_segment_path.strip(), 'fetch', 'failed', reason=repr(e), started_at=start, duration=time.time() - start)
+                    fetch_counter.add(failed=True)
+                    continue
+
+                segment_id, _, fs, _, report = item
+                journal.log(segment_id, 'fetch', 'done', metrics={'fs': fs, 'n_samples': report.n_samples}, started_at=start, duration=time.time() - start)
+                fetched.put(item)
+                fetch_counter.add()
+                count('segments_fetched')
+        except Exception as e:
+            errors.append(('fetch', e))
+            raise
+        finally:
+            fetched.put(_DONE)
+
+    def qc_stage():
+        # Keeps at most 2 * n_qc segments in the process pool, the others wait in the fetched queue
+        n_fetch_done = 0
+        pending = {}
+        item = None
+        try:
+            # Spawned, not forked: this process already runs the fetch and write threads, whose locks (queues, SQLite,
+            # stdout) a forked child could inherit held
+            with ProcessPoolExecutor(max_workers=n_qc, mp_context=multiprocessing.get_context('spawn')) as executor:
+                while n_fetch_done < n_fetch or pending:
+                    # Take new segments while there is room in the pool, without blocking when results are due
+                    while n_fetch_done < n_fetch and len(pending) < 2 * n_qc:
+                        try:
+                            item = fetched.get(timeout=0.1 if pending else None)
+                        except queue.Empty:
+                            break
+                        if item is _DONE:
+                            n_fetch_done += 1
+                            continue
+                        segment_id, scratch_path, fs, units, report = item
+                        pending[executor.submit(_check_segment_worker, scratch_path, fs, report, valid_BP_ranges, thresholds, windowing_param, segment_id, features_path)] = (item, time.time())
+                        item = None
+
+                    completed, _ = wait(pending, timeout=0.1, return_when=FIRST_COMPLETED)
+                    for future in completed:
+                        (segment_id, scratch_path, fs, units, _), start = pending.pop(future)
+                        try:
+                            status, metrics = future.result()
+                        except Exception as e:
+                            print(f'Quality checks failed for {segment_id}: {e}', flush=True)
+                            journal.log(segment_id, 'qc', 'failed', reason=repr(e), started_at=start, duration=time.time() - start)
+                            checked.put((segment_id, scratch_path, 'failed', fs, units))
+                            qc_counter.add(failed=True)
+                            continue
+
+                        # The duration includes the wait in the process pool
+                        journal.log(segment_id, 'qc', 'passed' if status == 'valid' else 'discarded', reason=None if status == 'valid' else status, metrics=metrics, started_at=start, duration=time.time() - start)
+                        checked.put((segment_id, scratch_path, status, fs, units))
+                        qc_counter.add()
+                        count('segments_checked')
+        except Exception as e:
+            errors.append(('qc', e))
+            stop.set()
+            raise
+        finally:
+            # The segments the writer will never see (in the pool, being submitted, or still coming from the fetch
+            # threads when the stage dies) are lost, their scratch directories are removed
+            in_flight = [item for item, _ in pending.values()] + ([item] if item not in (None, _DONE) else [])
+            for _, scratch_path, _, _, _ in in_flight:
+                rmtree(scratch_path, ignore_errors=True)
+            while stop.is_set() and n_fetch_done < n_fetch:
+                item = fetched.get()
+                if item is _DONE:
+                    n_fetch_done += 1
+                else:
+                    rmtree(item[1], ignore_errors=True)
+
+            # The writer stops also when the QC stage dies
+            checked.put(_DONE)
+
+    def write_stage():
+        while True:
+            item = checked.get()
+            if item is _DONE:
+                return
+
+            segment_id, scratch_path, status, fs, units = item
+            start = time.time()
+            try:
+                with step('download.write'):
+                    if status == 'failed':
+                        rmtree(scratch_path)
+                    else:
+                        store_checked_segment(segment_id, scratch_path, status, output_dir, fs, units, store_dir)
+                count('segments')
+                if status == 'valid':
+                    journal.log(segment_id, 'write', 'saved', reason=store_dir, started_at=start, duration=time.time() - start)
+                write_counter.add(failed=(status == 'failed'))
+            except Exception as e:
+                print(f'Write failed for {segment_id}: {e}', flush=True)
+                journal.log(segment_id, 'write', 'failed', reason=repr(e), started_at=start, duration=time.time() - start)
+                write_counter.add(failed=True)
+
+    start = time.time()
+    threads = [threading.Thread(target=fetch_stage, daemon=True) for _ in range(n_fetch)]
+    threads.append(threading.Thread(target=qc_stage, daemon=True))
+    writer = threading.Thread(target=write_stage, daemon=True)
+    threads.append(writer)
+    for thread in threads:
+        thread.start()
+
+    counters = [fetch_counter, qc_counter, write_counter]
+    queues = {'fetch->qc': fetched, 'qc->write': checked}
+    while writer.is_alive():
+        writer.join(timeout=report_every)
+        journal.flush()
+        flush()
+        _report(counters, queues, time.time() - start)
+
+    journal.close()
+    if errors:
+        stage, error = errors[0]
+        raise RuntimeError(f'The {stage} stage of the pipeline failed') from error
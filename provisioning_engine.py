@@ -0,0 +1,145 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterator, List, Optional, Set, Tuple
+from joblib import Parallel, delayed
+from wfdb_source import get_record_list
+
+
+def iter_subject_files(database_name : str, subjects : List[Tuple[int, str]], local_dir : Optional[str] = None, n_listing_threads : int = 16) -> Iterator[Tuple[int, str, List[str]]]:
+    r"""
+    List the files of many subjects concurrently. Listing a subject is a single small request,
+    so a pool of threads keeps several of them in flight while the results are consumed in order.
+
+    Parameters
+    ------------
+
+    database_name: str,
+        the name of the dataset inside PhysioNet
+    subjects: list,
+        pairs of (position in the database RECORDS file, subject path)
+    local_dir: str, default None,
+        root directory of a local mirror of database_name, when None PhysioNet is queried
+    n_listing_threads: int, default 16,
+        number of subjects listed at the same time
+
+    Returns
+    ------------
+
+    An iterator of (subject_idx, subject, files)
+    """
+    with ThreadPoolExecutor(max_workers=n_listing_threads) as executor:
+        listings = executor.map(lambda subject: get_record_list(database_name, subject[1], local_dir), subjects)
+
+        for (subject_idx, subject), files in zip(subjects, listings):
+            yield subject_idx, subject, files
+
+
+def _noop() -> None:
+    return None
+
+
+def _run_task(task_function : Callable, subject_idx : int, file_idx : int, args : tuple) -> Tuple[int, int, object]:
+    # Results come back unordered, so they are tagged with the task position
+    return subject_idx, file_idx, task_function(*args)
+
+
+def crawl_subjects(database_name : str, subjects : List[Tuple[int, str]], task_function : Callable, task_args : tuple = (), n_cores : int = 1, local_dir : Optional[str] = None, n_listing_threads : int = 16, exclude : Optional[Dict[str, Set[str]]] = None) -> Iterator[Tuple[int, str, List[str], list]]:
+    r"""
+    Run task_function on every (subject, file) pair of the given subjects as one stream of tasks, served by
+    a single pool of workers that stays alive for the whole crawl. Subjects are listed concurrently while
+    the workers are busy, and there is no barrier at the end of each subject.
+
+    task_function is called as task_function(subject_file, database_name, subject, subject_id, *task_args),
+    that is the signature of data_provisioning.worker_function and header_index.header_worker_function.
+    Files starting with the subject id are not waveforms and they are never dispatched, their result is None.
+
+    Parameters
+    ------------
+
+    database_name: str,
+        the name of the dataset inside PhysioNet
+    subjects: list,
+        pairs of (position in the database RECORDS file, subject path)
+    task_function: callable,
+        the function to run on every file
+    task_args: tuple, default (),
+        extra arguments for task_function
+    n_cores: int, default 1,
+        number of parallel workers
+    local_dir: str, default None,
+        root directory of a local mirror of database_name, when None PhysioNet is queried
+    n_listing_threads: int, default 16,
+        number of subjects listed at the same time
+    exclude: dict, default None,
+        files (per subject) that must not be dispatched, their result is None
+
+    Returns
+    ------------
+
+    An iterator of (subject_idx, subject, files, results) yielded as soon as all the files of a subject are done,
+    results are aligned with files
+    """
+    pending = {}
+    completed = {}
+    listed = {}
+    stats = {'tasks': 0, 'subjects': 0}
+    start = time.time()
+
+    def task_stream():
+        for subject_idx, subject, files in iter_subject_files(database_name, subjects, local_dir, n_listing_threads):
+            subject_id = subject.split('/')[1]
+            excluded = exclude.get(subject, set()) if exclude is not None else set()
+            file_idxs = [i for i, subject_file in enumerate(files) if not subject_file.startswith(subject_id) and subject_file not in excluded]
+
+            # Bookkeeping must happen before the tasks are handed to the workers
+            listed[subject_idx] = (subject, files)
+            completed[subject_idx] = [None] * len(files)
+            pending[subject_idx] = len(file_idxs)
+
+            for file_idx in file_idxs:
+                yield delayed(_run_task)(task_function, subject_idx, file_idx, (files[file_idx], database_name, subject, subject_id, *task_args))
+
+            # Subjects with nothing to dispatch are done as soon as they are listed
+            if not file_idxs:
+                yield delayed(_run_task)(_noop, subject_idx, -1, ())
+
+    for subject_idx, file_idx, result in Parallel(n_jobs=n_cores, return_as='generator_unordered')(task_stream()):
+        if file_idx >= 0:
+            completed[subject_idx][file_idx] = result
+            pending[subject_idx] -= 1
+            stats['tasks'] += 1
+
+        if pending[subject_idx] <= 0:
+            subject, files = listed.pop(subject_idx)
+            del pending[subject_idx]
+            stats['subjects'] += 1
+
+            if stats['subjects'] % 1000 == 0:
+                report_throughput(stats['subjects'], len(subjects), stats['tasks'], time.time() - start)
+
+            yield subject_idx, subject, files, completed.pop(subject_idx)
+
+    report_throughput(stats['subjects'], len(subjects), stats['tasks'], time.time() - start)
+
+
+def report_throughput(n_subjects : int, tot_subjects : int, n_tasks : int, elapsed : float) -> None:
+    r"""
+    Print the progress of a crawl and its throughput in tasks (headers) per second.
+
+    Parameters
+    ------------
+
+    n_subjects: int,
+        subjects completed so far
+    tot_subjects: int,
+        subjects to process
+    n_tasks: int,
+        tasks completed so far
+    elapsed: float,
+        seconds since the beginning of the crawl
+
+    Returns
+    ------------
+    None
+    """
+    print(f'Subjects processed {n_subjects}/{tot_subjects} - {n_tasks} tasks in {elapsed:.1f} s ({n_tasks / max(elapsed, 1e-9):.1f} tasks/s)', flush=True)
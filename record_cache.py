@@ -0,0 +1,338 @@
+import hashlib
+import os
+import posixpath
+import sqlite3
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+from typing import Optional
+import wfdb
+from async_fetch import PHYSIONET_URL
+from instrumentation import count
+
+
+# Workers (joblib, ProcessPoolExecutor) inherit the environment, so every process reads through the same cache
+CACHE_DIR_VARIABLE = 'MIMIC_RECORD_CACHE'
+CACHE_SIZE_VARIABLE = 'MIMIC_RECORD_CACHE_SIZE'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS objects (
+    digest TEXT PRIMARY KEY,
+    size INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS files (
+    database_name TEXT NOT NULL,
+    path TEXT NOT NULL,
+    digest TEXT NOT NULL REFERENCES objects (digest),
+    fetched_at REAL NOT NULL,
+    last_access REAL NOT NULL,
+    PRIMARY KEY (database_name, path)
+);
+CREATE INDEX IF NOT EXISTS files_by_digest ON files (digest);
+CREATE INDEX IF NOT EXISTS files_by_access ON files (last_access);
+"""
+
+
+class RecordCache:
+    r"""
+    Local cache of the WFDB files downloaded from PhysioNet, shared by all the processes of a host.
+
+    Files are content-addressed: the content of a file is stored once in objects/ under its SHA-256 digest,
+    computed while it is downloaded, and it is hard linked in tree/database_name/ with the layout it has in the
+    database, so the tree can be read by wfdb as a local mirror (see wfdb_source.py). A SQLite index (index.sqlite)
+    maps every file to its digest and keeps the size of the objects and the last access of the files.
+
+    When the objects exceed max_bytes, the least recently used ones are evicted, except those accessed in the last
+    min_age seconds, which a worker could be reading. Insertions and evictions are transactions of the index, and files
+    appear through atomic renames, so many processes can use the same cache_dir at the same time.
+
+    Parameters
+    ------------
+
+    cache_dir: str,
+        root directory of the cache, created if it does not exist
+    max_bytes: int, default 20 * 2**30,
+        maximum size of the cached files
+    base_url: str, default PHYSIONET_URL,
+        the server to fetch the files from, the database is expected at base_url/database_name
+    min_age: float, default 300,
+        seconds after its last access before a file can be evicted
+    retries: int, default 3,
+        attempts for a request failing with a connection error
+    timeout: float, default 300,
+        seconds before a single request is abandoned
+    """
+
+    def __init__(self, cache_dir : str, max_bytes : int = 20 * 2**30, base_url : str = PHYSIONET_URL, min_age : float = 300, retries : int = 3, timeout : float = 300):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.base_url = base_url
+        self.min_age = min_age
+        self.retries = retries
+        self.timeout = timeout
+
+        for directory in ['objects', 'tree', 'tmp']:
+            os.makedirs(os.path.join(cache_dir, directory), exist_ok=True)
+
+        self._connection = sqlite3.connect(os.path.join(cache_dir, 'index.sqlite'), timeout=60, check_same_thread=False, isolation_level=None)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.executescript(SCHEMA)
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        # Last access written in the index per file, updated at most once per minute
+        self._touched = {}
+
+    def object_path(self, digest : str) -> str:
+        return os.path.join(self.cache_dir, 'objects', digest[:2], digest)
+
+    def tree_path(self, database_name : str, path : str) -> str:
+        return os.path.join(self.cache_dir, 'tree', database_name, path)
+
+    def _download(self, database_name : str, path : str):
+        # Streamed to a temporary file, the digest is computed on the way
+        url = posixpath.join(self.base_url, database_name, path)
+        tmp_path = os.path.join(self.cache_dir, 'tmp', f'{os.getpid()}_{uuid.uuid4().hex}.part')
+
+        for attempt in range(self.retries):
+            digest = hashlib.sha256()
+            size = 0
+            try:
+                with urllib.request.urlopen(url, timeout=self.timeout) as response, open(tmp_path, 'wb') as f:
+                    while True:
+                        block = response.read(2**20)
+                        if not block:
+                            break
+                        digest.update(block)
+                        f.write(block)
+                        size += len(block)
+                return tmp_path, digest.hexdigest(), size
+            except urllib.error.HTTPError as e:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                if e.code == 404:
+                    raise FileNotFoundError(url)
+                raise
+            except (urllib.error.URLError, TimeoutError, ConnectionError):
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                if attempt == self.retries - 1:
+                    raise
+
+    def _lookup(self, database_name : str, path : str) -> Optional[str]:
+        # Local path of a cached file, None when it is not cached or its content is not the expected one
+        with self._lock:
+            row = self._connection.execute('SELECT f.digest, o.size FROM files AS f JOIN objects AS o ON f.digest = o.digest WHERE f.database_name = ? AND f.path = ?', (database_name, path)).fetchone()
+        if row is None:
+            return None
+
+        local_path = self.tree_path(database_name, path)
+        try:
+            if os.path.getsize(local_path) != row[1]:
+                raise OSError(f'{local_path} is truncated')
+        except OSError:
+            # Evicted by another process meanwhile, or damaged: it is fetched again
+            self._forget(database_name, path)
+            return None
+
+        now = time.time()
+        if now - self._touched.get((database_name, path), 0) > 60:
+            self._touched[(database_name, path)] = now
+            with self._lock:
+                self._connection.execute('UPDATE files SET last_access = ? WHERE database_name = ? AND path = ?', (now, database_name, path))
+        return local_path
+
+    def _insert(self, database_name : str, path : str, tmp_path : str, digest : str, size : int) -> str:
+        local_path = self.tree_path(database_name, path)
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+        now = time.time()
+
+        with self._lock:
+            self._connection.execute('BEGIN IMMEDIATE')
+            try:
+                # Same content already cached (e.g. fetched by another process meanwhile)
+                if os.path.exists(self.object_path(digest)):
+                    os.remove(tmp_path)
+                else:
+                    os.makedirs(os.path.dirname(self.object_path(digest)), exist_ok=True)
+                    os.replace(tmp_path, self.object_path(digest))
+
+                # The link is replaced atomically, a reader sees the old or the new file
+                link_tmp_path = f'{local_path}.{os.getpid()}.part'
+                if os.path.exists(link_tmp_path):
+                    os.remove(link_tmp_path)
+                os.link(self.object_path(digest), link_tmp_path)
+                os.replace(link_tmp_path, local_path)
+
+                self._connection.execute('INSERT OR IGNORE INTO objects VALUES (?, ?)', (digest, size))
+                self._connection.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)', (database_name, path, digest, now, now))
+                # The previous content of a file that changed on the server
+                self._remove_unreferenced()
+                self._evict(self.max_bytes)
+                self._connection.execute('COMMIT')
+            except:
+                self._connection.execute('ROLLBACK')
+                raise
+
+        self._touched[(database_name, path)] = now
+        return local_path
+
+    def _forget(self, database_name : str, path : str) -> None:
+        with self._lock:
+            self._connection.execute('BEGIN IMMEDIATE')
+            self._connection.execute('DELETE FROM files WHERE database_name = ? AND path = ?', (database_name, path))
+            self._remove_unreferenced()
+            self._connection.execute('COMMIT')
+        if os.path.exists(self.tree_path(database_name, path)):
+            os.remove(self.tree_path(database_name, path))
+
+    def _remove_unreferenced(self) -> None:
+        # Objects without files, inside the transaction of the caller
+        digests = [digest for digest, in self._connection.execute('SELECT digest FROM objects WHERE digest NOT IN (SELECT digest FROM files)')]
+        for digest in digests:
+            if os.path.exists(self.object_path(digest)):
+                os.remove(self.object_path(digest))
+        self._connection.executemany('DELETE FROM objects WHERE digest = ?', [(digest,) for digest in digests])
+
+    def _evict(self, max_bytes : int) -> int:
+        # Least recently used objects first, inside the transaction of the caller
+        total = self._connection.execute('SELECT COALESCE(SUM(size), 0) FROM objects').fetchone()[0]
+        if total <= max_bytes:
+            return 0
+
+        candidates = self._connection.execute(
+            'SELECT f.digest, o.size, MAX(f.last_access) AS last_access FROM files AS f JOIN objects AS o ON f.digest = o.digest '
+            'GROUP BY f.digest HAVING last_access < ? ORDER BY last_access', (time.time() - self.min_age,)).fetchall()
+
+        n_evicted = 0
+        for digest, size, _ in candidates:
+            if total <= max_bytes:
+                break
+            for database_name, path in self._connection.execute('SELECT database_name, path FROM files WHERE digest = ?', (digest,)).fetchall():
+                if os.path.exists(self.tree_path(database_name, path)):
+                    os.remove(self.tree_path(database_name, path))
+                self._touched.pop((database_name, path), None)
+            self._connection.execute('DELETE FROM files WHERE digest = ?', (digest,))
+            total -= size
+            n_evicted += 1
+
+        self._remove_unreferenced()
+        return n_evicted
+
+    def fetch_file(self, database_name : str, path : str) -> str:
+        r"""
+        Local path of a file of the database (e.g. p00/p000020/3000003_0003.hea), downloaded when it is not cached.
+        A missing file raises FileNotFoundError.
+        """
+        local_path = self._lookup(database_name, path)
+        if local_path is not None:
+            count('cache.hits')
+            return local_path
+
+        count('cache.misses')
+        tmp_path, digest, size = self._download(database_name, path)
+        return self._insert(database_name, path, tmp_path, digest, size)
+
+    def fetch_header(self, database_name : str, record_dir : str, record_name : str) -> str:
+        r"""
+        Cache the header of a record, returning the local record path (without extension) to give to wfdb.
+        """
+        self.fetch_file(database_name, posixpath.join(record_dir, f'{record_name}.hea'))
+        return self.tree_path(database_name, posixpath.join(record_dir, record_name))
+
+    def fetch_record(self, database_name : str, record_dir : str, record_name : str) -> str:
+        r"""
+        Cache the header and the signal files of a single segment record, returning the local record path (without extension).
+        """
+        record_path = self.fetch_header(database_name, record_dir, record_name)
+
+        # The header lists the signal files, several signals can share the same file
+        header = wfdb.rdheader(record_path)
+        for signal_file in sorted(set(header.file_name or [])):
+            self.fetch_file(database_name, posixpath.join(record_dir, signal_file))
+        return record_path
+
+    def verify(self) -> int:
+        r"""
+        Compute again the digest of every object, and remove the files whose content does not match it (they are
+        downloaded again when requested). Returns the number of damaged objects.
+        """
+        with self._lock:
+            digests = [digest for digest, in self._connection.execute('SELECT digest FROM objects')]
+
+        damaged = []
+        for digest in digests:
+            checksum = hashlib.sha256()
+            try:
+                with open(self.object_path(digest), 'rb') as f:
+                    for block in iter(lambda: f.read(2**20), b''):
+                        checksum.update(block)
+            except FileNotFoundError:
+                pass
+            if checksum.hexdigest() != digest:
+                damaged.append(digest)
+
+        for digest in damaged:
+            with self._lock:
+                files = self._connection.execute('SELECT database_name, path FROM files WHERE digest = ?', (digest,)).fetchall()
+            for database_name, path in files:
+                self._forget(database_name, path)
+            print(f'Removed damaged object {digest} ({len(files)} files)', flush=True)
+
+        return len(damaged)
+
+    def evict(self, max_bytes : Optional[int] = None) -> int:
+        r"""
+        Evict the least recently used objects until the cache is smaller than max_bytes (default the max_bytes of the cache).
+        Returns the number of objects evicted.
+        """
+        with self._lock:
+            self._connection.execute('BEGIN IMMEDIATE')
+            n_evicted = self._evict(self.max_bytes if max_bytes is None else max_bytes)
+            self._connection.execute('COMMIT')
+        return n_evicted
+
+    def stats(self) -> dict:
+        r"""
+        Number of files and objects, and size of the cache in bytes.
+        """
+        with self._lock:
+            n_files = self._connection.execute('SELECT COUNT(*) FROM files').fetchone()[0]
+            n_objects, size = self._connection.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM objects').fetchone()
+        return {'files': n_files, 'objects': n_objects, 'bytes': size, 'max_bytes': self.max_bytes}
+
+    def close(self) -> None:
+        self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+_cache = None
+
+
+def enable_record_cache(cache_dir : str, max_bytes : int = 20 * 2**30) -> None:
+    r"""
+    Read the PhysioNet records through a RecordCache in cache_dir, in this process and in the workers started from now on.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    os.environ[CACHE_DIR_VARIABLE] = os.path.abspath(cache_dir)
+    os.environ[CACHE_SIZE_VARIABLE] = str(int(max_bytes))
+
+
+def get_record_cache() -> Optional[RecordCache]:
+    r"""
+    The RecordCache of the current process, None when the cache is off. A forked worker opens its own.
+    """
+    global _cache
+    cache_dir = os.environ.get(CACHE_DIR_VARIABLE)
+    if not cache_dir:
+        return None
+
+    if _cache is None or _cache._pid != os.getpid() or _cache.cache_dir != cache_dir:
+        _cache = RecordCache(cache_dir, int(os.environ.get(CACHE_SIZE_VARIABLE, 20 * 2**30)))
+    return _cache
@@ -0,0 +1,237 @@
+import heapq
+import os
+import time
+import zipfile
+from typing import Callable, Dict, List, Optional, Sequence
+import numpy as np
+from joblib import Parallel, delayed, effective_n_jobs
+
+
+# Cost of dispatching a batch to a worker as a fraction of the median cost of a task, when it is not known in the units
+# of the costs: a loky dispatch takes about a millisecond, a segment from tens of milliseconds (preprocessing) to seconds (download)
+DISPATCH_OVERHEAD = 0.01
+
+
+def npy_length(path : str) -> int:
+    r"""
+    Number of samples of a 1D .npy file (e.g. abp.npy) from its header, without reading the data, 0 when it is missing.
+    """
+    if not os.path.exists(path):
+        return 0
+    with open(path, 'rb') as f:
+        version = np.lib.format.read_magic(f)
+        read_header = np.lib.format.read_array_header_1_0 if version == (1, 0) else np.lib.format.read_array_header_2_0
+        shape, _, _ = read_header(f)
+    return shape[0] if shape else 0
+
+
+def zip_member_sizes(zip_file_path : str) -> Dict[str, int]:
+    r"""
+    Uncompressed size of every member of an archive, e.g. to weigh the segments of a p0*.zip by their abp.npy.
+    """
+    with zipfile.ZipFile(zip_file_path, 'r') as zip_ref:
+        return {info.filename: info.file_size for info in zip_ref.infolist()}
+
+
+def segment_costs(segment_ids : Sequence[str], lengths : Optional[Dict[str, float]]) -> List[float]:
+    r"""
+    The cost of every segment from its length (duration or number of samples), the segments of unknown length are
+    given the median length (all the same cost when no length is known, so the file order is kept).
+    """
+    lengths = lengths or {}
+    known = [lengths[segment_id.strip()] for segment_id in segment_ids if lengths.get(segment_id.strip())]
+    default = float(np.median(known)) if known else 1.0
+    return [lengths.get(segment_id.strip()) or default for segment_id in segment_ids]
+
+
+def _pack(costs : np.array, order : np.array, target : float, max_batch : Optional[int]) -> List[List[int]]:
+    # Tasks costing at least target alone, the smaller ones, still by decreasing cost, fill batches up to target
+    batches, batch, batch_cost = [], [], 0.0
+    for idx in order:
+        if costs[idx] >= target:
+            batches.append([int(idx)])
+            continue
+        if batch and (batch_cost + costs[idx] > target or (max_batch is not None and len(batch) >= max_batch)):
+            batches.append(batch)
+            batch, batch_cost = [], 0.0
+        batch.append(int(idx))
+        batch_cost += costs[idx]
+    if batch:
+        batches.append(batch)
+
+    batches.sort(key=lambda batch: -costs[batch].sum())
+    return batches
+
+
+def plan_batches(costs : Sequence[float], n_workers : int, granularity : Optional[int] = None, max_batch : Optional[int] = None, overhead : float = 0.0) -> List[List[int]]:
+    r"""
+    Longest processing time first: tasks are sorted by decreasing cost, so that the long ones start first and the short
+    ones fill the gaps at the end. Tasks costing less than a target, the total cost over n_workers * granularity, can be
+    packed together in batches of about the target cost, so that many tiny tasks do not pay the dispatch overhead one by one.
+
+    Packing makes the end of the run coarser, so when granularity is None the tasks are packed only if the makespan
+    simulated with overhead added to every batch is shorter than the one of the tasks taken one by one (never when overhead
+    is 0), trying 8, 16, 32, ... batches per worker up to the number of tasks.
+
+    Parameters
+    ------------
+
+    costs: sequence,
+        the cost of every task (e.g. samples or duration of a segment), tasks of unknown cost can be given the median
+    n_workers: int,
+        number of parallel workers
+    granularity: int, default None,
+        batches per worker the small tasks are always packed into (e.g. to share the opening of an archive), when None
+        it is chosen by simulation as above
+    max_batch: int, default None,
+        maximum number of tasks of a batch
+    overhead: float, default 0.0,
+        cost of dispatching a batch to a worker, in the units of costs
+
+    Returns
+    ------------
+
+    The batches, lists of task indexes, by decreasing total cost
+    """
+    costs = np.asarray(costs, dtype=np.float64)
+    if len(costs) == 0:
+        return []
+
+    n_workers = max(n_workers, 1)
+    order = np.argsort(-costs, kind='stable')
+    if granularity is not None:
+        return _pack(costs, order, costs.sum() / (n_workers * granularity), max_batch)
+
+    best = [[int(idx)] for idx in order]
+    best_makespan = simulate_makespan(costs[order] + overhead, n_workers)
+    granularity = 8
+    while overhead > 0 and n_workers * granularity < len(costs):
+        batches = _pack(costs, order, costs.sum() / (n_workers * granularity), max_batch)
+        makespan = simulate_makespan([costs[batch].sum() + overhead for batch in batches], n_workers)
+        if makespan < best_makespan:
+            best, best_makespan = batches, makespan
+        granularity *= 2
+    return best
+
+
+def simulate_makespan(costs : Sequence[float], n_workers : int) -> float:
+    r"""
+    Makespan of tasks taken in the given order by the first free worker, in cost units (what joblib does with a list of tasks).
+    """
+    workers = [0.0] * max(n_workers, 1)
+    for cost in costs:
+        heapq.heappush(workers, heapq.heappop(workers) + cost)
+    return max(workers)
+
+
+def _run_batch(function : Callable, calls : List[tuple], kwargs : dict) -> dict:
+    # Runs in the worker: the calls of a batch one after the other, timed as a whole
+    start = time.time()
+    results = [function(*args, **kwargs) for args in calls]
+    return {'pid': os.getpid(), 'start': start, 'stop': time.time(), 'n_tasks': len(calls), 'results': results}
+
+
+class ScheduleReport:
+    r"""
+    Timings of a scheduled run: makespan (first start to last stop), busy time and utilisation of every worker, and the
+    lower bound of the makespan (the total busy time spread evenly, or the longest batch), to see how much is lost at the end.
+
+    Parameters
+    ------------
+
+    name: str,
+        what has been run (e.g. 'download')
+    timings: list,
+        the dictionaries returned by the batches (pid, start, stop, n_tasks)
+    n_workers: int,
+        number of parallel workers
+    predicted: dict, default None,
+        makespan in cost units of the tasks in file order and longest first, from their costs
+    """
+
+    def __init__(self, name : str, timings : List[dict], n_workers : int, predicted : Optional[dict] = None):
+        self.name = name
+        self.n_workers = n_workers
+        self.n_tasks = sum(timing['n_tasks'] for timing in timings)
+        self.n_batches = len(timings)
+        self.predicted = predicted or {}
+
+        self.makespan = max(timing['stop'] for timing in timings) - min(timing['start'] for timing in timings) if timings else 0.0
+        self.busy = {}
+        for timing in timings:
+            self.busy[timing['pid']] = self.busy.get(timing['pid'], 0.0) + timing['stop'] - timing['start']
+        longest = max((timing['stop'] - timing['start'] for timing in timings), default=0.0)
+        self.lower_bound = max(sum(self.busy.values()) / max(n_workers, 1), longest)
+
+    @property
+    def utilisation(self) -> Dict[int, float]:
+        return {pid: busy / self.makespan if self.makespan > 0 else 0.0 for pid, busy in self.busy.items()}
+
+    def print(self) -> None:
+        efficiency = self.lower_bound / self.makespan if self.makespan > 0 else 1.0
+        print(f'{self.name}: {self.n_tasks} tasks in {self.n_batches} batches over {self.n_workers} workers, makespan {self.makespan:.1f}s, lower bound {self.lower_bound:.1f}s ({efficiency:.0%})', flush=True)
+        if self.predicted:
+            print(f'  expected from the lengths: longest first {self.predicted["longest_first"] / self.predicted["file_order"]:.0%} of the makespan in file order', flush=True)
+        for pid, utilisation in sorted(self.utilisation.items()):
+            print(f'  worker {pid}: busy {self.busy[pid]:.1f}s ({utilisation:.0%})', flush=True)
+
+
+def run_scheduled(parallel : Parallel, function : Callable, calls : List[tuple], costs : Sequence[float], kwargs : Optional[dict] = None, name : str = 'tasks', pack : bool = True, max_batch : Optional[int] = None, overhead : Optional[float] = None) -> ScheduleReport:
+    r"""
+    Run function(*args, **kwargs) for every args of calls on the workers of parallel, longest first (see plan_batches),
+    with one joblib task per batch dispatched as soon as a worker is free, and print the ScheduleReport.
+
+    Parameters
+    ------------
+
+    parallel: joblib.Parallel,
+        the pool of workers
+    function: callable,
+        the worker function
+    calls: list,
+        the positional arguments of every call
+    costs: sequence,
+        the cost of every call, with the same order of calls
+    kwargs: dict, default None,
+        keyword arguments of all the calls
+    name: str, default 'tasks',
+        name printed in the report
+    pack: bool, default True,
+        whether the cheap calls can be packed in batches when it shortens the run, otherwise every call is a batch (e.g. calls
+        already taking a batch of segments)
+    max_batch: int, default None,
+        maximum number of calls of a batch
+    overhead: float, default None,
+        cost of dispatching a batch to a worker, in the units of costs (see plan_batches), DISPATCH_OVERHEAD times the
+        median cost when None
+
+    Returns
+    ------------
+
+    The ScheduleReport, with the results of the calls in results (in the order of calls)
+    """
+    costs = np.asarray(costs, dtype=np.float64)
+    n_workers = effective_n_jobs(parallel.n_jobs)
+    if overhead is None:
+        overhead = DISPATCH_OVERHEAD * float(np.median(costs)) if len(costs) else 0.0
+    batches = plan_batches(costs, n_workers, max_batch=max_batch, overhead=overhead if pack else 0.0)
+
+    # batch_size=1: joblib must not group the batches again, so they are dispatched in order to the first free worker,
+    # the pool of the caller is given back as it was (e.g. reused for the next archive)
+    batch_size, parallel.batch_size = parallel.batch_size, 1
+    try:
+        timings = parallel(delayed(_run_batch)(function, [calls[idx] for idx in batch], kwargs or {}) for batch in batches)
+    finally:
+        parallel.batch_size = batch_size
+
+    # The makespan of the batches that have been run, with the same dispatch overhead as the file order
+    predicted = {'file_order': simulate_makespan(costs + overhead, n_workers), 'longest_first': simulate_makespan([costs[batch].sum() + overhead for batch in batches], n_workers)} if costs.sum() > 0 else None
+    report = ScheduleReport(name, timings, n_workers, predicted)
+    if timings:
+        report.print()
+
+    report.results = [None] * len(calls)
+    for batch, timing in zip(batches, timings):
+        for idx, result in zip(batch, timing['results']):
+            report.results[idx] = result
+    return report
@@ -0,0 +1,427 @@
+import json
+import os
+import sqlite3
+import sys
+import time
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS segments (
+    segment_id TEXT PRIMARY KEY,
+    parent_folder TEXT NOT NULL,
+    patient_id TEXT NOT NULL,
+    seg_id TEXT NOT NULL,
+    duration REAL,
+    fs REAL,
+    channels TEXT,
+    status TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS segments_by_patient ON segments (patient_id);
+CREATE INDEX IF NOT EXISTS segments_by_status ON segments (status, patient_id);
+CREATE INDEX IF NOT EXISTS segments_by_duration ON segments (duration);
+CREATE TABLE IF NOT EXISTS patient_counts (
+    status TEXT NOT NULL,
+    patient_id TEXT NOT NULL,
+    n INTEGER NOT NULL,
+    PRIMARY KEY (status, patient_id)
+);
+CREATE TABLE IF NOT EXISTS counts (
+    name TEXT PRIMARY KEY,
+    n INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TRIGGER IF NOT EXISTS patient_counts_insert AFTER INSERT ON patient_counts BEGIN
+    INSERT INTO counts SELECT 'patients:' || NEW.status, 0 WHERE NOT EXISTS (SELECT 1 FROM counts WHERE name = 'patients:' || NEW.status);
+    UPDATE counts SET n = n + 1 WHERE name = 'patients:' || NEW.status;
+END;
+CREATE TRIGGER IF NOT EXISTS patient_counts_delete AFTER DELETE ON patient_counts BEGIN
+    UPDATE counts SET n = n - 1 WHERE name = 'patients:' || OLD.status;
+END;
+"""
+
+# Segments and patients of every status are also counted under this status
+ALL = '*'
+
+# Statuses written by the pipeline, any other string can be used (e.g. by the download_utils scripts)
+STATUSES = ['valid', 'downloading', 'downloaded', 'discarded', 'preprocessed', 'removed']
+
+
+def _add_statements(row : str, status : str) -> str:
+    # One more segment of the patient of row (NEW or OLD) with status, rows are created with NOT EXISTS since
+    # the conflict clause of the statement firing the trigger (e.g. an upsert) would override an INSERT OR IGNORE
+    return f"""
+    INSERT INTO patient_counts SELECT {status}, {row}.patient_id, 0 WHERE NOT EXISTS (SELECT 1 FROM patient_counts WHERE status = {status} AND patient_id = {row}.patient_id);
+    UPDATE patient_counts SET n = n + 1 WHERE status = {status} AND patient_id = {row}.patient_id;
+    INSERT INTO counts SELECT 'segments:' || {status}, 0 WHERE NOT EXISTS (SELECT 1 FROM counts WHERE name = 'segments:' || {status});
+    UPDATE counts SET n = n + 1 WHERE name = 'segments:' || {status};"""
+
+
+def _remove_statements(row : str, status : str) -> str:
+    # One less segment of the patient of row with status, the patient is removed from patient_counts at zero
+    return f"""
+    UPDATE patient_counts SET n = n - 1 WHERE status = {status} AND patient_id = {row}.patient_id;
+    DELETE FROM patient_counts WHERE status = {status} AND patient_id = {row}.patient_id AND n = 0;
+    UPDATE counts SET n = n - 1 WHERE name = 'segments:' || {status};"""
+
+
+# Counts are kept up to date by triggers, so that counting segments and patients is a primary key lookup
+SEGMENT_TRIGGERS = {
+    'segments_insert': f"""CREATE TRIGGER IF NOT EXISTS segments_insert AFTER INSERT ON segments BEGIN{_add_statements('NEW', f"'{ALL}'")}{_add_statements('NEW', 'NEW.status')}
+END;""",
+    'segments_delete': f"""CREATE TRIGGER IF NOT EXISTS segments_delete AFTER DELETE ON segments BEGIN{_remove_statements('OLD', f"'{ALL}'")}{_remove_statements('OLD', 'OLD.status')}
+END;""",
+    'segments_status': f"""CREATE TRIGGER IF NOT EXISTS segments_status AFTER UPDATE OF status ON segments WHEN OLD.status <> NEW.status BEGIN{_remove_statements('OLD', 'OLD.status')}{_add_statements('NEW', 'NEW.status')}
+END;""",
+}
+TRIGGERS = '\n'.join(SEGMENT_TRIGGERS.values())
+
+# Above this number of rows, a write drops the segment triggers and counts everything again once at the end
+BULK_ROWS = 1000
+
+
+def split_segment_id(segment_id : str) -> Tuple[str, str, str]:
+    r"""
+    parent_folder, patient_id and seg_id of a segment in the parent_folder/patient_id/seg_id format
+    (a longer path, e.g. a records directory, is accepted).
+    """
+    parts = segment_id.strip().replace(os.sep, '/').split('/')
+    if len(parts) < 3:
+        raise ValueError(f'{segment_id} is not in the parent_folder/patient_id/seg_id format')
+    return parts[-3], parts[-2], parts[-1]
+
+
+def read_segments_txt(txt_path : str) -> Tuple[str, List[str]]:
+    r"""
+    Database name (first line) and segments (following lines, blank lines skipped) of a txt list of segments.
+    """
+    with open(txt_path, 'r') as f:
+        database_name = f.readline().strip()
+        segments = [line.strip() for line in f if line.strip()]
+    return database_name, segments
+
+
+class SegmentCatalog:
+    r"""
+    SQLite catalog of the segments of a database: patient, parent folder, duration, sampling frequency, channels and
+    status in the pipeline (valid after the data provisioning, then downloaded or discarded, preprocessed or removed).
+    It replaces the txt lists (database name on the first line, one segment per line) that can still be imported
+    and exported with import_txt and export_txt.
+
+    Segments are indexed by patient, status and duration, and the number of segments and of patients of every
+    status are kept by triggers, so counting does not scan the catalog (writes of more than BULK_ROWS segments
+    drop the triggers and count everything once at the end instead). Every write is a single transaction, so
+    workers and scripts can update the same catalog.
+
+    Parameters
+    ------------
+
+    catalog_path: str,
+        location of the SQLite file, created if it does not exist (':memory:' for a temporary catalog)
+    """
+
+    def __init__(self, catalog_path : str):
+        self.catalog_path = catalog_path
+        self._connection = sqlite3.connect(catalog_path, timeout=60)
+        with self._connection:
+            self._connection.executescript(SCHEMA + TRIGGERS)
+
+    @property
+    def database_name(self) -> Optional[str]:
+        row = self._connection.execute("SELECT value FROM meta WHERE key = 'database_name'").fetchone()
+        return row[0] if row is not None else None
+
+    def _set_database_name(self, database_name : Optional[str]) -> None:
+        # A catalog holds the segments of a single database, as a txt list
+        if database_name is None:
+            return
+        current = self.database_name
+        if current is not None and current != database_name:
+            raise ValueError(f'{self.catalog_path} is a catalog of {current}, not of {database_name}')
+        self._connection.execute("INSERT OR IGNORE INTO meta VALUES ('database_name', ?)", (database_name,))
+
+    def add(self, segment_ids : Iterable[str], status : str = 'valid', database_name : Optional[str] = None, replace_status : bool = False, remove_others : bool = False) -> int:
+        r"""
+        Add segments to the catalog, in the given order (the order of export_txt).
+
+        Parameters
+        ------------
+
+        segment_ids: iterable,
+            the segments in the parent_folder/patient_id/seg_id format
+        status: str, default 'valid',
+            status of the new segments
+        database_name: str, default None,
+            the name of the dataset, it must match the one of the catalog
+        replace_status: bool, default False,
+            whether segments already in the catalog take status too, otherwise they keep their own
+            (e.g. the valid segments listed again after a download stay downloaded)
+        remove_others: bool, default False,
+            whether the segments of the catalog that are not given are removed, whatever their status (e.g. the
+            segments of a previous data provisioning with another min_duration)
+
+        Returns
+        ------------
+
+        The number of segments given
+        """
+        now = time.time()
+        rows = [('/'.join(parts), *parts, status, now) for parts in (split_segment_id(segment_id) for segment_id in segment_ids if segment_id.strip())]
+        on_conflict = 'DO UPDATE SET status = excluded.status, updated_at = excluded.updated_at' if replace_status else 'DO NOTHING'
+
+        bulk = len(rows) > BULK_ROWS
+        with self._connection:
+            if bulk:
+                self._begin_bulk()
+            self._set_database_name(database_name)
+            if bulk:
+                self._drop_triggers()
+            self._connection.executemany(f'INSERT INTO segments (segment_id, parent_folder, patient_id, seg_id, status, updated_at) VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (segment_id) {on_conflict}', rows)
+            if remove_others:
+                self._connection.execute('CREATE TEMP TABLE IF NOT EXISTS given (segment_id TEXT PRIMARY KEY)')
+                self._connection.execute('DELETE FROM temp.given')
+                self._connection.executemany('INSERT OR IGNORE INTO temp.given VALUES (?)', [row[:1] for row in rows])
+                self._connection.execute('DELETE FROM segments WHERE segment_id NOT IN (SELECT segment_id FROM temp.given)')
+                self._connection.execute('DELETE FROM temp.given')
+            if bulk:
+                self._recount()
+        return len(rows)
+
+    def _begin_bulk(self) -> None:
+        # DDL does not open a transaction by itself (sqlite3 only opens one before INSERT, UPDATE and DELETE): the bulk
+        # write locks the catalog from the start, so that no other connection writes while the triggers are dropped and
+        # a crash before _recount rolls the drop back
+        self._connection.execute('BEGIN IMMEDIATE')
+
+    def _drop_triggers(self) -> None:
+        # Inside the transaction opened by _begin_bulk, other connections never see the catalog without its triggers
+        for name in SEGMENT_TRIGGERS:
+            self._connection.execute(f'DROP TRIGGER IF EXISTS {name}')
+
+    def _recount(self) -> None:
+        # Counts from scratch with a few GROUP BY, then the triggers are back (patient_counts keeps its own, which fill the patient counts)
+        self._connection.execute('DELETE FROM patient_counts')
+        self._connection.execute('DELETE FROM counts')
+        self._connection.execute('INSERT INTO patient_counts SELECT status, patient_id, COUNT(*) FROM segments GROUP BY status, patient_id')
+        self._connection.execute('INSERT INTO patient_counts SELECT ?, patient_id, COUNT(*) FROM segments GROUP BY patient_id', (ALL,))
+        self._connection.execute("INSERT INTO counts SELECT 'segments:' || status, COUNT(*) FROM segments GROUP BY status")
+        self._connection.execute("INSERT INTO counts SELECT 'segments:' || ?, COUNT(*) FROM segments", (ALL,))
+        for statement in SEGMENT_TRIGGERS.values():
+            self._connection.execute(statement)
+
+    def set_status(self, segment_ids : Iterable[str], status : str, database_name : Optional[str] = None) -> int:
+        r"""
+        Move segments to status, adding the ones not in the catalog yet.
+        """
+        return self.add(segment_ids, status, database_name, replace_status=True)
+
+    def set_info(self, segment_id : str, duration : Optional[float] = None, fs : Optional[float] = None, channels : Optional[List[str]] = None) -> None:
+        r"""
+        Duration (in minutes, as the min_duration of the data provisioning), sampling frequency and channels of a
+        segment of the catalog, None values are left as they are.
+        """
+        with self._connection:
+            self._connection.execute('UPDATE segments SET duration = COALESCE(?, duration), fs = COALESCE(?, fs), channels = COALESCE(?, channels), updated_at = ? WHERE segment_id = ?',
+                                     (duration, fs, json.dumps(list(channels)) if channels is not None else None, time.time(), segment_id))
+
+    def fill_from_header_index(self, index_path : str) -> int:
+        r"""
+        Duration, sampling frequency and channels of the segments from the headers of a header index (see header_index.py),
+        with a single query. Returns the number of segments found in the index.
+        """
+        self._connection.execute('ATTACH DATABASE ? AS header_index', (index_path,))
+        try:
+            with self._connection:
+                cursor = self._connection.execute("""
+                    UPDATE segments SET duration = CAST(h.sig_len AS REAL) / (h.fs * 60), fs = h.fs, channels = h.sig_name, updated_at = ?
+                    FROM header_index.headers h
+                    WHERE h.record_key = ? || '/' || segments.segment_id AND h.found = 1
+                """, (time.time(), self.database_name))
+        finally:
+            self._connection.execute('DETACH DATABASE header_index')
+        return cursor.rowcount
+
+    def fill_from_store(self, store_dir : str) -> int:
+        r"""
+        Duration, sampling frequency and channels of the segments saved in a SegmentStore (see segment_store.py), from
+        its index. Returns the number of segments found in the store.
+        """
+        self._connection.execute('ATTACH DATABASE ? AS store', (os.path.join(store_dir, 'index.sqlite'),))
+        try:
+            with self._connection:
+                cursor = self._connection.execute("""
+                    UPDATE segments SET duration = CAST(s.length AS REAL) / (s.fs * 60), fs = s.fs, channels = s.channels, updated_at = ?
+                    FROM store.segments s
+                    WHERE s.segment_id = segments.segment_id AND s.removed = 0
+                """, (time.time(),))
+        finally:
+            self._connection.execute('DETACH DATABASE store')
+        return cursor.rowcount
+
+    def remove(self, segment_ids : Iterable[str]) -> None:
+        with self._connection:
+            self._connection.executemany('DELETE FROM segments WHERE segment_id = ?', [(segment_id.strip(),) for segment_id in segment_ids])
+
+    def info(self, segment_id : str) -> dict:
+        r"""
+        Catalog entry of a segment (parent_folder, patient_id, seg_id, duration, fs, channels, status), KeyError when it is not in the catalog.
+        """
+        row = self._connection.execute('SELECT parent_folder, patient_id, seg_id, duration, fs, channels, status FROM segments WHERE segment_id = ?', (segment_id,)).fetchone()
+        if row is None:
+            raise KeyError(segment_id)
+
+        parent_folder, patient_id, seg_id, duration, fs, channels, status = row
+        return {'parent_folder': parent_folder, 'patient_id': patient_id, 'seg_id': seg_id, 'duration': duration, 'fs': fs, 'channels': json.loads(channels) if channels is not None else None, 'status': status}
+
+    def segments(self, status : Optional[Union[str, List[str]]] = None, patient_id : Optional[str] = None, min_duration : Optional[float] = None, max_duration : Optional[float] = None) -> List[str]:
+        r"""
+        The segments matching all the given conditions, in the order they have been added, each condition uses an index.
+
+        Parameters
+        ------------
+
+        status: str or list, default None,
+            status of the segments, or any of a list of statuses
+        patient_id: str, default None,
+            patient of the segments (e.g. p000020)
+        min_duration: float, default None,
+            minimum duration in minutes (segments without a duration do not match)
+        max_duration: float, default None,
+            maximum duration in minutes
+
+        Returns
+        ------------
+
+        A list of segments in the parent_folder/patient_id/seg_id format
+        """
+        conditions, values = [], []
+        if isinstance(status, (list, tuple, set)):
+            conditions.append(f'status IN ({", ".join("?" * len(status))})')
+            values.extend(status)
+            status = None
+        for condition, value in [('status = ?', status), ('patient_id = ?', patient_id), ('duration >= ?', min_duration), ('duration <= ?', max_duration)]:
+            if value is not None:
+                conditions.append(condition)
+                values.append(value)
+
+        where = f'WHERE {" AND ".join(conditions)}' if conditions else ''
+        return [row[0] for row in self._connection.execute(f'SELECT segment_id FROM segments {where} ORDER BY rowid', values)]
+
+    def durations(self, status : Optional[str] = None) -> Dict[str, float]:
+        r"""
+        Duration in minutes of the segments of status (all when None) whose duration is known (e.g. to schedule the longest first, see scheduling.py).
+        """
+        where, values = ('AND status = ?', (status,)) if status is not None else ('', ())
+        return dict(self._connection.execute(f'SELECT segment_id, duration FROM segments WHERE duration IS NOT NULL {where}', values))
+
+    def patients(self, status : Optional[str] = None) -> List[str]:
+        r"""
+        The patients with at least one segment of status (any status when None).
+        """
+        return [row[0] for row in self._connection.execute('SELECT patient_id FROM patient_counts WHERE status = ? ORDER BY patient_id', (status if status is not None else ALL,))]
+
+    def _count(self, name : str) -> int:
+        row = self._connection.execute('SELECT n FROM counts WHERE name = ?', (name,)).fetchone()
+        return row[0] if row is not None else 0
+
+    def count(self, status : Optional[str] = None) -> int:
+        r"""
+        Number of segments of status (all the segments when None).
+        """
+        return self._count(f'segments:{status if status is not None else ALL}')
+
+    def count_patients(self, status : Optional[str] = None) -> int:
+        r"""
+        Number of different patients with segments of status (all the patients when None).
+        """
+        return self._count(f'patients:{status if status is not None else ALL}')
+
+    def status_counts(self) -> Dict[str, Tuple[int, int]]:
+        r"""
+        Number of patients and segments of every status (e.g. {'valid': (6, 30)}).
+        """
+        counts = {}
+        for name, n in self._connection.execute("SELECT name, n FROM counts WHERE n > 0 AND name NOT LIKE ?", (f'%:{ALL}',)):
+            kind, status = name.split(':', 1)
+            patients, segments = counts.get(status, (0, 0))
+            counts[status] = (n, segments) if kind == 'patients' else (patients, n)
+        return dict(sorted(counts.items()))
+
+    def import_txt(self, txt_path : str, status : str = 'valid', replace_status : bool = False, remove_others : bool = False) -> int:
+        r"""
+        Add the segments of a txt list (database name on the first line, a segment per line) with status, see add.
+        Returns the number of segments of the list.
+        """
+        database_name, segments = read_segments_txt(txt_path)
+        return self.add(segments, status, database_name, replace_status, remove_others)
+
+    def export_txt(self, txt_path : str, status : Optional[Union[str, List[str]]] = None, **conditions) -> str:
+        r"""
+        Write the segments matching status and conditions (see segments) as a txt list, with the database name on the
+        first line, in the order they have been added. Returns txt_path.
+        """
+        segment_ids = self.segments(status, **conditions)
+        with open(f'{txt_path}.tmp', 'w') as f:
+            f.write(f'{self.database_name}\n')
+            for segment_id in segment_ids:
+                f.write(f'{segment_id}\n')
+        os.replace(f'{txt_path}.tmp', txt_path)
+        return txt_path
+
+    def merge(self, catalog_path : str) -> int:
+        r"""
+        Add the segments of another catalog (e.g. of a shard), with their information, a segment in both takes the other status.
+        Returns the number of segments of the other catalog.
+        """
+        other = SegmentCatalog(catalog_path)
+        database_name, n_segments = other.database_name, other.count()
+        other.close()
+
+        self._connection.execute('ATTACH DATABASE ? AS other', (catalog_path,))
+        try:
+            bulk = n_segments > BULK_ROWS
+            with self._connection:
+                if bulk:
+                    self._begin_bulk()
+                self._set_database_name(database_name)
+                if bulk:
+                    self._drop_triggers()
+                self._connection.execute("""
+                    INSERT INTO segments SELECT * FROM other.segments WHERE true ORDER BY rowid
+                    ON CONFLICT (segment_id) DO UPDATE SET duration = COALESCE(excluded.duration, duration), fs = COALESCE(excluded.fs, fs),
+                    channels = COALESCE(excluded.channels, channels), status = excluded.status, updated_at = excluded.updated_at
+                """)
+                if bulk:
+                    self._recount()
+        finally:
+            self._connection.execute('DETACH DATABASE other')
+        return n_segments
+
+    def __contains__(self, segment_id : str) -> bool:
+        return self._connection.execute('SELECT 1 FROM segments WHERE segment_id = ?', (segment_id,)).fetchone() is not None
+
+    def __len__(self) -> int:
+        return self.count()
+
+    def close(self) -> None:
+        self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+if __name__ == '__main__':
+    # python segment_catalog.py catalog.sqlite [list.txt status ...]
+    with SegmentCatalog(sys.argv[1]) as catalog:
+        for txt_path, status in zip(sys.argv[2::2], sys.argv[3::2]):
+            print(f'Imported {catalog.import_txt(txt_path, status, replace_status=True)} segments of {txt_path} as {status}')
+        print(f'{catalog.database_name}: {catalog.count_patients()} patients, {catalog.count()} segments')
+        for status, (num_patients, num_records) in catalog.status_counts().items():
+            print(f'  {status}: {num_patients} patients, {num_records} segments')
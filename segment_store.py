@@ -0,0 +1,249 @@
+import json
+import os
+import sqlite3
+import time
+from contextlib import contextmanager
+from typing import List, Optional
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+    import msvcrt
+
+
+# Signals are stored as they come from wfdb.rdrecord
+DTYPE = np.float64
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS segments (
+    segment_id TEXT PRIMARY KEY,
+    group_name TEXT NOT NULL,
+    offset INTEGER NOT NULL,
+    length INTEGER NOT NULL,
+    fs REAL NOT NULL,
+    channels TEXT NOT NULL,
+    units TEXT,
+    removed INTEGER NOT NULL DEFAULT 0,
+    stored_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS segments_by_group ON segments (group_name, offset);
+"""
+
+
+@contextmanager
+def _locked(data_file):
+    # Exclusive lock of a data file, shared by threads and processes appending to it
+    if fcntl is not None:
+        fcntl.flock(data_file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(data_file.fileno(), fcntl.LOCK_UN)
+    else:
+        # msvcrt locks a byte range from the current position, the first byte acts as the lock of the file
+        data_file.seek(0)
+        msvcrt.locking(data_file.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            data_file.seek(0)
+            msvcrt.locking(data_file.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+class SegmentStore:
+    r"""
+    Store of the signals of many segments in a few large files. The segments of a patient group (e.g. p00) are
+    appended to the same data file, channel after channel, and a SQLite index keeps where each segment starts,
+    its length, sampling frequency and channels. Segments are read by ID as np.memmap views of the data file,
+    without copies, instead of opening two .npy files in a directory per segment.
+
+    Appends take an exclusive lock on the data file, so parallel workers can write to the same store. Removed
+    segments are only marked in the index (tombstones), their space is reclaimed by compact.
+
+    Parameters
+    ------------
+
+    store_dir: str,
+        directory of the data files and of the index, created if it does not exist
+    """
+
+    def __init__(self, store_dir : str):
+        self.store_dir = store_dir
+        os.makedirs(store_dir, exist_ok=True)
+        self._connection = sqlite3.connect(os.path.join(store_dir, 'index.sqlite'), timeout=60)
+        self._connection.executescript(SCHEMA)
+
+    @staticmethod
+    def group_of(segment_id : str) -> str:
+        r"""
+        The group of a segment is the parent folder of its patient (e.g. p00 for p00/p000020/3000020_0001).
+        """
+        return segment_id.split('/')[0]
+
+    def data_path(self, group_name : str) -> str:
+        return os.path.join(self.store_dir, f'{group_name}.dat')
+
+    def append(self, segment_id : str, signals, fs : float, channels : List[str], units : Optional[List[str]] = None, block_size : int = 2**18) -> None:
+        r"""
+        Append the signals of a segment at the end of the data file of its group. A segment already in the store
+        is replaced, the old signals become a tombstone.
+
+        Parameters
+        ------------
+
+        segment_id: str,
+            the segment in the parent_folder/patient_id/seg_id format
+        signals: np.array or list,
+            a 2D array (channels x samples) or a list of 1D arrays of the same length, memory maps included
+        fs: float,
+            the sampling frequency
+        channels: list,
+            the names of the channels
+        units: list, default None,
+            the units of the channels
+        block_size: int, default 2**18,
+            number of samples written at once, signals in memory maps are never loaded entirely
+
+        Returns
+        ------------
+        None
+        """
+        length = len(signals[0])
+        if length == 0:
+            raise ValueError(f'{segment_id} has no samples, it cannot be stored')
+        group_name = self.group_of(segment_id)
+
+        with open(self.data_path(group_name), 'ab') as data_file:
+            with _locked(data_file):
+                data_file.seek(0, os.SEEK_END)
+                offset = data_file.tell()
+                for signal in signals:
+                    for block_start in range(0, length, block_size):
+                        data_file.write(np.ascontiguousarray(signal[block_start : block_start + block_size], dtype=DTYPE).tobytes())
+                data_file.flush()
+                os.fsync(data_file.fileno())
+
+        with self._connection:
+            self._connection.execute('INSERT OR REPLACE INTO segments VALUES (?, ?, ?, ?, ?, ?, ?, 0, ?)',
+                                     (segment_id, group_name, offset, length, float(fs), json.dumps(list(channels)), json.dumps(list(units)) if units is not None else None, time.time()))
+
+    def info(self, segment_id : str) -> dict:
+        r"""
+        Index entry of a segment (group_name, offset, length, fs, channels, units), KeyError when it is not in the store.
+        """
+        row = self._connection.execute('SELECT group_name, offset, length, fs, channels, units FROM segments WHERE segment_id = ? AND removed = 0', (segment_id,)).fetchone()
+        if row is None:
+            raise KeyError(segment_id)
+
+        group_name, offset, length, fs, channels, units = row
+        return {'group_name': group_name, 'offset': offset, 'length': length, 'fs': fs, 'channels': json.loads(channels), 'units': json.loads(units) if units is not None else None}
+
+    def read(self, segment_id : str, mode : str = 'r') -> np.memmap:
+        r"""
+        Zero-copy view of the signals of a segment.
+
+        Parameters
+        ------------
+
+        segment_id: str,
+            the segment in the parent_folder/patient_id/seg_id format
+        mode: str, default 'r',
+            'r' to read, 'r+' to modify the signals in place (e.g. to interpolate them)
+
+        Returns
+        ------------
+
+        A (channels x samples) np.memmap, the order of the channels is the one given by info
+        """
+        entry = self.info(segment_id)
+        shape = (len(entry['channels']), entry['length'])
+        if entry['length'] == 0:
+            # np.memmap cannot map 0 bytes (e.g. stores written before append rejected empty segments)
+            return np.empty(shape, dtype=DTYPE)
+        return np.memmap(self.data_path(entry['group_name']), dtype=DTYPE, mode=mode, offset=entry['offset'], shape=shape)
+
+    def read_channel(self, segment_id : str, channel : str, mode : str = 'r') -> np.memmap:
+        r"""
+        Zero-copy view of one channel (e.g. 'ABP') of a segment.
+        """
+        return self.read(segment_id, mode)[self.info(segment_id)['channels'].index(channel)]
+
+    def remove(self, segment_id : str) -> None:
+        r"""
+        Mark a segment as removed, its space is reclaimed by compact.
+        """
+        with self._connection:
+            self._connection.execute('UPDATE segments SET removed = 1 WHERE segment_id = ?', (segment_id,))
+
+    def segment_ids(self, group_name : Optional[str] = None) -> List[str]:
+        r"""
+        The segments in the store (removed ones excluded), in the order they have been written.
+        """
+        if group_name is None:
+            rows = self._connection.execute('SELECT segment_id FROM segments WHERE removed = 0 ORDER BY group_name, offset')
+        else:
+            rows = self._connection.execute('SELECT segment_id FROM segments WHERE removed = 0 AND group_name = ? ORDER BY offset', (group_name,))
+        return [row[0] for row in rows]
+
+    def groups(self) -> List[str]:
+        return [row[0] for row in self._connection.execute('SELECT DISTINCT group_name FROM segments ORDER BY group_name')]
+
+    def __contains__(self, segment_id : str) -> bool:
+        return self._connection.execute('SELECT 1 FROM segments WHERE segment_id = ? AND removed = 0', (segment_id,)).fetchone() is not None
+
+    def __len__(self) -> int:
+        return self._connection.execute('SELECT COUNT(*) FROM segments WHERE removed = 0').fetchone()[0]
+
+    def compact(self, block_size : int = 2**18) -> None:
+        r"""
+        Rewrite the data files without removed or replaced segments. It must not run while other processes use the store.
+
+        Parameters
+        ------------
+
+        block_size: int, default 2**18,
+            number of samples copied at once
+
+        Returns
+        ------------
+        None
+        """
+        for group_name in self.groups():
+            rows = self._connection.execute('SELECT segment_id, offset, length, channels FROM segments WHERE group_name = ? AND removed = 0 ORDER BY offset', (group_name,)).fetchall()
+            data_path = self.data_path(group_name)
+            live_bytes = sum(length * len(json.loads(channels)) for _, _, length, channels in rows) * np.dtype(DTYPE).itemsize
+            if os.path.getsize(data_path) == live_bytes:
+                continue
+
+            new_offsets = []
+            tmp_path = f'{data_path}.compact'
+            with open(tmp_path, 'wb') as tmp_file:
+                for segment_id, offset, length, channels in rows:
+                    new_offsets.append((tmp_file.tell(), segment_id))
+                    if length == 0:
+                        continue
+                    signals = np.memmap(data_path, dtype=DTYPE, mode='r', offset=offset, shape=(len(json.loads(channels)) * length,))
+                    for block_start in range(0, len(signals), block_size):
+                        tmp_file.write(signals[block_start : block_start + block_size].tobytes())
+                    del signals
+                tmp_file.flush()
+                os.fsync(tmp_file.fileno())
+
+            with self._connection:
+                self._connection.executemany('UPDATE segments SET offset = ? WHERE segment_id = ?', new_offsets)
+                self._connection.execute('DELETE FROM segments WHERE group_name = ? AND removed = 1', (group_name,))
+                os.replace(tmp_path, data_path)
+
+            print(f'Compacted {data_path}: {len(rows)} segments, {live_bytes / 2**20:.1f} MB', flush=True)
+
+    def close(self) -> None:
+        self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
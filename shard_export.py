@@ -0,0 +1,288 @@
+import glob
+import json
+import os
+import sqlite3
+import time
+from collections import deque
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterator, List, Optional, Tuple
+import numpy as np
+from data_preprocessing import create_windows, estimate_windowed_bp
+from segment_store import SegmentStore
+
+
+# Windows are stored as (PPG, ABP), the input and the target of the models
+CHANNELS = ['PLETH', 'ABP']
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS metadata (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS shards (
+    shard INTEGER PRIMARY KEY,
+    file_name TEXT NOT NULL,
+    n_windows INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS windows (
+    shard INTEGER NOT NULL,
+    row INTEGER NOT NULL,
+    patient_id TEXT NOT NULL,
+    segment_id TEXT NOT NULL,
+    window_offset INTEGER NOT NULL,
+    sbp REAL NOT NULL,
+    dbp REAL NOT NULL,
+    PRIMARY KEY (shard, row)
+);
+CREATE INDEX IF NOT EXISTS windows_by_patient ON windows (patient_id);
+"""
+
+
+def iter_record_segments(records_dir : str) -> Iterator[Tuple[str, np.array, np.array]]:
+    r"""
+    The preprocessed segments of a records directory (parent_folder/patient_id/seg_id/{abp,ppg}.npy), sorted by ID,
+    as (segment_id, abp, ppg) with the signals memory mapped.
+    """
+    for segment_path in sorted(glob.glob(f'{records_dir}/p*/p*/*')):
+        if not os.path.exists(os.path.join(segment_path, 'abp.npy')):
+            continue
+        segment_id = '/'.join(segment_path.replace(os.sep, '/').split('/')[-3:])
+        yield segment_id, np.load(os.path.join(segment_path, 'abp.npy'), mmap_mode='r'), np.load(os.path.join(segment_path, 'ppg.npy'), mmap_mode='r')
+
+
+def iter_store_segments(store_dir : str) -> Iterator[Tuple[str, np.array, np.array]]:
+    r"""
+    The segments of a SegmentStore, sorted by ID, as (segment_id, abp, ppg) memory maps.
+    """
+    with SegmentStore(store_dir) as store:
+        for segment_id in sorted(store.segment_ids()):
+            yield segment_id, store.read_channel(segment_id, 'ABP'), store.read_channel(segment_id, 'PLETH')
+
+
+def export_shards(segments : Iterator[Tuple[str, np.array, np.array]], shard_dir : str, windowing_param : dict, fs : float = 125.0, windows_per_shard : int = 4096, dtype=np.float32) -> int:
+    r"""
+    Cut the preprocessed segments in the windows of create_windows once, and write them in contiguous shards of shape
+    (windows_per_shard, 2, win_len * fs), PPG first and ABP second, so that training does not window the signals again
+    every epoch. Shards are .npy files (shard_00000.npy, ...) read as memory maps by ShardReader, and a SQLite index
+    (index.sqlite) keeps shard, row, patient ID, segment ID, window offset and SBP/DBP (as in the download checks) of
+    every window. Segments are written in the given order, so with sorted segments the windows of a patient are contiguous.
+
+    Parameters
+    ------------
+
+    segments: iterator,
+        (segment_id, abp, ppg) of the preprocessed segments, as given by iter_record_segments or iter_store_segments
+    shard_dir: str,
+        directory of the shards and of the index, its previous content is replaced
+    windowing_param: dict,
+        contains parameters tos etup the sliding window (length in seconds and overlap)
+    fs: float, default 125.0,
+        the sampling frequency of the signals
+    windows_per_shard: int, default 4096,
+        number of windows of a shard (the last one can be shorter)
+    dtype: default np.float32,
+        type of the samples in the shards
+
+    Returns
+    ------------
+
+    The number of windows written
+    """
+    os.makedirs(shard_dir, exist_ok=True)
+    for old_file in glob.glob(os.path.join(shard_dir, 'shard_*.npy')) + glob.glob(os.path.join(shard_dir, 'index.sqlite')):
+        os.remove(old_file)
+
+    window_size = int(round(windowing_param['win_len'] * fs))
+    buffer = np.empty((windows_per_shard, len(CHANNELS), window_size), dtype=dtype)
+    rows = []
+    n_shards = 0
+    n_windows = 0
+
+    connection = sqlite3.connect(os.path.join(shard_dir, 'index.sqlite'))
+    connection.executescript(SCHEMA)
+
+    def write_shard():
+        nonlocal n_shards
+        file_name = f'shard_{n_shards:05d}.npy'
+        np.save(os.path.join(shard_dir, file_name), buffer[:len(rows)])
+        with connection:
+            connection.execute('INSERT INTO shards VALUES (?, ?, ?)', (n_shards, file_name, len(rows)))
+            connection.executemany('INSERT INTO windows VALUES (?, ?, ?, ?, ?, ?, ?)', [(n_shards, row, *entry) for row, entry in enumerate(rows)])
+        print(f'Written {file_name} with {len(rows)} windows', flush=True)
+        n_shards += 1
+        rows.clear()
+
+    start = time.time()
+    for segment_id, abp, ppg in segments:
+        win_start, win_stop = create_windows(windowing_param['win_len'], fs, len(abp), windowing_param['win_overlap'])
+        if len(win_start) == 0:
+            continue
+
+        # Same SBP/DBP of the download checks
+        SBP, DBP = estimate_windowed_bp(abp, win_start, win_stop)
+        patient_id = segment_id.split('/')[1]
+
+        # Windows are strided views of the signals, copied straight in the shard buffer
+        abp_windows = np.lib.stride_tricks.sliding_window_view(abp, window_size)
+        ppg_windows = np.lib.stride_tricks.sliding_window_view(ppg, window_size)
+
+        for i in range(len(win_start)):
+            buffer[len(rows), 0] = ppg_windows[win_start[i]]
+            buffer[len(rows), 1] = abp_windows[win_start[i]]
+            rows.append((patient_id, segment_id, int(win_start[i]), float(SBP[i]), float(DBP[i])))
+            n_windows += 1
+            if len(rows) == windows_per_shard:
+                write_shard()
+
+    if rows:
+        write_shard()
+
+    with connection:
+        metadata = {'fs': fs, 'win_len': windowing_param['win_len'], 'win_overlap': windowing_param['win_overlap'], 'window_size': window_size, 'channels': CHANNELS, 'dtype': np.dtype(dtype).name}
+        connection.executemany('INSERT OR REPLACE INTO metadata VALUES (?, ?)', [(key, json.dumps(value)) for key, value in metadata.items()])
+    connection.close()
+
+    print(f'Exported {n_windows} windows in {n_shards} shards in {time.time() - start:.1f}s', flush=True)
+    return n_windows
+
+
+class ShardReader:
+    r"""
+    Batches of the windows exported by export_shards. Shards are opened as read-only memory maps, and the index is
+    loaded in memory as arrays (index[column][i] for the i-th window, in shard and row order).
+
+    - window(i) and the batches of consecutive windows of a shard (e.g. mode='patient') are views of the memory maps, without copies
+    - random batches gather their windows, shard by shard in row order, with one copy into the batch array
+
+    Batches are prepared by background threads, prefetch batches ahead of the one in use.
+
+    Parameters
+    ------------
+
+    shard_dir: str,
+        directory written by export_shards
+    """
+
+    def __init__(self, shard_dir : str):
+        self.shard_dir = shard_dir
+
+        with closing(sqlite3.connect(os.path.join(shard_dir, 'index.sqlite'))) as connection:
+            self.metadata = {key: json.loads(value) for key, value in connection.execute('SELECT key, value FROM metadata')}
+            shards = connection.execute('SELECT file_name, n_windows FROM shards ORDER BY shard').fetchall()
+            rows = connection.execute('SELECT shard, row, patient_id, segment_id, window_offset, sbp, dbp FROM windows ORDER BY shard, row').fetchall()
+
+        self.shards = [np.load(os.path.join(shard_dir, file_name), mmap_mode='r') for file_name, _ in shards]
+        self.shard_starts = np.concatenate(([0], np.cumsum([n_windows for _, n_windows in shards]))).astype(int)
+
+        columns = list(zip(*rows)) if rows else [[]] * 7
+        self.index = {
+            'shard': np.array(columns[0], dtype=int),
+            'row': np.array(columns[1], dtype=int),
+            'patient_id': np.array(columns[2], dtype=object),
+            'segment_id': np.array(columns[3], dtype=object),
+            'window_offset': np.array(columns[4], dtype=int),
+            'sbp': np.array(columns[5], dtype=np.float64),
+            'dbp': np.array(columns[6], dtype=np.float64),
+        }
+
+    def __len__(self) -> int:
+        return int(self.shard_starts[-1])
+
+    def window(self, i : int) -> np.array:
+        r"""
+        View of the i-th window, of shape (2, window_size) with PPG first and ABP second.
+        """
+        return self.shards[self.index['shard'][i]][self.index['row'][i]]
+
+    def get_batch(self, indexes : np.array) -> np.array:
+        r"""
+        The windows of indexes, of shape (len(indexes), 2, window_size). Consecutive windows of the same shard are a view,
+        the others are gathered shard by shard (in row order, to read the memory maps sequentially) with one copy.
+        """
+        indexes = np.asarray(indexes, dtype=int)
+        shards = self.index['shard'][indexes]
+        rows = self.index['row'][indexes]
+
+        if len(indexes) and shards[0] == shards[-1] and np.array_equal(rows, np.arange(rows[0], rows[0] + len(rows))):
+            return self.shards[shards[0]][rows[0] : rows[0] + len(rows)]
+
+        batch = np.empty((len(indexes),) + self.shards[0].shape[1:], dtype=self.shards[0].dtype)
+        for shard in np.unique(shards):
+            positions = np.flatnonzero(shards == shard)
+            positions = positions[np.argsort(rows[positions], kind='stable')]
+            batch[positions] = self.shards[shard][rows[positions]]
+        return batch
+
+    def batch_indexes(self, batch_size : int, mode : str = 'random', seed : Optional[int] = None) -> List[np.array]:
+        r"""
+        The windows of the batches of an epoch.
+
+        Parameters
+        ------------
+
+        batch_size: int,
+            maximum number of windows of a batch
+        mode: str, default 'random',
+            'random' for batches of windows drawn at random, 'patient' for batches with the consecutive windows
+            of one patient only (patients in random order, a patient with many windows gives many batches)
+        seed: int, default None,
+            seed of the random order
+
+        Returns
+        ------------
+
+        A list of arrays with the indexes of the windows of every batch
+        """
+        rng = np.random.default_rng(seed)
+
+        if mode == 'random':
+            order = rng.permutation(len(self))
+            return [order[i : i + batch_size] for i in range(0, len(order), batch_size)]
+
+        if mode == 'patient':
+            # Windows of a patient are contiguous (and batches are views) when segments have been exported in ID order
+            order = np.argsort(self.index['patient_id'], kind='stable')
+            _, first, counts = np.unique(self.index['patient_id'][order], return_index=True, return_counts=True)
+            batches = []
+            for patient in rng.permutation(len(first)):
+                windows = order[first[patient] : first[patient] + counts[patient]]
+                batches.extend([windows[i : i + batch_size] for i in range(0, len(windows), batch_size)])
+            return batches
+
+        raise ValueError(f"Unknown batch mode {mode}, use 'random' or 'patient'")
+
+    def batches(self, batch_size : int, mode : str = 'random', seed : Optional[int] = None, prefetch : int = 4, n_threads : int = 2) -> Iterator[Tuple[np.array, Dict[str, np.array]]]:
+        r"""
+        Iterate over the batches of an epoch (see batch_indexes), prepared by n_threads background threads.
+
+        Parameters
+        ------------
+
+        batch_size: int,
+            maximum number of windows of a batch
+        mode: str, default 'random',
+            'random' or 'patient'
+        seed: int, default None,
+            seed of the random order
+        prefetch: int, default 4,
+            number of batches prepared ahead
+        n_threads: int, default 2,
+            number of threads preparing the batches
+
+        Returns
+        ------------
+
+        An iterator of (windows, index) pairs: windows of shape (batch_size, 2, window_size) and the index columns of the batch
+        """
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=n_threads) as executor:
+            for indexes in self.batch_indexes(batch_size, mode, seed):
+                pending.append((executor.submit(self.get_batch, indexes), indexes))
+                if len(pending) > prefetch:
+                    future, batch_indexes = pending.popleft()
+                    yield future.result(), {column: values[batch_indexes] for column, values in self.index.items()}
+
+            while pending:
+                future, batch_indexes = pending.popleft()
+                yield future.result(), {column: values[batch_indexes] for column, values in self.index.items()}
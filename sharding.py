@@ -0,0 +1,388 @@
+import glob
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import time
+import zipfile
+from typing import List, Optional, Tuple
+from event_journal import EVENT_FIELDS, SCHEMA as EVENTS_SCHEMA
+from feature_table import SCHEMA as FEATURES_SCHEMA
+from segment_store import SegmentStore
+from segment_catalog import SegmentCatalog
+
+
+MANIFEST_NAME = 'manifest.json'
+
+# Directory of output_dir where a merge is built before being moved in place
+STAGING_NAME = '.merging'
+
+# Entries of a manifest that are paths, they must exist when given
+MANIFEST_PATHS = ['store_dir', 'features_path', 'journal_path', 'catalog_path', 'spectral_dir']
+
+# Merged SQLite files (kept in a merged dataset that already has them) and merged directories (never overwritten)
+MERGED_SQLITE = ['features.sqlite', 'events.sqlite', 'segments.sqlite']
+MERGED_DIRS = ['records', 'store', 'spectral']
+
+
+def parse_shard(spec : str) -> Tuple[int, int]:
+    r"""
+    Parse a shard given as 'i/N' (e.g. '0/4' is the first of 4 shards) into (i, N).
+    """
+    try:
+        index, n_shards = (int(part) for part in spec.split('/'))
+    except ValueError:
+        raise ValueError(f"Invalid shard {spec}, expected 'i/N'")
+
+    if not 0 <= index < n_shards:
+        raise ValueError(f'Invalid shard {spec}, i must be between 0 and {n_shards - 1}')
+    return index, n_shards
+
+
+def patient_of(path : str) -> str:
+    r"""
+    The patient of a subject (p00/p000020/) or of a segment (p00/p000020/3000020_0001).
+    """
+    return path.strip().strip('/').split('/')[1]
+
+
+def shard_of(patient_id : str, n_shards : int) -> int:
+    r"""
+    The shard of a patient among n_shards. It is computed from a digest of the patient ID, so it is the same on every
+    host and every run (unlike hash(), which is salted per process), and all the segments of a patient are in one shard.
+    """
+    digest = hashlib.blake2b(patient_id.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'big') % n_shards
+
+
+def in_shard(path : str, shard : Optional[Tuple[int, int]]) -> bool:
+    r"""
+    Whether a subject or a segment belongs to shard (i, N), always True when shard is None.
+    """
+    if shard is None:
+        return True
+    return shard_of(patient_of(path), shard[1]) == shard[0]
+
+
+def shard_segments_file(valid_segments_file : str, shard : Tuple[int, int], output_file : str) -> str:
+    r"""
+    Write the segments of a valid segments file that belong to a shard in output_file, database name first.
+    """
+    with open(valid_segments_file, 'r') as f:
+        lines = f.readlines()
+
+    with open(output_file, 'w') as f:
+        f.write(lines[0])
+        for line in lines[1:]:
+            if line.strip() and in_shard(line, shard):
+                f.write(line)
+
+    return output_file
+
+
+def shard_dir(output_dir : str, shard : Tuple[int, int]) -> str:
+    r"""
+    The output directory of a shard inside output_dir (e.g. output/shard_0_of_4).
+    """
+    return os.path.join(output_dir, f'shard_{shard[0]}_of_{shard[1]}')
+
+
+def write_manifest(output_dir : str, shard : Tuple[int, int], database_name : str, **entries) -> str:
+    r"""
+    Create or update the manifest of a shard (manifest.json in its output directory): shard index, number of shards,
+    database and the given entries (e.g. the paths of the segment store, of the feature table, of the event journal),
+    so that merge_shards knows what to combine. Paths inside output_dir are kept relative to it, so the shard directory
+    can be copied to another host before merging.
+
+    Parameters
+    ------------
+
+    output_dir: str,
+        the output directory of the shard
+    shard: tuple,
+        (i, N)
+    database_name: str,
+        the name of the dataset
+    entries: dict,
+        what to add to the manifest, None values are ignored
+
+    Returns
+    ------------
+
+    The path of the manifest
+    """
+    manifest_path = os.path.join(output_dir, MANIFEST_NAME)
+    manifest = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r') as f:
+            manifest = json.load(f)
+
+    manifest.update({'shard': shard[0], 'n_shards': shard[1], 'database_name': database_name, 'updated_at': time.time()})
+    for key, value in entries.items():
+        if isinstance(value, str) and os.path.exists(value):
+            relative_path = os.path.relpath(value, output_dir)
+            value = os.path.abspath(value) if relative_path.startswith('..') else relative_path
+        if value is not None:
+            manifest[key] = value
+
+    with open(f'{manifest_path}.tmp', 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(f'{manifest_path}.tmp', manifest_path)
+
+    return manifest_path
+
+
+def _load_manifests(shard_dirs : List[str]) -> List[dict]:
+    manifests = []
+    for directory in shard_dirs:
+        with open(os.path.join(directory, MANIFEST_NAME), 'r') as f:
+            manifests.append(dict(json.load(f), shard_dir=directory))
+
+    n_shards = {manifest['n_shards'] for manifest in manifests}
+    databases = {manifest['database_name'] for manifest in manifests}
+    if len(n_shards) != 1 or len(databases) != 1:
+        raise ValueError(f'Shards of different runs: number of shards {n_shards}, databases {databases}')
+
+    indexes = sorted(manifest['shard'] for manifest in manifests)
+    if indexes != list(range(n_shards.pop())):
+        raise ValueError(f'Shards {indexes} do not cover the whole run, all the shards are required to merge them')
+
+    return sorted(manifests, key=lambda manifest: manifest['shard'])
+
+
+def _manifest_path(manifest : dict, key : str) -> Optional[str]:
+    # Paths of a manifest are relative to its shard directory
+    if manifest.get(key) is None:
+        return None
+    return os.path.join(manifest['shard_dir'], manifest[key])
+
+
+def _merge_segment_lists(list_paths : List[str], output_file : str) -> Tuple[int, int]:
+    # Patients never span shards: segments are ordered by patient, each keeping the order of its shard
+    # Returns the number of patients and records, as count_patients_and_records
+    database_names = set()
+    segments = []
+    for list_path in list_paths:
+        with open(list_path, 'r') as f:
+            lines = f.readlines()
+        database_names.add(lines[0].strip())
+        segments.extend([line.strip() for line in lines[1:] if line.strip()])
+
+    if len(database_names) != 1:
+        raise ValueError(f'{output_file}: the shards list segments of different databases {database_names}')
+
+    segments.sort(key=patient_of)
+    with open(output_file, 'w') as f:
+        f.write(f'{database_names.pop()}\n')
+        for segment in segments:
+            f.write(f'{segment}\n')
+
+    return len({patient_of(segment) for segment in segments}), len(segments)
+
+
+def _link_or_copy(source : str, destination : str) -> str:
+    # Hard link when source and destination are on the same file system, so the shards are left as they are at no cost
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copy2(source, destination)
+    return destination
+
+
+def _record_patients(records_dir : str) -> List[str]:
+    # Patients of a records directory, as patient directories or as members of the p*.zip archives
+    patients = {os.path.basename(patient_path) for patient_path in glob.glob(f'{records_dir}/p*/p*')}
+    for zip_file_path in glob.glob(f'{records_dir}/p*.zip'):
+        with zipfile.ZipFile(zip_file_path, 'r') as zip_ref:
+            # Members are .../parent_folder/patient_id/seg_id/signal.npy
+            patients.update(member.split('/')[-3] for member in zip_ref.namelist() if member.endswith('.npy') and member.count('/') >= 2)
+    return sorted(patients)
+
+
+def _check_shards(manifests : List[dict], output_dir : str) -> None:
+    # Everything that would stop the merge halfway is checked before anything is written
+    for manifest in manifests:
+        for key in MANIFEST_PATHS:
+            path = _manifest_path(manifest, key)
+            if path is not None and not os.path.exists(path):
+                raise ValueError(f'{path}, the {key} of the manifest of {manifest["shard_dir"]}, does not exist')
+
+    for directory, key in [('records', None), ('spectral', 'spectral_dir')]:
+        owners = {}
+        for manifest in manifests:
+            source = os.path.join(manifest['shard_dir'], 'records') if key is None else _manifest_path(manifest, key)
+            if source is None or not os.path.isdir(source):
+                continue
+            for patient_id in _record_patients(source):
+                if patient_id in owners:
+                    raise ValueError(f'{patient_id} is in the {directory} of both {owners[patient_id]} and {manifest["shard_dir"]}')
+                owners[patient_id] = manifest['shard_dir']
+
+    for name in MERGED_DIRS:
+        if os.path.exists(os.path.join(output_dir, name)):
+            raise ValueError(f'{os.path.join(output_dir, name)} already exists, merge in another output_dir')
+
+
+def _merge_records(records_dir : str, output_records_dir : str) -> None:
+    # Patient directories are linked (or copied) file by file, archives of the same patient group (p00.zip, ...) are combined member by member
+    for patient_path in glob.glob(f'{records_dir}/p*/p*'):
+        parent_folder, patient_id = patient_path.replace(os.sep, '/').split('/')[-2:]
+        shutil.copytree(patient_path, os.path.join(output_records_dir, parent_folder, patient_id), copy_function=_link_or_copy)
+
+    for zip_file_path in glob.glob(f'{records_dir}/p*.zip'):
+        with zipfile.ZipFile(zip_file_path, 'r') as source, zipfile.ZipFile(os.path.join(output_records_dir, os.path.basename(zip_file_path)), 'a', compression=zipfile.ZIP_DEFLATED, allowZip64=True) as destination:
+            for info in source.infolist():
+                with source.open(info) as source_member, destination.open(info, 'w', force_zip64=True) as destination_member:
+                    shutil.copyfileobj(source_member, destination_member, 2**20)
+
+
+def _publish(source : str, destination : str) -> None:
+    # Move an entry of the staging directory in place, directories already there (e.g. logs) receive its content
+    if os.path.isdir(source) and os.path.isdir(destination):
+        for name in os.listdir(source):
+            _publish(os.path.join(source, name), os.path.join(destination, name))
+        os.rmdir(source)
+    else:
+        os.replace(source, destination)
+
+
+def _merge_store(store_dir : str, output_store : SegmentStore) -> int:
+    with SegmentStore(store_dir) as store:
+        segment_ids = store.segment_ids()
+        for segment_id in segment_ids:
+            entry = store.info(segment_id)
+            output_store.append(segment_id, store.read(segment_id), entry['fs'], entry['channels'], entry['units'])
+    return len(segment_ids)
+
+
+def _merge_sqlite(source_path : str, output_path : str, schema : str, statement : str) -> None:
+    connection = sqlite3.connect(output_path)
+    connection.executescript(schema)
+    connection.execute('ATTACH DATABASE ? AS shard', (source_path,))
+    with connection:
+        connection.execute(statement)
+    connection.execute('DETACH DATABASE shard')
+    connection.close()
+
+
+def merge_shards(shard_dirs : List[str], output_dir : str) -> dict:
+    r"""
+    Combine the outputs of the shards of a run (one output directory per shard, with its manifest) in output_dir,
+    as if the run had been done on a single host:
+    - the segment lists (txt files with the database name on the first line) with the same name are merged, by patient
+    - patient directories of records are linked (or copied), and the p0*.zip archives of the same group are combined
+    - segment stores, feature tables, event journals and segment catalogs of the manifests are merged in output_dir (store, features.sqlite, events.sqlite, segments.sqlite)
+    - patient directories of the spectral features of the manifests are linked (or copied) in output_dir/spectral
+    - logs are copied in output_dir/logs, with the shard in the name
+    The merged manifest, written in output_dir, has the number of patients and records of every merged list.
+
+    The shards are checked first (all of them, same run, files of the manifests, no patient in two shards), then the
+    merge is built in output_dir/.merging, leaving the shards untouched, and finally moved in place with the manifest last.
+    A merge that failed can therefore be run again, and one interrupted while being moved in place is completed.
+
+    Parameters
+    ------------
+
+    shard_dirs: list,
+        the output directories of all the shards (e.g. copied from every host)
+    output_dir: str,
+        where to write the merged dataset
+
+    Returns
+    ------------
+
+    The merged manifest
+    """
+    if os.path.exists(os.path.join(output_dir, MANIFEST_NAME)):
+        raise ValueError(f'{output_dir} already contains a merged dataset')
+
+    staging_dir = os.path.join(output_dir, STAGING_NAME)
+    if os.path.exists(os.path.join(staging_dir, MANIFEST_NAME)):
+        print(f'Completing the merge staged in {staging_dir}', flush=True)
+    else:
+        manifests = _load_manifests(shard_dirs)
+        _check_shards(manifests, output_dir)
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        os.makedirs(staging_dir)
+        _stage_merge(manifests, output_dir, staging_dir)
+
+    with open(os.path.join(staging_dir, MANIFEST_NAME), 'r') as f:
+        merged = json.load(f)
+
+    # Every entry is renamed in place, the manifest last as the mark of a complete merge
+    for name in sorted(os.listdir(staging_dir)):
+        if name != MANIFEST_NAME:
+            _publish(os.path.join(staging_dir, name), os.path.join(output_dir, name))
+    os.replace(os.path.join(staging_dir, MANIFEST_NAME), os.path.join(output_dir, MANIFEST_NAME))
+    os.rmdir(staging_dir)
+
+    return merged
+
+
+def _stage_merge(manifests : List[dict], output_dir : str, staging_dir : str) -> None:
+    # The whole merge written in staging_dir, with its manifest at the end
+    database_name = manifests[0]['database_name']
+    merged = {'database_name': database_name, 'n_shards': len(manifests), 'shards': [manifest['shard_dir'] for manifest in manifests], 'counts': {}}
+
+    # SQLite files already in output_dir (e.g. a catalog opened by main.py) keep their rows, the shards are merged in a copy
+    for name in MERGED_SQLITE:
+        if os.path.exists(os.path.join(output_dir, name)):
+            shutil.copy2(os.path.join(output_dir, name), os.path.join(staging_dir, name))
+
+    # Segment lists: every txt file whose first line is the database name
+    list_names = sorted({os.path.basename(path) for manifest in manifests for path in glob.glob(os.path.join(manifest['shard_dir'], '*.txt'))})
+    for list_name in list_names:
+        list_paths = [os.path.join(manifest['shard_dir'], list_name) for manifest in manifests if os.path.exists(os.path.join(manifest['shard_dir'], list_name))]
+        with open(list_paths[0], 'r') as f:
+            if f.readline().strip() != database_name:
+                continue
+
+        num_patients, num_records = _merge_segment_lists(list_paths, os.path.join(staging_dir, list_name))
+        merged['counts'][list_name] = {'patients': num_patients, 'records': num_records, 'shards': len(list_paths)}
+        print(f'{list_name}: there are {num_patients} different patients, for a total of {num_records} different records, from {len(list_paths)} shards', flush=True)
+
+    for manifest in manifests:
+        shard_name = os.path.basename(os.path.normpath(manifest['shard_dir']))
+
+        records_dir = os.path.join(manifest['shard_dir'], 'records')
+        if os.path.isdir(records_dir):
+            os.makedirs(os.path.join(staging_dir, 'records'), exist_ok=True)
+            _merge_records(records_dir, os.path.join(staging_dir, 'records'))
+
+        store_dir = _manifest_path(manifest, 'store_dir')
+        if store_dir is not None and os.path.exists(store_dir):
+            with SegmentStore(os.path.join(staging_dir, 'store')) as output_store:
+                print(f'Merged {_merge_store(store_dir, output_store)} segments of {store_dir}', flush=True)
+            merged['store_dir'] = 'store'
+
+        features_path = _manifest_path(manifest, 'features_path')
+        if features_path is not None and os.path.exists(features_path):
+            _merge_sqlite(features_path, os.path.join(staging_dir, 'features.sqlite'), FEATURES_SCHEMA, 'INSERT OR REPLACE INTO features SELECT * FROM shard.features')
+            merged['features_path'] = 'features.sqlite'
+
+        journal_path = _manifest_path(manifest, 'journal_path')
+        if journal_path is not None and os.path.exists(journal_path):
+            _merge_sqlite(journal_path, os.path.join(staging_dir, 'events.sqlite'), EVENTS_SCHEMA, f'INSERT INTO events ({", ".join(EVENT_FIELDS)}) SELECT {", ".join(EVENT_FIELDS)} FROM shard.events ORDER BY event_id')
+            merged['journal_path'] = 'events.sqlite'
+
+        catalog_path = _manifest_path(manifest, 'catalog_path')
+        if catalog_path is not None and os.path.exists(catalog_path):
+            with SegmentCatalog(os.path.join(staging_dir, 'segments.sqlite')) as output_catalog:
+                print(f'Merged {output_catalog.merge(catalog_path)} segments of {catalog_path}', flush=True)
+            merged['catalog_path'] = 'segments.sqlite'
+
+        spectral_dir = _manifest_path(manifest, 'spectral_dir')
+        if spectral_dir is not None and os.path.isdir(spectral_dir):
+            os.makedirs(os.path.join(staging_dir, 'spectral'), exist_ok=True)
+            _merge_records(spectral_dir, os.path.join(staging_dir, 'spectral'))
+            merged['spectral_dir'] = 'spectral'
+
+        for log_path in glob.glob(os.path.join(manifest['shard_dir'], 'logs', '*')):
+            os.makedirs(os.path.join(staging_dir, 'logs'), exist_ok=True)
+            shutil.copy2(log_path, os.path.join(staging_dir, 'logs', f'{shard_name}_{os.path.basename(log_path)}'))
+
+    merged['merged_at'] = time.time()
+    with open(os.path.join(staging_dir, f'{MANIFEST_NAME}.tmp'), 'w') as f:
+        json.dump(merged, f, indent=2)
+    os.replace(os.path.join(staging_dir, f'{MANIFEST_NAME}.tmp'), os.path.join(staging_dir, MANIFEST_NAME))
@@ -0,0 +1,282 @@
+import glob
+import multiprocessing
+import os
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+from joblib import Parallel, delayed
+from scipy.signal import welch
+from data_preprocessing import create_windows, read_local_segment
+from segment_store import SegmentStore
+from instrumentation import instrumented, step, count
+
+
+# Windows are stacked as (PPG, ABP), as in the exported shards
+CHANNELS = ['ppg', 'abp']
+
+# Cardiac band in Hz, 30 to 240 bpm
+CARDIAC_BAND = (0.5, 4.0)
+
+# Features of every window and channel, stored as float32
+FEATURES = ['dominant_frequency', 'band_power', 'snr']
+
+
+def welch_windows(windows : np.array, fs : float, nperseg_seconds : float = 8.0, nfft : int = 2048) -> Tuple[np.array, np.array]:
+    r"""
+    Welch PSD of many equal-length windows at once, along the last axis (e.g. windows of shape (channels, n_windows, window_size)).
+
+    Parameters
+    ------------
+
+    windows: np.array,
+        the windows, the PSD is computed along the last axis
+    fs: float,
+        the sampling frequency
+    nperseg_seconds: float, default 8.0,
+        length of the Welch segments in seconds (50% overlap), shorter windows are a single segment
+    nfft: int, default 2048,
+        length of the FFT of every segment, zero padded for a finer frequency grid
+
+    Returns
+    ------------
+
+    The frequencies and the PSDs, of shape windows.shape[:-1] + (len(frequencies),)
+    """
+    nperseg = min(int(round(nperseg_seconds * fs)), windows.shape[-1])
+    return welch(windows, fs=fs, window='hann', nperseg=nperseg, nfft=max(nfft, nperseg), axis=-1)
+
+
+def psd_features(f : np.array, psd : np.array, band : Tuple[float, float] = CARDIAC_BAND, peak_width : float = 0.3) -> Dict[str, np.array]:
+    r"""
+    Spectral features of PSDs computed on the same frequencies, along the last axis:
+    - dominant_frequency: frequency of the highest peak inside band (Hz, the heart rate for PPG and ABP)
+    - band_power: power inside band
+    - snr: power within peak_width Hz of the dominant frequency and of its first harmonic, over the rest of the power
+      above band[0], in dB
+    PSDs with NaNs give NaN features.
+
+    Parameters
+    ------------
+
+    f: np.array,
+        the frequencies
+    psd: np.array,
+        the PSDs, frequencies on the last axis
+    band: tuple, default CARDIAC_BAND,
+        lower and upper frequency of the band where the dominant frequency is searched
+    peak_width: float, default 0.3,
+        half width in Hz of the peaks counted as signal by the SNR, it covers the main lobe of the Hann window
+        of 8 s Welch segments (0.25 Hz)
+
+    Returns
+    ------------
+
+    A dictionary with the features, of shape psd.shape[:-1]
+    """
+    df = f[1] - f[0]
+    in_band = (f >= band[0]) & (f <= band[1])
+    valid = ~np.isnan(psd).any(axis=-1)
+    psd = np.where(valid[..., None], psd, 0.0)
+
+    dominant_frequency = f[in_band][np.argmax(psd[..., in_band], axis=-1)]
+    band_power = psd[..., in_band].sum(axis=-1) * df
+
+    # Fundamental and first harmonic, over the rest of the spectrum above the band start
+    above = f >= band[0]
+    distance = np.abs(f[above] - dominant_frequency[..., None])
+    harmonic_distance = np.abs(f[above] - 2 * dominant_frequency[..., None])
+    peaks = (distance <= peak_width) | (harmonic_distance <= peak_width)
+    signal_power = np.where(peaks, psd[..., above], 0.0).sum(axis=-1)
+    noise_power = psd[..., above].sum(axis=-1) - signal_power
+    with np.errstate(divide='ignore', invalid='ignore'):
+        snr = 10 * np.log10(signal_power / noise_power)
+
+    return {
+        'dominant_frequency': np.where(valid, dominant_frequency, np.nan),
+        'band_power': np.where(valid, band_power, np.nan),
+        'snr': np.where(valid, snr, np.nan),
+    }
+
+
+def spectrum_path(spectral_dir : str, segment_id : str) -> str:
+    r"""
+    The feature file of a segment, spectral_dir/parent_folder/patient_id/seg_id.npz.
+    """
+    return os.path.join(spectral_dir, f'{segment_id}.npz')
+
+
+def save_segment_spectrum(spectral_dir : str, segment_id : str, fs : float, win_start : np.array, f : np.array, psd : np.array, features : Dict[str, np.array]) -> None:
+    # Per window features and the average PSD of the segment, in float32, written under a temporary name and then renamed
+    path = spectrum_path(spectral_dir, segment_id)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    arrays = {'fs': np.float32(fs), 'win_start': win_start.astype(np.int64), 'frequencies': f.astype(np.float32)}
+    for c, channel in enumerate(CHANNELS):
+        arrays[f'{channel}_psd'] = np.nanmean(psd[c], axis=0).astype(np.float32)
+        for feature in FEATURES:
+            arrays[f'{channel}_{feature}'] = features[feature][c].astype(np.float32)
+
+    with open(f'{path}.{os.getpid()}.part', 'wb') as file:
+        np.savez(file, **arrays)
+    os.replace(f'{path}.{os.getpid()}.part', path)
+
+
+def read_segment_spectrum(spectral_dir : str, segment_id : str) -> Dict[str, np.array]:
+    r"""
+    The spectral features of a segment: fs, win_start, frequencies, and for ppg and abp the average PSD
+    (<channel>_psd) and the features of every window (<channel>_dominant_frequency, <channel>_band_power, <channel>_snr).
+    """
+    with np.load(spectrum_path(spectral_dir, segment_id)) as arrays:
+        return {key: arrays[key] for key in arrays.files}
+
+
+def _compute_batch(spectral_dir : str, batch : List[Tuple[str, np.array, np.array]], fs : float, nperseg_seconds : float, nfft : int, band : Tuple[float, float]) -> None:
+    # One Welch call for the windows of all the segments of the batch, then split back by segment
+    with step('spectral.welch'):
+        f, psd = welch_windows(np.concatenate([windows for _, _, windows in batch], axis=1), fs, nperseg_seconds, nfft)
+    with step('spectral.features'):
+        features = psd_features(f, psd, band)
+
+    with step('spectral.write'):
+        start = 0
+        for segment_id, win_start, _ in batch:
+            stop = start + len(win_start)
+            save_segment_spectrum(spectral_dir, segment_id, fs, win_start, f, psd[:, start:stop], {feature: values[:, start:stop] for feature, values in features.items()})
+            start = stop
+
+
+@instrumented('spectral')
+def spectral_worker_function(segment_ids : List[str], spectral_dir : str, windowing_param : dict, records_dir : Optional[str] = None, store_dir : Optional[str] = None, fs : float = 125.0,
+                             nperseg_seconds : float = 8.0, nfft : int = 2048, band : Tuple[float, float] = CARDIAC_BAND, max_windows : int = 2048) -> int:
+    r"""
+    A thead wil spawn executing the code of this function, that is computing the spectral features of a batch of segments
+    read from the local output of the pipeline. The PPG and ABP windows of create_windows are stacked as a
+    (2, n_windows, window_size) array with the windows of many segments, up to max_windows, and their PSDs are computed
+    with a single Welch call. Segments already in spectral_dir are skipped, as those not found locally.
+
+    Parameters
+    ------------
+
+    segment_ids: list,
+        the segments in the parent_folder/patient_id/seg_id format
+    spectral_dir: str,
+        directory of the feature files
+    windowing_param: dict,
+        contains parameters tos etup the sliding window (length in seconds and overlap)
+    records_dir: str, default None,
+        directory with the parent_folder/patient_id/seg_id/{abp,ppg}.npy files of the segments
+    store_dir: str, default None,
+        directory of a SegmentStore, looked up before records_dir
+    fs: float, default 125.0,
+        the sampling frequency of the signals of records_dir
+    nperseg_seconds: float, default 8.0,
+        length of the Welch segments in seconds
+    nfft: int, default 2048,
+        length of the FFT of every Welch segment
+    band: tuple, default CARDIAC_BAND,
+        band of the dominant frequency and of the band power
+    max_windows: int, default 2048,
+        maximum number of windows of a Welch call (about 40 MB of float64 windows per 1000 windows of 20 s at 125 Hz)
+
+    Returns
+    ------------
+    The number of segments computed
+    """
+    store = SegmentStore(store_dir) if store_dir is not None else None
+    # Batches of windows with the same sampling frequency (all MIMIC-III waveforms are at 125 Hz)
+    batches = {}
+    n_computed = 0
+
+    for segment_id in segment_ids:
+        segment_id = segment_id.strip()
+        if os.path.exists(spectrum_path(spectral_dir, segment_id)):
+            continue
+
+        with step('spectral.read'):
+            signals = read_local_segment(segment_id, records_dir, store, fs)
+            if signals is None:
+                print(f'No local signals for {segment_id}, skipped', flush=True)
+                continue
+
+            abp, ppg, segment_fs, _ = signals
+            window_size = int(round(windowing_param['win_len'] * segment_fs))
+            win_start, _ = create_windows(windowing_param['win_len'], segment_fs, len(abp), windowing_param['win_overlap'])
+            if len(win_start) == 0:
+                continue
+
+            # Windows are strided views of the signals, copied once in the batch
+            windows = np.stack([np.lib.stride_tricks.sliding_window_view(signal, window_size)[win_start] for signal in [ppg, abp]])
+
+        batch = batches.setdefault(segment_fs, [])
+        batch.append((segment_id, win_start, windows))
+        count('segments')
+        n_computed += 1
+
+        if sum(len(start) for _, start, _ in batch) >= max_windows:
+            _compute_batch(spectral_dir, batch, segment_fs, nperseg_seconds, nfft, band)
+            batch.clear()
+
+    for segment_fs, batch in batches.items():
+        if batch:
+            _compute_batch(spectral_dir, batch, segment_fs, nperseg_seconds, nfft, band)
+
+    if store is not None:
+        store.close()
+    return n_computed
+
+
+def compute_spectral_features(valid_segments_file_path : str, spectral_dir : str, windowing_param : dict, n_cores : int = 1, records_dir : Optional[str] = None, store_dir : Optional[str] = None, batch_size : int = 64) -> None:
+    r"""
+    Spectral features (dominant frequency, band power and spectral SNR of the PPG and ABP windows) of the segments of
+    a txt file that are found in the local output, one feature file per segment in spectral_dir (see spectral_worker_function).
+
+    Parameters
+    ------------
+
+    valid_segments_file_path: str,
+        the txt file with the database name on the first line and the segments on the others
+    spectral_dir: str,
+        directory of the feature files
+    windowing_param: dict,
+        contains parameters tos etup the sliding window (length in seconds and overlap)
+    n_cores: int, default 1,
+        number of parallel workers
+    records_dir: str, default None,
+        directory of the downloaded segments
+    store_dir: str, default None,
+        directory of a SegmentStore
+    batch_size: int, default 64,
+        number of segments of a worker call
+
+    Returns
+    ------------
+    None
+    """
+    num_cores = multiprocessing.cpu_count()
+    print(f'Used cores {n_cores}/{num_cores}')
+
+    with open(valid_segments_file_path, 'r') as f:
+        segment_ids = [line.strip() for line in f.readlines()[1:] if line.strip()]
+
+    os.makedirs(spectral_dir, exist_ok=True)
+    n_computed = Parallel(n_jobs=n_cores)(delayed(spectral_worker_function)(segment_ids[i : i + batch_size], spectral_dir, windowing_param, records_dir, store_dir) for i in range(0, len(segment_ids), batch_size))
+    print(f'Computed the spectral features of {sum(n_computed)} segments in {spectral_dir}', flush=True)
+
+
+def load_spectral_table(spectral_dir : str) -> Dict[str, np.array]:
+    r"""
+    One row per segment of spectral_dir, with the median over the windows of every feature and the heart rate in bpm
+    (60 times the median dominant frequency), e.g. table['ppg_heart_rate'][i] for the segment table['segment_id'][i].
+    """
+    paths = sorted(glob.glob(os.path.join(spectral_dir, 'p*', 'p*', '*.npz')))
+    table = {'segment_id': np.array(['/'.join(os.path.relpath(path, spectral_dir).replace(os.sep, '/')[:-len('.npz')].split('/')[-3:]) for path in paths], dtype=object)}
+
+    columns = {f'{channel}_{feature}': [] for channel in CHANNELS for feature in FEATURES}
+    for path in paths:
+        with np.load(path) as arrays:
+            for column in columns:
+                columns[column].append(np.nanmedian(arrays[column]) if len(arrays[column]) else np.nan)
+
+    for column, values in columns.items():
+        table[column] = np.array(values, dtype=np.float64)
+    for channel in CHANNELS:
+        table[f'{channel}_heart_rate'] = 60 * table[f'{channel}_dominant_frequency']
+    return table
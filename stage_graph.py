@@ -0,0 +1,202 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+from typing import Callable, Dict, List, Optional
+
+
+STATE_NAME = 'stages.json'
+
+
+def hash_path(path : str) -> Optional[str]:
+    r"""
+    SHA-256 of a file content, of a directory from the names and sizes of its files (record directories and stores
+    are too large to be read at every check), None when the path does not exist.
+    """
+    digest = hashlib.sha256()
+    if os.path.isfile(path):
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(2**20), b''):
+                digest.update(block)
+        return digest.hexdigest()
+
+    if os.path.isdir(path):
+        for dir_path, dir_names, file_names in os.walk(path):
+            dir_names.sort()
+            for file_name in sorted(file_names):
+                file_path = os.path.join(dir_path, file_name)
+                digest.update(f'{os.path.relpath(file_path, path)}\0{os.path.getsize(file_path)}\n'.encode())
+        return digest.hexdigest()
+
+    return None
+
+
+class Stage:
+    r"""
+    A stage of the pipeline: a function producing outputs (paths) from the outputs of the stages it depends on.
+
+    Parameters
+    ------------
+
+    name: str,
+        name of the stage, also the CLI subcommand
+    run: callable,
+        run(upstream) -> dict of outputs (name -> path), upstream has the outputs of all the stages before
+    deps: list, default (),
+        names of the stages whose outputs are needed
+    params: dict, default None,
+        JSON serializable parameters changing the outputs (thresholds, paths, ...), not the ones changing only the speed
+    inputs: list, default None,
+        paths read by the stage that are not produced by another stage (e.g. a valid segments file given by the user)
+    clear: list, default None,
+        outputs removed before the stage runs again because something changed (or it is forced), for the stages
+        skipping what they find already done, so that a run that was only interrupted (with the same key) still resumes from them
+    """
+
+    def __init__(self, name : str, run : Callable[[dict], Dict[str, str]], deps : List[str] = (), params : Optional[dict] = None, inputs : Optional[List[str]] = None, clear : Optional[List[str]] = None):
+        self.name = name
+        self.run = run
+        self.deps = list(deps)
+        self.params = params if params is not None else {}
+        self.inputs = [path for path in (inputs or []) if path is not None]
+        self.clear = clear or []
+
+
+class StageGraph:
+    r"""
+    Stages forming a dependency graph, run as a make-like build: running a stage runs first the stages it depends on,
+    and a stage is skipped when it is up to date. The key of a stage is the SHA-256 of its parameters, of the content
+    of its inputs and of the outputs of its dependencies, so a stage runs again when any of them changes and stays
+    up to date when a dependency runs again producing the same outputs.
+    Keys, outputs and their hashes are kept in output_dir/stages.json after every completed stage, and the key of a
+    stage is marked as running before it starts, so that an interrupted stage runs again without clearing its outputs.
+
+    Parameters
+    ------------
+
+    output_dir: str,
+        directory of the state file
+    """
+
+    def __init__(self, output_dir : str):
+        self.state_path = os.path.join(output_dir, STATE_NAME)
+        self.stages = {}
+        self.state = {}
+        if os.path.exists(self.state_path):
+            with open(self.state_path, 'r') as f:
+                self.state = json.load(f)
+
+    def add(self, stage : Stage) -> Stage:
+        for dep in stage.deps:
+            if dep not in self.stages:
+                raise ValueError(f'{stage.name} depends on {dep}, which is not a stage of the graph')
+        self.stages[stage.name] = stage
+        return stage
+
+    def order(self, target : str) -> List[str]:
+        r"""
+        The stages to go through to run target, dependencies first (stages are added after their dependencies, so there are no cycles).
+        """
+        needed, to_visit = set(), [target]
+        while to_visit:
+            name = to_visit.pop()
+            if name not in needed:
+                needed.add(name)
+                to_visit.extend(self.stages[name].deps)
+        return [name for name in self.stages if name in needed]
+
+    def key(self, name : str) -> str:
+        r"""
+        The key of a stage with its current parameters and inputs and the last outputs of its dependencies.
+        """
+        stage = self.stages[name]
+        content = {
+            'params': stage.params,
+            'inputs': {path: hash_path(path) for path in stage.inputs},
+            'deps': {dep: self.state.get(dep, {}).get('output_hashes') for dep in stage.deps},
+        }
+        return hashlib.sha256(json.dumps(content, sort_keys=True, default=str).encode()).hexdigest()
+
+    def why_stale(self, name : str, check_outputs : bool = True) -> Optional[str]:
+        r"""
+        Why a stage has to run ('never run', 'interrupted', 'parameters or inputs changed', 'outputs changed'), None when it is up to date.
+        Output files are hashed again, output directories only with check_outputs (otherwise only their existence is checked).
+        """
+        state = self.state.get(name)
+        if state is None or 'key' not in state:
+            return 'never run'
+        if state.get('running') is not None:
+            return 'interrupted'
+        if state['key'] != self.key(name):
+            return 'parameters or inputs changed'
+        for output, path in state['outputs'].items():
+            if not os.path.exists(path):
+                return f'{output} missing'
+            if (check_outputs or os.path.isfile(path)) and hash_path(path) != state['output_hashes'][output]:
+                return f'{output} changed'
+        return None
+
+    def _save(self) -> None:
+        with open(f'{self.state_path}.tmp', 'w') as f:
+            json.dump(self.state, f, indent=2)
+        os.replace(f'{self.state_path}.tmp', self.state_path)
+
+    def run(self, target : str, force : bool = False) -> dict:
+        r"""
+        Run target and the stages it depends on that are not up to date.
+
+        Parameters
+        ------------
+
+        target: str,
+            the stage to run
+        force: bool, default False,
+            whether to run target even if it is up to date (its dependencies are still skipped when up to date)
+
+        Returns
+        ------------
+
+        The outputs of target and of all the stages before it
+        """
+        upstream = {}
+        for name in self.order(target):
+            reason = 'forced' if force and name == target else self.why_stale(name)
+            if reason is None:
+                print(f'Stage {name} is up to date, skipped', flush=True)
+                upstream.update(self.state[name]['outputs'])
+                continue
+
+            print(f'Running stage {name} ({reason}) ...', flush=True)
+            # The outputs of a run interrupted with the same key are kept, the stage resumes from them
+            key = self.key(name)
+            if reason == 'forced' or (reason != 'never run' and self.state[name].get('running') != key):
+                for path in self.stages[name].clear:
+                    shutil.rmtree(path, ignore_errors=True)
+            self.state[name] = {**self.state.get(name, {}), 'running': key}
+            self._save()
+
+            start = time.time()
+            outputs = self.stages[name].run(dict(upstream))
+            # The key is computed after the run, when the dependencies' outputs are the ones just used
+            self.state[name] = {'key': self.key(name), 'outputs': outputs, 'output_hashes': {output: hash_path(path) for output, path in outputs.items()},
+                                'completed_at': time.time(), 'seconds': time.time() - start}
+            self._save()
+            print(f'Stage {name} done in {time.time() - start:.1f}s', flush=True)
+            upstream.update(outputs)
+
+        return upstream
+
+    def status(self) -> List[dict]:
+        r"""
+        State of every stage without running anything or walking the output directories: name, whether it is up to date (or why not),
+        when it completed and how long it took.
+        """
+        rows, stale = [], {}
+        for name, stage in self.stages.items():
+            state = self.state.get(name, {})
+            stale[name] = self.why_stale(name, check_outputs=False)
+            if stale[name] is None:
+                stale[name] = next((f'{dep} is not up to date' for dep in stage.deps if stale[dep] is not None), None)
+            rows.append({'stage': name, 'stale': stale[name], 'completed_at': state.get('completed_at'), 'seconds': state.get('seconds'), 'outputs': state.get('outputs', {})})
+        return rows
@@ -0,0 +1,152 @@
+import os
+import posixpath
+from typing import Iterator, List, Optional, Tuple
+import numpy as np
+import wfdb
+from record_cache import get_record_cache
+
+
+# Bytes per sample of the WFDB storage formats (212 packs two 12 bit samples in 3 bytes, 310/311 three 10 bit samples in 4 bytes)
+BYTES_PER_SAMPLE = {'8': 1, '16': 2, '24': 3, '32': 4, '61': 2, '80': 1, '160': 2, '212': 1.5, '310': 4 / 3, '311': 4 / 3}
+
+
+def get_record_list(database_name : str, record_dir : str = '', local_dir : Optional[str] = None) -> List[str]:
+    r"""
+    List the records of a database directory, either from PhysioNet or from a local WFDB mirror.
+    A local mirror is a copy of the database tree (e.g. produced with wfdb.dl_database), where every
+    directory contains the same RECORDS file that PhysioNet serves.
+
+    Parameters
+    ------------
+
+    database_name: str,
+        the name of the dataset inside PhysioNet (e.g. mimic3wdb-matched/1.0)
+    record_dir: str, default '',
+        the directory relative to the database root (e.g. p00/p000020/)
+    local_dir: str, default None,
+        root directory of a local mirror of database_name, when None PhysioNet is queried
+
+    Returns
+    ------------
+
+    The list of records names, as they appear in the RECORDS file
+    """
+
+    if local_dir is None:
+        return wfdb.get_record_list(posixpath.join(database_name, record_dir).rstrip('/'))
+
+    with open(os.path.join(local_dir, record_dir, 'RECORDS'), 'r') as records_file:
+        return records_file.read().splitlines()
+
+
+def rdheader(record_name : str, database_name : str, record_dir : str = '', local_dir : Optional[str] = None):
+    r"""
+    Read a WFDB header either from PhysioNet or from a local WFDB mirror.
+
+    Parameters
+    ------------
+
+    record_name: str,
+        the name of the record (without extension)
+    database_name: str,
+        the name of the dataset inside PhysioNet (e.g. mimic3wdb-matched/1.0)
+    record_dir: str, default '',
+        the directory relative to the database root that contains the record (e.g. p00/p000020/)
+    local_dir: str, default None,
+        root directory of a local mirror of database_name, when None PhysioNet is queried
+
+    Returns
+    ------------
+
+    A wfdb Record or MultiRecord with the header fields
+    """
+
+    if local_dir is None:
+        # Through the local record cache when it is enabled (see record_cache.py)
+        cache = get_record_cache()
+        if cache is not None:
+            return wfdb.rdheader(record_name=cache.fetch_header(database_name, record_dir, record_name))
+        return wfdb.rdheader(record_name=record_name, pn_dir=posixpath.join(database_name, record_dir).rstrip('/'))
+
+    return wfdb.rdheader(record_name=os.path.join(local_dir, record_dir, record_name))
+
+
+def signal_file_bytes(header) -> int:
+    r"""
+    Size in bytes of the signal file of a single segment record, from its header: sig_len frames of all the channels.
+    """
+    return int(header.sig_len * sum(BYTES_PER_SAMPLE.get(str(fmt), 2) for fmt in header.fmt))
+
+
+def rdrecord(record_name : str, database_name : str, record_dir : str = '', local_dir : Optional[str] = None, **kwargs):
+    r"""
+    Read a WFDB record either from PhysioNet or from a local WFDB mirror.
+
+    Parameters
+    ------------
+
+    record_name: str,
+        the name of the record (without extension)
+    database_name: str,
+        the name of the dataset inside PhysioNet (e.g. mimic3wdb-matched/1.0)
+    record_dir: str, default '',
+        the directory relative to the database root that contains the record (e.g. p00/p000020/)
+    local_dir: str, default None,
+        root directory of a local mirror of database_name, when None PhysioNet is queried
+    kwargs:
+        other arguments of wfdb.rdrecord (channel_names, sampfrom, sampto, ...)
+
+    Returns
+    ------------
+
+    A wfdb Record with the signals
+    """
+
+    if local_dir is None:
+        # The whole signal files are cached once, the following reads are local
+        cache = get_record_cache()
+        if cache is not None:
+            return wfdb.rdrecord(record_name=cache.fetch_record(database_name, record_dir, record_name), **kwargs)
+        return wfdb.rdrecord(record_name=record_name, pn_dir=posixpath.join(database_name, record_dir).rstrip('/'), **kwargs)
+
+    return wfdb.rdrecord(record_name=os.path.join(local_dir, record_dir, record_name), **kwargs)
+
+
+def iter_record_chunks(record_name : str, database_name : str, record_dir : str = '', local_dir : Optional[str] = None, channel_names : Optional[List[str]] = None, chunk_size : int = 2**18, sig_len : Optional[int] = None) -> Iterator[Tuple[int, np.array]]:
+    r"""
+    Read some channels of a WFDB record in chunks of at most chunk_size samples, either from PhysioNet or from
+    a local WFDB mirror, so that the whole record is never in memory. From PhysioNet only the byte range of
+    every chunk is requested, but channels stored in the same signal file are interleaved in it (as in MIMIC-III),
+    so the other channels of that file are still transferred.
+
+    Parameters
+    ------------
+
+    record_name: str,
+        the name of the record (without extension)
+    database_name: str,
+        the name of the dataset inside PhysioNet (e.g. mimic3wdb-matched/1.0)
+    record_dir: str, default '',
+        the directory relative to the database root that contains the record (e.g. p00/p000020/)
+    local_dir: str, default None,
+        root directory of a local mirror of database_name, when None PhysioNet is queried
+    channel_names: list, default None,
+        the channels to read, in the order they are returned, when None all the channels are read
+    chunk_size: int, default 2**18,
+        maximum number of samples of every chunk
+    sig_len: int, default None,
+        length of the record, when None it is read from the header
+
+    Returns
+    ------------
+
+    A generator of (sampfrom, chunk) pairs, where chunk is a (samples x channels) array of physical values
+    """
+
+    if sig_len is None:
+        sig_len = rdheader(record_name, database_name, record_dir, local_dir).sig_len
+
+    for sampfrom in range(0, sig_len, chunk_size):
+        sampto = min(sampfrom + chunk_size, sig_len)
+        chunk = rdrecord(record_name, database_name, record_dir, local_dir, channel_names=channel_names, sampfrom=sampfrom, sampto=sampto)
+        yield sampfrom, chunk.p_signal